@@ -25,12 +25,20 @@ def main():
     run_parser = subparsers.add_parser('run', help="Run the pipeline.")
     serve_control_parser = subparsers.add_parser('serve-control', help="Serve the control flows.")
     serve_data_parser = subparsers.add_parser('serve-data', help="Serve the data-processing flows.")
+    query_profile_parser = subparsers.add_parser('query-profile',
+                                                 help="Show the most expensive SQL statements from recorded profiles.")
+    flow_weights_parser = subparsers.add_parser('flow-weights',
+                                                help="Compare the configured flow launch weights to learned ones.")
 
     run_parser.add_argument("config", type=str, help="Path to config.")
     run_parser.add_argument("--launch-prefect", action="store_true", help="Launch the prefect server")
     run_parser.add_argument("--no-dask-cluster", action="store_true", help="Skip launching the dask cluster")
     serve_control_parser.add_argument("config", type=str, help="Path to config.")
     serve_data_parser.add_argument("config", type=str, help="Path to config.")
+    query_profile_parser.add_argument("--hours", type=float, default=24, help="How far back to look")
+    query_profile_parser.add_argument("--top", type=int, default=20, help="How many statements to show")
+    query_profile_parser.add_argument("--flow-type", type=str, default=None, help="Only include this flow type")
+    flow_weights_parser.add_argument("config", type=str, help="Path to config.")
     args = parser.parse_args()
 
     if args.command == 'run':
@@ -39,9 +47,41 @@ def main():
         run_data(args.config)
     elif args.command == 'serve-control':
         run_control(args.config)
+    elif args.command == 'query-profile':
+        show_query_profile(args.hours, args.top, args.flow_type)
+    elif args.command == 'flow-weights':
+        show_flow_weights(args.config)
     else:
         parser.print_help()
 
+def show_query_profile(hours: float, top: int, flow_type: str | None):
+    from punchpipe.control.profiling import get_top_statements
+    from punchpipe.control.util import get_database_session
+
+    session = get_database_session(read_only=True)
+    rows = get_top_statements(session, datetime.now() - timedelta(hours=hours), n=top, flow_type=flow_type)
+    session.close()
+    if not rows:
+        print("No query profiles recorded in that window. Is profiling enabled in the config?")
+        return
+    table = pd.DataFrame(rows, columns=["fingerprint", "count", "total_time", "max_time", "rows", "n_runs"])
+    table["mean_time"] = table["total_time"] / table["count"]
+    with pd.option_context("display.max_colwidth", 120, "display.width", 250):
+        print(table[["total_time", "mean_time", "max_time", "count", "rows", "n_runs", "fingerprint"]])
+
+def show_flow_weights(configuration_path: str):
+    from punchpipe.control.calibration import compare_weights
+    from punchpipe.control.util import get_database_session
+
+    session = get_database_session(read_only=True)
+    rows = compare_weights(load_pipeline_configuration(configuration_path), session)
+    session.close()
+    table = pd.DataFrame(rows).set_index("flow_type")
+    if "learned" not in table:
+        print("No flow weights have been learned yet. Is the calibrator control flow running?")
+    with pd.option_context("display.width", 250, "display.float_format", "{:.2f}".format):
+        print(table)
+
 def find_flow(target_flow, subpackage="flows") -> Flow:
     for filename in os.listdir(os.path.join(THIS_DIR, subpackage)):
         if filename.endswith(".py"):
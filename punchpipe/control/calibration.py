@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import psutil
+from prefect import flow, get_run_logger, task
+from prefect.cache_policies import NO_CACHE
+from sqlalchemy import delete, func, insert, select
+
+from punchpipe.control.db import Flow, FlowResources, FlowWeight, ResourceUsage, seconds_between
+from punchpipe.control.health import MACHINE, MINUTE
+from punchpipe.control.util import get_database_session, load_pipeline_configuration
+
+
+@task(cache_policy=NO_CACHE)
+def measure_flow_types(session, since: datetime) -> dict[str, dict]:
+    """Gathers each flow type's run times and resource usage since `since`
+
+    Durations come from the flows table, and CPU time from what each flow recorded as it finished (completed or failed),
+    so short flows that the health monitor's once-a-minute samples miss still count. The peak memory of one process is
+    estimated from each minute's peak total across that type's processes, divided by how many there were, and is then
+    shared among the flows a process runs at once. That's the type's mean batch size, since a batch of flows shares one
+    Prefect run and one process. If the memory a flow recorded as it finished is larger, which it can be for flows too
+    short to be sampled, that's used instead.
+    """
+    durations = {}
+    for flow_type, duration in session.execute(select(Flow.flow_type, seconds_between(Flow.start_time, Flow.end_time))
+                                               .where(Flow.state == "completed")
+                                               .where(Flow.end_time >= since)
+                                               .where(Flow.start_time.is_not(None))):
+        durations.setdefault(flow_type, []).append(duration)
+    finished = {flow_type: (n_flows, cpu_seconds, rss) for flow_type, n_flows, cpu_seconds, rss in session.execute(
+        select(FlowResources.flow_type, func.count(), func.sum(FlowResources.cpu_seconds), func.max(FlowResources.rss))
+        .where(FlowResources.finished_at >= since)
+        .group_by(FlowResources.flow_type))}
+    sampled_peak_rss = dict(session.execute(
+        select(ResourceUsage.flow_type, func.max(ResourceUsage.max_rss / ResourceUsage.n_processes))
+        .where(ResourceUsage.period_seconds == MINUTE)
+        .where(ResourceUsage.period_start >= since)
+        .where(ResourceUsage.flow_type != MACHINE)
+        .group_by(ResourceUsage.flow_type)).all())
+
+    # Speedster's processes run one flow at a time, under a name per process rather than per batch
+    runs = session.execute(select(Flow.flow_type, func.count())
+                           .where(Flow.state.in_(("completed", "failed")))
+                           .where(Flow.end_time >= since)
+                           .where(Flow.flow_run_name.is_not(None))
+                           .where(Flow.flow_run_name.not_like("speedster%"))
+                           .group_by(Flow.flow_type, Flow.flow_run_name)).all()
+    batch_sizes = {}
+    for flow_type, n_flows in runs:
+        batch_sizes.setdefault(flow_type, []).append(n_flows)
+
+    measurements = {}
+    for flow_type, these_durations in durations.items():
+        if flow_type not in finished:
+            continue
+        n_flows, cpu_seconds, finishing_rss = finished[flow_type]
+        p50, p90, p99 = np.percentile(these_durations, [50, 90, 99])
+        cpu_seconds = cpu_seconds / n_flows
+        peak_rss = finishing_rss
+        if flow_type in sampled_peak_rss:
+            peak_rss = max(peak_rss, sampled_peak_rss[flow_type] / np.mean(batch_sizes.get(flow_type, [1])))
+        measurements[flow_type] = {"n_flows": len(these_durations), "duration_p50": p50, "duration_p90": p90,
+                                   "duration_p99": p99, "cpu_seconds": cpu_seconds,
+                                   "cores": cpu_seconds / max(np.mean(these_durations), 1), "peak_rss": peak_rss}
+    return measurements
+
+
+def recommend_weight(measurement: dict, memory_per_weight: float, min_weight: float) -> float:
+    """A flow type's weight is its share of the machine's most-used resource, in units where 1 is one core's worth
+
+    That's the larger of the cores it keeps busy and its peak memory in units of `memory_per_weight` bytes, so that a
+    flow that's light on CPU but holds a lot of memory isn't packed in too densely.
+    """
+    weight = max(measurement["cores"], measurement["peak_rss"] / memory_per_weight, min_weight)
+    return round(float(weight), 2)
+
+
+def get_learned_weights(session) -> dict[str, float]:
+    return dict(session.execute(select(FlowWeight.flow_type, FlowWeight.weight)).all())
+
+
+def compare_weights(pipeline_config: dict, session) -> list[dict]:
+    """Each flow type's configured weight next to its learned weight and measurements, for review"""
+    learned = {row.flow_type: row for row in session.execute(select(FlowWeight)).scalars()}
+    rows = []
+    for flow_type in sorted(set(pipeline_config["flows"]) | set(learned)):
+        configured = pipeline_config["flows"].get(flow_type, {}).get("launch_weight", 1)
+        row = {"flow_type": flow_type, "configured": configured}
+        if flow_type in learned:
+            weight = learned[flow_type]
+            row.update(learned=weight.weight, n_flows=weight.n_flows, duration_p50=weight.duration_p50,
+                       duration_p90=weight.duration_p90, cores=weight.cores, peak_rss_gb=weight.peak_rss / 1E9,
+                       computed_at=weight.computed_at)
+            if isinstance(configured, (int, float)) and configured:
+                row["ratio"] = weight.weight / configured
+        rows.append(row)
+    return rows
+
+
+@flow
+def calibrator(pipeline_config_path: str, session=None):
+    """Learns each flow type's launch weight from its recent run times and resource usage
+
+    Flow types with `launch_weight: auto` in the config are launched with these weights.
+    """
+    logger = get_run_logger()
+
+    pipeline_config = load_pipeline_configuration(pipeline_config_path)
+    calibrator_config = pipeline_config["control"].get("calibrator", {})
+    if session is None:
+        session = get_database_session()
+
+    now = datetime.now()
+    measurements = measure_flow_types(session, now - timedelta(days=calibrator_config.get("lookback_days", 7)))
+    memory_per_weight = calibrator_config.get("memory_gb_per_weight", None)
+    if memory_per_weight is None:
+        memory_per_weight = psutil.virtual_memory().total / psutil.cpu_count()
+    else:
+        memory_per_weight *= 1E9
+    min_flows = calibrator_config.get("min_flows", 20)
+    min_weight = calibrator_config.get("min_weight", 0.1)
+
+    rows = []
+    for flow_type, measurement in sorted(measurements.items()):
+        if measurement["n_flows"] < min_flows:
+            logger.info(f"Only {measurement['n_flows']} recent {flow_type} flows; keeping its previous weight")
+            continue
+        weight = recommend_weight(measurement, memory_per_weight, min_weight)
+        rows.append(dict(flow_type=flow_type, computed_at=now, weight=weight, **measurement))
+        configured = pipeline_config["flows"].get(flow_type, {}).get("launch_weight", 1)
+        logger.info(f"{flow_type}: weight {weight} (configured {configured}) from {measurement['n_flows']} flows, "
+                    f"median duration {measurement['duration_p50']:.0f} s, {measurement['cores']:.2f} cores, "
+                    f"peak memory {measurement['peak_rss'] / 1E9:.2f} GB")
+    if rows:
+        session.execute(delete(FlowWeight).where(FlowWeight.flow_type.in_([row["flow_type"] for row in rows])))
+        session.execute(insert(FlowWeight), rows)
+        session.commit()
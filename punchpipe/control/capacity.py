@@ -0,0 +1,117 @@
+import socket
+from datetime import datetime, timedelta
+
+import psutil
+from sqlalchemy import func, select
+
+from punchpipe.control.db import Health, LaunchCapacity
+
+# Settings for control.launcher.adaptive_capacity that don't have to be given. The thresholds are percentages; above the
+# high threshold capacity is lowered, below the low one it can be raised, and in between it's held.
+CAPACITY_DEFAULTS = {
+    "memory_high": 85, "memory_low": 70,
+    "cpu_high": 95, "cpu_low": 80,
+    "iowait_high": 25, "iowait_low": 10,
+    "increase_step": 5,
+    "decrease_factor": 0.8,
+    # The minimum time between raises, so each one's effect shows up in the readings before the next
+    "hold_seconds": 120,
+    # How often to make a new decision, and how much health-monitor history to consider
+    "interval_seconds": 30,
+    "telemetry_minutes": 5,
+}
+
+# Each non-blocking reading covers the time since the one before, so take one now that the first has something to go on
+psutil.cpu_times_percent(interval=None)
+
+
+def measure_pressure(session, now: datetime, telemetry_minutes: float) -> dict[str, float]:
+    """The machine's current CPU, memory and IO-wait usage, as percentages
+
+    CPU and memory are the higher of a live psutil reading and their recent average from the health monitor, so a
+    brief lull doesn't look like spare capacity. The live CPU reading covers the time since the previous one, rather
+    than blocking the launcher while it measures.
+    """
+    times = psutil.cpu_times_percent(interval=None)
+    iowait = getattr(times, "iowait", 0.0)
+    pressure = {"cpu": 100 - times.idle - iowait, "memory": psutil.virtual_memory().percent, "iowait": iowait}
+    recent_cpu, recent_memory = session.execute(
+        select(func.avg(Health.cpu_usage), func.avg(Health.memory_percentage))
+        .where(Health.datetime >= now - timedelta(minutes=telemetry_minutes))).one()
+    if recent_cpu is not None:
+        pressure["cpu"] = max(pressure["cpu"], recent_cpu)
+        pressure["memory"] = max(pressure["memory"], recent_memory)
+    return pressure
+
+
+def adjust_capacity(capacity: float, weight_running: float, pressure: dict[str, float], config: dict,
+                    seconds_since_change: float) -> tuple[float, str, str]:
+    """Decides the launcher's new maximum running weight
+
+    If any reading is over its high threshold, capacity is cut by `decrease_factor`, unless the running weight is
+    already above capacity and draining. If all readings are under their low thresholds, capacity is raised by
+    `increase_step`, but only when it's what's limiting launches and it hasn't changed within `hold_seconds`. The
+    result stays between `min_weight_running` and `max_weight_running`.
+
+    Returns
+    -------
+    The new capacity, the action taken ("lower", "raise" or "hold") and the reason for it
+    """
+    lower_bound, upper_bound = config["min_weight_running"], config["max_weight_running"]
+    capacity = min(max(capacity, lower_bound), upper_bound)
+
+    over = [f"{name} {value:.0f}% > {config[f'{name}_high']}%"
+            for name, value in pressure.items() if value > config[f"{name}_high"]]
+    if over:
+        if weight_running > capacity:
+            return capacity, "hold", f"{', '.join(over)}, but running weight {weight_running:.1f} is still draining"
+        new_capacity = max(lower_bound, capacity * config["decrease_factor"])
+        if new_capacity == capacity:
+            return capacity, "hold", f"{', '.join(over)}, but at the lower bound"
+        return new_capacity, "lower", ", ".join(over)
+
+    if any(value >= config[f"{name}_low"] for name, value in pressure.items()):
+        return capacity, "hold", "within the hysteresis band"
+    if weight_running < capacity - config["increase_step"]:
+        return capacity, "hold", f"running weight {weight_running:.1f} isn't limited by capacity"
+    if seconds_since_change < config["hold_seconds"]:
+        return capacity, "hold", f"last changed {seconds_since_change:.0f} s ago"
+    new_capacity = min(upper_bound, capacity + config["increase_step"])
+    if new_capacity == capacity:
+        return capacity, "hold", "at the upper bound"
+    return new_capacity, "raise", "all readings below their low thresholds"
+
+
+def get_launch_capacity(session, launcher_config: dict, weight_running: float, logger,
+                        now: datetime | None = None) -> float:
+    """The maximum running weight for the launcher, adapted to the machine's load if that's enabled
+
+    Decisions are made at most every `interval_seconds`, and each is recorded in the launch_capacity table, which also
+    carries the current capacity from one launcher run to the next.
+    """
+    adaptive_config = launcher_config.get("adaptive_capacity", {})
+    if not adaptive_config.get("enabled", False):
+        return launcher_config["max_weight_running"]
+    config = {**CAPACITY_DEFAULTS, **adaptive_config}
+    if now is None:
+        now = datetime.now()
+
+    latest = session.execute(select(LaunchCapacity).order_by(LaunchCapacity.decided_at.desc()).limit(1)).scalar()
+    if latest is not None and (now - latest.decided_at).total_seconds() < config["interval_seconds"]:
+        return latest.max_weight_running
+    capacity = launcher_config["max_weight_running"] if latest is None else latest.max_weight_running
+    last_change = session.execute(select(func.max(LaunchCapacity.decided_at))
+                                  .where(LaunchCapacity.action != "hold")).scalar()
+    seconds_since_change = float("inf") if last_change is None else (now - last_change).total_seconds()
+
+    pressure = measure_pressure(session, now, config["telemetry_minutes"])
+    new_capacity, action, reason = adjust_capacity(capacity, weight_running, pressure, config, seconds_since_change)
+    session.add(LaunchCapacity(decided_at=now, hostname=socket.gethostname(), previous_weight=capacity,
+                               max_weight_running=new_capacity, weight_running=weight_running,
+                               cpu_percentage=pressure["cpu"], memory_percentage=pressure["memory"],
+                               iowait_percentage=pressure["iowait"], action=action, reason=reason))
+    session.commit()
+    logger.info(f"Launch capacity {action}: {capacity:.1f} -> {new_capacity:.1f} ({reason}). "
+                f"CPU {pressure['cpu']:.0f}%, memory {pressure['memory']:.0f}%, IO wait {pressure['iowait']:.0f}%, "
+                f"running weight {weight_running:.1f}")
+    return new_capacity
@@ -1,8 +1,9 @@
 import os
+import socket
 import asyncio
 import subprocess
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import UTC, datetime, timedelta
 
 from prefect import flow, get_run_logger, task
 from prefect.cache_policies import NO_CACHE
@@ -14,9 +15,12 @@ from prefect.client.schemas.filters import (
     FlowRunFilterStateType,
 )
 from prefect.client.schemas.objects import StateType
+from sqlalchemy import and_, delete, false, func, insert, or_, select
 from sqlalchemy.orm import aliased
 
-from punchpipe.control.db import File, FileRelationship, Flow
+from punchpipe.control.db import PACKETNAME2ARCHIVE, PACKETNAME2SQL, SCI_XFI, File, FileRelationship, Flow, FlowArchive
+from punchpipe.control.health import terminate_flow_processes
+from punchpipe.control.model_grid import reset_model_grids
 from punchpipe.control.util import get_database_session, load_pipeline_configuration
 
 
@@ -36,6 +40,10 @@ async def cleaner(pipeline_config_path: str, session=None):
     # running flows are both in Prefect and in our punchpipe database, so we have to cancel them both places
     await fail_stuck_flows(logger, session, pipeline_config, "running", update_prefect=True)
 
+    archive_old_flows(logger, session, pipeline_config)
+
+    archive_old_packets(logger, session, pipeline_config)
+
 @task(cache_policy=NO_CACHE)
 def reset_revivable_flows(logger, session, pipeline_config):
     # Note: I thought about adding a maximum here, but this flow takes only 5 seconds to revive 10,000 L1 flows, so I
@@ -99,6 +107,9 @@ def reset_revivable_flows(logger, session, pipeline_config):
         session.delete(f)
     logger.info(f"Deleted {len(unique_flows)} flows")
 
+    # Any deleted model files are behind their grid's high-water mark, so have the schedulers rebuild those grids
+    reset_model_grids(session, {f.flow_type for f in unique_flows})
+
     session.commit()
     if len(unique_flows):
         logger.info(f"Processed {len(unique_flows)} revivable flows")
@@ -139,8 +150,8 @@ async def cancel_running_prefect_flows_before_cutoff(
                 # First we send a cancel signal. If the underlying is process actually is still running, we don't
                 # want to leave it running unmonitored. (Ideally we wouldn't be cancelling it at all, but failing
                 # that, this is the next best thing.) There doesn't appear to be a way to cancel flows from the
-                # python client, so we have to roll up our sleeves. There also doesn't appear to be a way to get the
-                # PID of the underlying flow so we can kill it ourselves.
+                # python client, so we have to roll up our sleeves. (Flow processes are terminated through our own
+                # process registry; this is to keep Prefect's records and concurrency slots straight.)
 
                 logger.info(f"Cancelling flow {flow_run.name}")
                 subprocess.run(["prefect", "flow-run", "cancel", str(flow_run.id)])
@@ -220,7 +231,16 @@ async def fail_stuck_flows(logger, session, pipeline_config, state, update_prefe
               .where(Flow.launch_time < cutoff)
               ).all()
 
-    # Next we try to kill any of the stuck flows that are still running, so they release any DB locks they hold.
+    # Next we try to kill any of the stuck flows that are still running, so they release any DB locks they hold. Those
+    # running on this machine can be terminated directly, and the health monitor on each other machine will terminate
+    # its own once they're marked timed out. Speedster's flows are left for speedster to notice.
+    if len(stucks):
+        grace_seconds = pipeline_config['control'].get('health_monitor', {}).get('termination_grace_seconds', 10)
+        terminated = terminate_flow_processes(session, [stuck.flow_id for stuck in stucks], socket.gethostname(),
+                                              grace_seconds)
+        session.commit()
+        if terminated:
+            logger.info(f"Terminated the processes of {len(terminated)} stuck flows")
     # we clean the prefect database even if our database returned no stucks because they might have somehow gotten
     # out of sync. we want to clean that up too
     if update_prefect:
@@ -242,3 +262,94 @@ async def fail_stuck_flows(logger, session, pipeline_config, state, update_prefe
         session.commit()
         logger.info(f"Failed {len(stucks)} flows that have been "
                     f"in a '{state}' state for {amount_of_patience} minutes from punchpipe database")
+
+
+@task(cache_policy=NO_CACHE)
+def archive_old_flows(logger, session, pipeline_config):
+    """Moves old completed and failed flows out of the flows table, so the queries on active flows stay fast"""
+    cleaner_config = pipeline_config['control']['cleaner']
+    archive_after_days = cleaner_config.get('archive_flows_after_days', -1)
+    if archive_after_days < 0:
+        logger.warning("There is no archive_flows_after_days option in the config, so ending without archiving.")
+        return
+    batch_size = cleaner_config.get('archive_batch_size', 10_000)
+    max_batches = cleaner_config.get('archive_max_batches_per_run', 10)
+
+    cutoff = datetime.now() - timedelta(days=archive_after_days)
+    columns = [column.name for column in Flow.__table__.columns]
+    n_archived = 0
+    # Each batch is its own transaction, so we never hold locks on a large chunk of the flows table, and we cap the
+    # number of batches so that working through a large backlog is spread over several cleaner runs.
+    for _ in range(max_batches):
+        flow_ids = session.execute(select(Flow.flow_id)
+                                   .where(Flow.state.in_(["completed", "failed"]))
+                                   # By when they finished, since flows can wait a long time to be launched, and
+                                   # recently finished flows are still read from the flows table
+                                   .where(Flow.end_time < cutoff)
+                                   .limit(batch_size)).scalars().all()
+        if not flow_ids:
+            break
+        session.execute(insert(FlowArchive).from_select(
+            columns, select(*[Flow.__table__.c[column] for column in columns]).where(Flow.flow_id.in_(flow_ids))))
+        session.execute(delete(Flow).where(Flow.flow_id.in_(flow_ids)))
+        session.commit()
+        n_archived += len(flow_ids)
+        if len(flow_ids) < batch_size:
+            break
+    if n_archived:
+        logger.info(f"Archived {n_archived} flows from before {cutoff}")
+
+
+def get_stale_engineering_criterion(session, packet_table, cutoff: datetime):
+    """Selects the engineering packets from before the cutoff, except the most recent one for each spacecraft
+
+    A spacecraft's engineering state only changes when it sends a new packet, so however old its latest packet is, an
+    image after the cutoff may still need it.
+    """
+    latest = session.execute(select(packet_table.spacecraft_id, func.max(packet_table.timestamp))
+                             .where(packet_table.timestamp < cutoff)
+                             .group_by(packet_table.spacecraft_id)).all()
+    return or_(false(), *(and_(packet_table.spacecraft_id == spacecraft_id, packet_table.timestamp < latest_timestamp)
+                          for spacecraft_id, latest_timestamp in latest))
+
+
+@task(cache_policy=NO_CACHE)
+def archive_old_packets(logger, session, pipeline_config):
+    """Moves packets that level 0 no longer needs out of the packet tables, so image formation queries stay fast"""
+    cleaner_config = pipeline_config['control']['cleaner']
+    margin_days = cleaner_config.get('archive_packets_margin_days', -1)
+    if margin_days < 0:
+        logger.warning("There is no archive_packets_margin_days option in the config, so ending without archiving.")
+        return
+    batch_size = cleaner_config.get('archive_batch_size', 10_000)
+    max_batches = cleaner_config.get('archive_max_batches_per_run', 10)
+
+    # Level 0 only tries to form images from science packets inside the retry window, so used packets from before it
+    # are finished with. Engineering packets aren't marked as used, and level 0 looks back from each image for the
+    # most recent one, so we keep an extra margin of those.
+    retry_days = float(pipeline_config["flows"]["level0"]["options"].get("retry_days", 3.0))
+    retry_window_start = datetime.now(UTC) - timedelta(days=retry_days)
+    for packet_name, packet_table in PACKETNAME2SQL.items():
+        archive_table = PACKETNAME2ARCHIVE[packet_name]
+        if packet_table is SCI_XFI:
+            criteria = [SCI_XFI.is_used, SCI_XFI.timestamp < retry_window_start]
+        else:
+            criteria = [get_stale_engineering_criterion(session, packet_table,
+                                                        retry_window_start - timedelta(days=margin_days))]
+        columns = [column.name for column in archive_table.columns]
+
+        n_archived = 0
+        for _ in range(max_batches):
+            ids = session.execute(select(packet_table.id).where(*criteria).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            session.execute(insert(archive_table).from_select(
+                columns, select(*[packet_table.__table__.c[column] for column in columns])
+                .where(packet_table.id.in_(ids))))
+            session.execute(delete(packet_table).where(packet_table.id.in_(ids)))
+            session.commit()
+            n_archived += len(ids)
+            if len(ids) < batch_size:
+                break
+        if n_archived:
+            logger.info(f"Archived {n_archived} {packet_name} packets")
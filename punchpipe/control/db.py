@@ -1,26 +1,203 @@
 import os
-
-from sqlalchemy import TEXT, Boolean, Column, Float, Index, Integer, String
+from itertools import product
+from collections import defaultdict
+
+from sqlalchemy import (
+    DDL,
+    TEXT,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    MetaData,
+    SmallInteger,
+    String,
+    Table,
+    Text,
+    TypeDecorator,
+    event,
+    inspect,
+    select,
+    type_coerce,
+)
 from sqlalchemy.dialects.mysql import DATETIME, MEDIUMTEXT
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, attributes, column_property, declarative_base
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import FunctionElement
 
 Base = declarative_base()
 
+# The schema is written for MariaDB, but is kept portable so the pipeline (and its benchmarks) can also run against
+# SQLite. These types use the MariaDB-specific column types on MariaDB and the nearest generic type elsewhere.
+PreciseDateTime = DateTime().with_variant(DATETIME(fsp=6), "mysql", "mariadb")
+LongText = Text().with_variant(MEDIUMTEXT, "mysql", "mariadb")
+
+
+class seconds_between(FunctionElement):
+    """The number of seconds from `start` to `end` (two datetime expressions), as a float, in any supported dialect"""
+    type = Float()
+    inherit_cache = True
+    name = "seconds_between"
+
+
+@compiles(seconds_between)
+def _seconds_between_default(element, compiler, **kwargs):
+    start, end = list(element.clauses)
+    return f"TIMESTAMPDIFF(MICROSECOND, {compiler.process(start, **kwargs)}, {compiler.process(end, **kwargs)}) / 1e6"
+
+
+@compiles(seconds_between, "sqlite")
+def _seconds_between_sqlite(element, compiler, **kwargs):
+    start, end = list(element.clauses)
+    return (f"((julianday({compiler.process(end, **kwargs)}) - julianday({compiler.process(start, **kwargs)}))"
+            " * 86400.0)")
+
+# Every state a file can be in. In the compact schema, a file's state is stored as its index in this list, so new states
+# must only ever be added at the end.
+FILE_STATES = ("planned", "creating", "created", "progressed", "failed", "unreported", "quickpunched", "levelh",
+               "waiting", "impossible", "timed_out", "revivable", "upgraded")
+
+# The compact schema stores the files table's state and type columns as small integers, which makes its rows and (more
+# importantly) its composite indices much smaller. It has to be chosen before the tables are created, and existing
+# databases can be converted with scripts/compact_files_table.py. A compact database records that it is in the
+# file_code_lookup table, and every engine checks it matches this setting.
+COMPACT_FILES_SCHEMA = os.environ.get("PUNCHPIPE_COMPACT_FILES", "0").lower() in ("1", "true", "yes")
+FILES_SCHEMA_MARKER = {"column_name": "files_schema", "code": 0, "value": "compact"}
+
+
+class FileCodeLookup(Base):
+    """Maps the integer codes used by the compact files schema back to strings, for anyone writing SQL by hand"""
+    __tablename__ = "file_code_lookup"
+    column_name = Column(String(16), primary_key=True)
+    code = Column(SmallInteger, primary_key=True)
+    value = Column(String(64), nullable=False)
+
+
+class CodedString(TypeDecorator):
+    """A short string column that's stored as a small integer
+
+    If `values` is given, each string is stored as its index in `values`. Otherwise, the (ASCII) characters of the string
+    are packed into the integer, which keeps strings with a common prefix next to each other in the index.
+    """
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, length: int = 0, values: tuple[str, ...] | None = None):
+        super().__init__()
+        self.length = length
+        self.values = values
+
+    def encode(self, value: str) -> int:
+        if self.values is not None:
+            return self.values.index(value)
+        if len(value) > self.length:
+            raise ValueError(f"'{value}' is longer than {self.length} characters")
+        code = 0
+        for i in range(self.length):
+            code = code * 256 + (ord(value[i]) if i < len(value) else 0)
+        return code
+
+    def decode(self, code: int) -> str:
+        if self.values is not None:
+            return self.values[code]
+        characters = []
+        for _ in range(self.length):
+            code, character = divmod(code, 256)
+            if character:
+                characters.append(chr(character))
+        return "".join(reversed(characters))
+
+    def all_values(self) -> list[str]:
+        """Every string this column can hold (for the packed encoding, every string of printable ASCII characters)"""
+        if self.values is not None:
+            return list(self.values)
+        printable = [chr(c) for c in range(32, 127)]
+        return ["".join(characters) for n in range(self.length + 1) for characters in product(printable, repeat=n)]
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else self.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.decode(value)
+
+    class comparator_factory(TypeDecorator.Comparator):
+        # Pattern matching doesn't mean anything for the stored integers, so we translate it to something that does
+        def operate(self, op, *other, **kwargs):
+            if op is operators.startswith_op and self.type.values is None:
+                prefix = other[0]
+                low = self.type.encode(prefix)
+                high = low + 256 ** (self.type.length - len(prefix)) - 1
+                return type_coerce(self.expr, SmallInteger).between(low, high)
+            patterns = {operators.startswith_op: "{}%", operators.endswith_op: "%{}",
+                        operators.contains_op: "%{}%", operators.like_op: "{}"}
+            if op in patterns:
+                return self.expr.in_(select(FileCodeLookup.code)
+                                     .where(FileCodeLookup.column_name == self.expr.key)
+                                     .where(FileCodeLookup.value.like(patterns[op].format(other[0]))))
+            return super().operate(op, *other, **kwargs)
+
+
+if COMPACT_FILES_SCHEMA:
+    _CODED_COLUMNS = {"level": CodedString(1), "file_type": CodedString(2), "observatory": CodedString(1),
+                      "polarization": CodedString(2), "state": CodedString(values=FILE_STATES)}
+else:
+    _CODED_COLUMNS = {"level": String(1), "file_type": String(2), "observatory": String(1),
+                      "polarization": String(2), "state": String(64)}
+
+
+def file_code_lookup_rows() -> list[dict]:
+    """Every row file_code_lookup should hold for this schema, with the compact schema's marker last"""
+    rows = [{"column_name": column_name, "code": column_type.encode(value), "value": value}
+            for column_name, column_type in _CODED_COLUMNS.items() if isinstance(column_type, CodedString)
+            for value in column_type.all_values()]
+    if COMPACT_FILES_SCHEMA:
+        rows.append(FILES_SCHEMA_MARKER)
+    return rows
+
+
+@event.listens_for(FileCodeLookup.__table__, "after_create")
+def _populate_file_code_lookup(target, connection, **kwargs):
+    if rows := file_code_lookup_rows():
+        connection.execute(target.insert(), rows)
+
+
+def check_files_schema(connection) -> None:
+    """Raises if the database's files table uses a different schema than this process expects
+
+    A process expecting the wrong schema would still run, but its filters on the coded columns would quietly match
+    nothing. Databases whose tables haven't been created yet pass.
+    """
+    if not inspect(connection).has_table(FileCodeLookup.__tablename__):
+        return
+    marker = connection.execute(select(FileCodeLookup.value)
+                                .where(FileCodeLookup.column_name == FILES_SCHEMA_MARKER["column_name"])
+                                .where(FileCodeLookup.code == FILES_SCHEMA_MARKER["code"])).scalar()
+    is_compact = marker == FILES_SCHEMA_MARKER["value"]
+    if is_compact and not COMPACT_FILES_SCHEMA:
+        raise RuntimeError("The database's files table uses the compact schema. Set PUNCHPIPE_COMPACT_FILES=1.")
+    if COMPACT_FILES_SCHEMA and not is_compact:
+        raise RuntimeError("PUNCHPIPE_COMPACT_FILES is set, but the database's files table doesn't use the compact "
+                           "schema. Convert it with scripts/compact_files_table.py, or unset PUNCHPIPE_COMPACT_FILES.")
+
 
 class File(Base):
     __tablename__ = "files"
     file_id = Column(Integer, primary_key=True)
-    level = Column(String(1), nullable=False)
-    file_type = Column(String(2), nullable=False)
-    observatory = Column(String(1), nullable=False)
+    level = Column(_CODED_COLUMNS["level"], nullable=False)
+    file_type = Column(_CODED_COLUMNS["file_type"], nullable=False)
+    observatory = Column(_CODED_COLUMNS["observatory"], nullable=False)
     file_version = Column(String(16), nullable=False)
     software_version = Column(String(35), nullable=False)
-    date_created = Column(DATETIME(fsp=6), nullable=True)
-    date_obs = Column(DATETIME(fsp=6), nullable=False)
-    date_beg = Column(DATETIME(fsp=6), nullable=True)
-    date_end = Column(DATETIME(fsp=6), nullable=True)
-    polarization = Column(String(2), nullable=True)
-    state = Column(String(64), nullable=False)
+    date_created = Column(PreciseDateTime, nullable=True)
+    date_obs = Column(PreciseDateTime, nullable=False)
+    date_beg = Column(PreciseDateTime, nullable=True)
+    date_end = Column(PreciseDateTime, nullable=True)
+    polarization = Column(_CODED_COLUMNS["polarization"], nullable=True)
+    # The old state is loaded before it's changed, so the change can be journaled for the file status summary
+    state = column_property(Column(_CODED_COLUMNS["state"], nullable=False), active_history=True)
     outlier = Column(Boolean, nullable=False, default=False)
     bad_packets = Column(Boolean, nullable=False, default=False)
     processing_flow = Column(Integer, nullable=True)
@@ -68,6 +245,7 @@ Index("construct_background", File.level, File.observatory, File.outlier, File.d
 Index("get_cal_file", File.file_type, File.observatory, File.date_obs, File.state)
 Index("CNN", File.file_type, File.observatory, File.level, File.state, File.outlier)
 Index("processing_flow_index", File.processing_flow)
+Index("files_created", File.date_created)
 Index("level0_uniqueness",
       File.level, File.polarization, File.file_type,
       File.observatory, File.file_version, File.date_obs,
@@ -81,12 +259,12 @@ class Flow(Base):
     flow_run_name = Column(String(64), nullable=True)
     flow_run_id = Column(String(36), nullable=True)
     state = Column(String(16), nullable=False)
-    creation_time = Column(DATETIME(fsp=6), nullable=False)
-    launch_time = Column(DATETIME(fsp=6), nullable=True)
-    start_time = Column(DATETIME(fsp=6), nullable=True)
-    end_time = Column(DATETIME(fsp=6), nullable=True)
+    creation_time = Column(PreciseDateTime, nullable=False)
+    launch_time = Column(PreciseDateTime, nullable=True)
+    start_time = Column(PreciseDateTime, nullable=True)
+    end_time = Column(PreciseDateTime, nullable=True)
     priority = Column(Integer, nullable=False)
-    call_data = Column(MEDIUMTEXT, nullable=True)
+    call_data = Column(LongText, nullable=True)
     is_backprocessing = Column(Boolean, nullable=False, default=False)
 
     def __repr__(self):
@@ -97,6 +275,99 @@ Index("flow_stats", Flow.end_time, Flow.flow_type, Flow.state)
 Index("flow_cards", Flow.start_time, Flow.flow_level, Flow.flow_type)
 Index("escalate_flows", Flow.state, Flow.flow_type, Flow.priority, Flow.creation_time)
 
+
+class FlowArchive(Base):
+    """Completed and failed flows that are old enough to be moved out of the `flows` table
+
+    The columns mirror `Flow`, and flows keep their original IDs, so `File.processing_flow` still points at the right
+    row. The `flows_all` view (mapped as `FlowAll`) combines both tables for historical queries.
+    """
+    __tablename__ = "flows_archive"
+    flow_id = Column(Integer, primary_key=True, autoincrement=False)
+    flow_level = Column(String(1), nullable=False)
+    flow_type = Column(String(64), nullable=False)
+    flow_run_name = Column(String(64), nullable=True)
+    flow_run_id = Column(String(36), nullable=True)
+    state = Column(String(16), nullable=False)
+    creation_time = Column(PreciseDateTime, nullable=False)
+    launch_time = Column(PreciseDateTime, nullable=True)
+    start_time = Column(PreciseDateTime, nullable=True)
+    end_time = Column(PreciseDateTime, nullable=True)
+    priority = Column(Integer, nullable=False)
+    call_data = Column(LongText, nullable=True)
+    is_backprocessing = Column(Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f"FlowArchive(id={self.flow_id!r})"
+
+
+Index("archive_flow_stats", FlowArchive.end_time, FlowArchive.flow_type, FlowArchive.state)
+
+_flow_columns = ", ".join(column.name for column in Flow.__table__.columns)
+_flows_all_select = f"SELECT {_flow_columns} FROM flows UNION ALL SELECT {_flow_columns} FROM flows_archive"
+# MySQL has no CREATE VIEW IF NOT EXISTS, and SQLite has no CREATE OR REPLACE VIEW
+event.listen(FlowArchive.__table__, "after_create",
+             DDL(f"CREATE OR REPLACE VIEW flows_all AS {_flows_all_select}").execute_if(dialect=("mysql", "mariadb")))
+event.listen(FlowArchive.__table__, "after_create",
+             DDL(f"CREATE VIEW IF NOT EXISTS flows_all AS {_flows_all_select}").execute_if(dialect="sqlite"))
+event.listen(FlowArchive.__table__, "before_drop", DDL("DROP VIEW IF EXISTS flows_all"))
+
+
+class FlowAll(Base):
+    """The `flows_all` view, for reading flows whether or not they've been archived, e.g. when joining old files to the
+    flows that made them. It's read-only, and its table isn't in `Base.metadata`, since the view is created with
+    `flows_archive`.
+    """
+    __table__ = Table("flows_all", MetaData(),
+                      *(Column(column.name, column.type, primary_key=column.primary_key)
+                        for column in Flow.__table__.columns))
+
+    def __repr__(self):
+        return f"FlowAll(id={self.flow_id!r})"
+
+
+class ModelGrid(Base):
+    """Tracks how far a regularly-spaced grid of model files has been materialized as placeholder files"""
+    __tablename__ = "model_grids"
+    grid_id = Column(Integer, primary_key=True)
+    flow_type = Column(String(64), nullable=False, unique=True)
+    t0 = Column(PreciseDateTime, nullable=False)
+    spacing_seconds = Column(Float, nullable=False)
+    model_keys = Column(String(256), nullable=False)
+    last_slot = Column(PreciseDateTime, nullable=True)
+
+    def __repr__(self):
+        return f"ModelGrid(flow_type={self.flow_type!r}, last_slot={self.last_slot!r})"
+
+
+class ModelQueueEntry(Base):
+    """One 'waiting' placeholder model file that a background-model scheduler still has to try to produce"""
+    __tablename__ = "model_queue"
+    entry_id = Column(Integer, primary_key=True)
+    flow_type = Column(String(64), nullable=False)
+    file_id = Column(Integer, nullable=False, unique=True)
+    date_obs = Column(PreciseDateTime, nullable=False)
+
+
+Index("model_queue_order", ModelQueueEntry.flow_type, ModelQueueEntry.date_obs)
+
+class QueryProfile(Base):
+    """Aggregate timings for one kind of SQL statement over one flow run, recorded when query profiling is on"""
+    __tablename__ = "query_profiles"
+    profile_id = Column(Integer, primary_key=True)
+    recorded_at = Column(PreciseDateTime, nullable=False)
+    flow_type = Column(String(64), nullable=True)
+    flow_run_name = Column(String(64), nullable=True)
+    fingerprint = Column(TEXT, nullable=False)
+    count = Column(Integer, nullable=False)
+    total_time = Column(Float, nullable=False)
+    max_time = Column(Float, nullable=False)
+    rows = Column(Integer, nullable=False)
+
+
+Index("query_profiles_recent", QueryProfile.recorded_at)
+
+
 class FileRelationship(Base):
     __tablename__ = "relationships"
     relationship_id = Column(Integer, primary_key=True)
@@ -112,12 +383,12 @@ class TLMFiles(Base):
     path = Column(String(128), nullable=False)
     successful = Column(Boolean, nullable=False)
     num_attempts = Column(Integer, nullable=False)
-    last_attempt = Column(DATETIME(fsp=6), nullable=True)
+    last_attempt = Column(PreciseDateTime, nullable=True)
 
 class Health(Base):
     __tablename__ = "health"
     health_id = Column(Integer, primary_key=True)
-    datetime = Column(DATETIME(fsp=6), nullable=False)
+    datetime = Column(PreciseDateTime, nullable=False)
     cpu_usage = Column(Float, nullable=False)
     memory_usage = Column(Float, nullable=False)
     memory_percentage = Column(Float, nullable=False)
@@ -126,10 +397,225 @@ class Health(Base):
     num_pids = Column(Integer, nullable=False)
 
 
+class FlowProcess(Base):
+    """The process running each flow, registered by the processor for as long as the flow runs"""
+    __tablename__ = "flow_processes"
+    flow_id = Column(Integer, primary_key=True, autoincrement=False)
+    flow_type = Column(String(64), nullable=False)
+    hostname = Column(String(255), nullable=False)
+    pid = Column(Integer, nullable=False)
+    # As reported by psutil, in seconds since the epoch. Together with the PID, this identifies the process even if the
+    # PID is later reused.
+    process_start_time = Column(Float, nullable=False)
+    registered_at = Column(PreciseDateTime, nullable=False)
+    # The process tree's cumulative CPU time when the flow started, so the flow's own CPU time can be worked out when it
+    # finishes
+    cpu_time_at_start = Column(Float, nullable=True)
+
+
+Index("flow_processes_host", FlowProcess.hostname, FlowProcess.pid)
+
+
+class ResourceSample(Base):
+    """One reading of the resources used by a flow's process tree, or by the whole machine
+
+    The CPU time and IO counts are cumulative, so usage over a period is the difference between two samples. Samples are
+    only kept briefly, until they're rolled up into `ResourceUsage`.
+    """
+    __tablename__ = "resource_samples"
+    sample_id = Column(Integer, primary_key=True)
+    sampled_at = Column(PreciseDateTime, nullable=False)
+    hostname = Column(String(255), nullable=False)
+    flow_type = Column(String(64), nullable=False)
+    flow_id = Column(Integer, nullable=True)
+    pid = Column(Integer, nullable=True)
+    rss = Column(Float, nullable=False)
+    cpu_time = Column(Float, nullable=False)
+    read_bytes = Column(Float, nullable=False)
+    write_bytes = Column(Float, nullable=False)
+
+
+Index("resource_samples_time", ResourceSample.sampled_at)
+Index("resource_samples_series", ResourceSample.hostname, ResourceSample.pid, ResourceSample.sampled_at)
+
+
+class ResourceUsage(Base):
+    """Resources used by each flow type (or the whole machine) over each minute or hour"""
+    __tablename__ = "resource_usage"
+    period_seconds = Column(Integer, primary_key=True, autoincrement=False)
+    period_start = Column(PreciseDateTime, primary_key=True)
+    hostname = Column(String(255), primary_key=True)
+    flow_type = Column(String(64), primary_key=True)
+    n_samples = Column(Integer, nullable=False)
+    n_processes = Column(Integer, nullable=False)
+    # Of the total RSS of all the processes, in bytes, across the sampling times
+    mean_rss = Column(Float, nullable=False)
+    max_rss = Column(Float, nullable=False)
+    # Used during the period
+    cpu_seconds = Column(Float, nullable=False)
+    read_bytes = Column(Float, nullable=False)
+    write_bytes = Column(Float, nullable=False)
+
+
+class FlowResources(Base):
+    """The resources each flow used, recorded by its process as it finishes
+
+    Unlike the sampled `ResourceUsage`, this covers every flow, including those that finish between samples. A batch of
+    flows shares one process, so each is recorded with an equal share of it.
+    """
+    __tablename__ = "flow_resources"
+    flow_id = Column(Integer, primary_key=True, autoincrement=False)
+    flow_type = Column(String(64), nullable=False)
+    finished_at = Column(PreciseDateTime, nullable=False)
+    cpu_seconds = Column(Float, nullable=False)
+    # Of the process tree as the flow finished, in bytes
+    rss = Column(Float, nullable=False)
+
+
+Index("flow_resources_recent", FlowResources.flow_type, FlowResources.finished_at)
+
+
+class FlowWeight(Base):
+    """Launch weights learned from each flow type's run times and resource usage, with the measurements behind them"""
+    __tablename__ = "flow_weights"
+    flow_type = Column(String(64), primary_key=True)
+    computed_at = Column(PreciseDateTime, nullable=False)
+    n_flows = Column(Integer, nullable=False)
+    # Of completed flows, in seconds
+    duration_p50 = Column(Float, nullable=False)
+    duration_p90 = Column(Float, nullable=False)
+    duration_p99 = Column(Float, nullable=False)
+    cpu_seconds = Column(Float, nullable=False)
+    # The mean number of cores in use while a flow runs, and one flow's share of its process's largest resident memory,
+    # in bytes
+    cores = Column(Float, nullable=False)
+    peak_rss = Column(Float, nullable=False)
+    weight = Column(Float, nullable=False)
+
+
+class LaunchCapacity(Base):
+    """Each decision of the launcher's adaptive capacity controller, with the readings it was based on"""
+    __tablename__ = "launch_capacity"
+    decision_id = Column(Integer, primary_key=True)
+    decided_at = Column(PreciseDateTime, nullable=False)
+    hostname = Column(String(255), nullable=False)
+    # The maximum running weight before and after the decision
+    previous_weight = Column(Float, nullable=True)
+    max_weight_running = Column(Float, nullable=False)
+    weight_running = Column(Float, nullable=False)
+    # As percentages
+    cpu_percentage = Column(Float, nullable=False)
+    memory_percentage = Column(Float, nullable=False)
+    iowait_percentage = Column(Float, nullable=False)
+    action = Column(String(16), nullable=False)
+    reason = Column(String(255), nullable=False)
+
+
+Index("launch_capacity_recent", LaunchCapacity.decided_at)
+
+
+# These summary tables are maintained by the `summarizer` control flow, so the monitor and watchdog can read
+# precomputed numbers instead of aggregating the flows and files tables themselves.
+class FlowStatusSummary(Base):
+    """How many flows are in each state: all planned and launched flows, and others if they started in the last day"""
+    __tablename__ = "flow_status_summary"
+    flow_level = Column(String(1), primary_key=True)
+    flow_type = Column(String(64), primary_key=True)
+    state = Column(String(16), primary_key=True)
+    count = Column(Integer, nullable=False)
+    updated_at = Column(PreciseDateTime, nullable=False)
+
+
+class FileStatusSummary(Base):
+    """How many files are in each state"""
+    __tablename__ = "file_status_summary"
+    level = Column(String(1), primary_key=True)
+    file_type = Column(String(2), primary_key=True)
+    state = Column(String(64), primary_key=True)
+    count = Column(Integer, nullable=False)
+    updated_at = Column(PreciseDateTime, nullable=False)
+
+
+class FileStateChange(Base):
+    """A journal of changes to the number of files in each state, waiting to be applied to `FileStatusSummary`
+
+    Rows are written as files are added, deleted or change state through the ORM, in the same transaction.
+    """
+    __tablename__ = "file_state_changes"
+    change_id = Column(Integer, primary_key=True)
+    level = Column(String(1), nullable=False)
+    file_type = Column(String(2), nullable=False)
+    state = Column(String(64), nullable=False)
+    delta = Column(Integer, nullable=False)
+
+
+_FILE_GROUP = ("level", "file_type", "state")
+
+
+def _committed_file_group(file: File) -> tuple:
+    """The level, type and state a file had in the database before this flush, with None for any that aren't loaded"""
+    group = []
+    for name in _FILE_GROUP:
+        # Without loading anything, since a deleted file's row is already gone
+        history = attributes.get_history(file, name, passive=attributes.PASSIVE_NO_INITIALIZE)
+        values = history.deleted or history.unchanged or history.added
+        group.append(values[0] if values else None)
+    return tuple(group)
+
+
+@event.listens_for(Session, "after_flush")
+def _journal_file_state_changes(session, flush_context):
+    """Journals how each flush changed the number of files in each state. Changes made outside the ORM's unit of work
+    (bulk inserts or updates, or SQL written by hand) aren't seen here, and are picked up by the summarizer's periodic
+    full recount instead."""
+    deltas = defaultdict(int)
+    for file in session.new:
+        if isinstance(file, File):
+            deltas[tuple(getattr(file, name) for name in _FILE_GROUP)] += 1
+    for file in session.dirty:
+        if isinstance(file, File) and any(attributes.get_history(file, name).has_changes() for name in _FILE_GROUP):
+            deltas[_committed_file_group(file)] -= 1
+            deltas[tuple(getattr(file, name) for name in _FILE_GROUP)] += 1
+    for file in session.deleted:
+        if isinstance(file, File):
+            deltas[_committed_file_group(file)] -= 1
+    rows = [dict(zip(_FILE_GROUP, group), delta=delta) for group, delta in deltas.items()
+            if delta and None not in group]
+    if rows:
+        session.connection().execute(FileStateChange.__table__.insert(), rows)
+
+
+class SummaryProgress(Base):
+    """How far each of the summarizer's incremental jobs has got"""
+    __tablename__ = "summary_progress"
+    job = Column(String(32), primary_key=True)
+    done_until = Column(PreciseDateTime, nullable=False)
+
+
+class FlowHourlyStats(Base):
+    """How many flows of each type finished in each state during each hour, and how long they took in total"""
+    __tablename__ = "flow_hourly_stats"
+    hour = Column(PreciseDateTime, primary_key=True)
+    flow_type = Column(String(64), primary_key=True)
+    state = Column(String(16), primary_key=True)
+    count = Column(Integer, nullable=False)
+    total_duration = Column(Float, nullable=False)
+
+
+class FileHourlyCounts(Base):
+    """How many files of each product were created during each hour"""
+    __tablename__ = "file_hourly_counts"
+    hour = Column(PreciseDateTime, primary_key=True)
+    level = Column(String(1), primary_key=True)
+    file_type = Column(String(2), primary_key=True)
+    observatory = Column(String(1), primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
 class PacketHistory(Base):
     __tablename__ = "packet_history"
     id = Column(Integer, primary_key=True)
-    datetime = Column(DATETIME(fsp=6), nullable=False)
+    datetime = Column(PreciseDateTime, nullable=False)
     num_images_succeeded = Column(Integer, nullable=False)
     num_images_failed = Column(Integer, nullable=False)
 
@@ -141,16 +627,18 @@ class SCI_XFI(Base):
     packet_index = Column(Integer, nullable=False)
     ccsds_sequence_count = Column(Integer, nullable=False)
     ccsds_packet_length = Column(Integer, nullable=False)
-    timestamp = Column(DATETIME(fsp=6), nullable=False, index=True)
+    timestamp = Column(PreciseDateTime, nullable=False, index=True)
     is_used = Column(Boolean, nullable=False)
     num_attempts = Column(Integer, nullable=True)
-    last_attempt = Column(DATETIME(fsp=6), nullable=True)
+    last_attempt = Column(PreciseDateTime, nullable=True)
     last_skip_reason = Column(TEXT, nullable=True)
     flash_block = Column(Integer, nullable=False)
     compression_settings = Column(Integer, nullable=False)
     acquisition_settings = Column(Integer, nullable=False)
     packet_group = Column(Integer, nullable=False)
 
+Index("unused_packets", SCI_XFI.is_used, SCI_XFI.spacecraft_id, SCI_XFI.timestamp)
+
 class ENG_CEB(Base):
     __tablename__ = "eng_ceb"
     id = Column(Integer, primary_key=True)
@@ -159,7 +647,7 @@ class ENG_CEB(Base):
     packet_index = Column(Integer, nullable=False)
     ccsds_sequence_count = Column(Integer, nullable=False)
     ccsds_packet_length = Column(Integer, nullable=False)
-    timestamp = Column(DATETIME(fsp=6), nullable=False, index=True)
+    timestamp = Column(PreciseDateTime, nullable=False, index=True)
 
 class ENG_PFW(Base):
     __tablename__ = "eng_pfw"
@@ -169,7 +657,7 @@ class ENG_PFW(Base):
     packet_index = Column(Integer, nullable=False)
     ccsds_sequence_count = Column(Integer, nullable=False)
     ccsds_packet_length = Column(Integer, nullable=False)
-    timestamp = Column(DATETIME(fsp=6), nullable=False, index=True)
+    timestamp = Column(PreciseDateTime, nullable=False, index=True)
 
 class ENG_XACT(Base):
     __tablename__ = "eng_xact"
@@ -179,7 +667,7 @@ class ENG_XACT(Base):
     packet_index = Column(Integer, nullable=False)
     ccsds_sequence_count = Column(Integer, nullable=False)
     ccsds_packet_length = Column(Integer, nullable=False)
-    timestamp = Column(DATETIME(fsp=6), nullable=False, index=True)
+    timestamp = Column(PreciseDateTime, nullable=False, index=True)
 
 class ENG_LZ(Base):
     __tablename__ = "eng_lz"
@@ -189,7 +677,7 @@ class ENG_LZ(Base):
     packet_index = Column(Integer, nullable=False)
     ccsds_sequence_count = Column(Integer, nullable=False)
     ccsds_packet_length = Column(Integer, nullable=False)
-    timestamp = Column(DATETIME(fsp=6), nullable=False, index=True)
+    timestamp = Column(PreciseDateTime, nullable=False, index=True)
 
 class ENG_LED(Base):
     __tablename__ = "eng_led"
@@ -199,9 +687,9 @@ class ENG_LED(Base):
     packet_index = Column(Integer, nullable=False)
     ccsds_sequence_count = Column(Integer, nullable=False)
     ccsds_packet_length = Column(Integer, nullable=False)
-    timestamp = Column(DATETIME(fsp=6), nullable=False, index=True)
-    led_start_time = Column(DATETIME(fsp=6), nullable=False, index=True)
-    led_end_time = Column(DATETIME(fsp=6), nullable=False, index=True)
+    timestamp = Column(PreciseDateTime, nullable=False, index=True)
+    led_start_time = Column(PreciseDateTime, nullable=False, index=True)
+    led_end_time = Column(PreciseDateTime, nullable=False, index=True)
 
 PACKETNAME2SQL = {'SCI_XFI': SCI_XFI,
                   'ENG_CEB': ENG_CEB,
@@ -210,6 +698,18 @@ PACKETNAME2SQL = {'SCI_XFI': SCI_XFI,
                   'ENG_LED': ENG_LED,
                   "ENG_LZ": ENG_LZ}
 
+
+def _make_packet_archive_table(packet_table):
+    """Makes a table with the same columns as a packet table, to hold packets we're done with"""
+    columns = [Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                      index=column.index, autoincrement=False)
+               for column in packet_table.__table__.columns]
+    return Table(f"{packet_table.__tablename__}_archive", Base.metadata, *columns)
+
+
+# Packets move here once image formation no longer needs them, so the tables level 0 queries stay small
+PACKETNAME2ARCHIVE = {name: _make_packet_archive_table(table) for name, table in PACKETNAME2SQL.items()}
+
 def get_closest_file(f_target: File, f_others: list[File]) -> File:
     return min(f_others, key=lambda o: abs((f_target.date_obs - o.date_obs).total_seconds()))
 
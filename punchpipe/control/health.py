@@ -1,34 +1,401 @@
-from datetime import datetime
+import os
+import socket
+from datetime import datetime, timedelta
+from collections import defaultdict
 
+import httpx
 import psutil
-from prefect import flow
+from prefect import flow, get_run_logger, task
+from prefect.cache_policies import NO_CACHE
+from prefect.client.orchestration import get_client
+from prefect.client.schemas.filters import FlowRunFilter, FlowRunFilterId
+from sqlalchemy import delete, func, insert, select, update
 
-from punchpipe.control.db import Health
+from punchpipe.control.db import Flow, FlowProcess, FlowResources, Health, LaunchCapacity, ResourceSample, ResourceUsage
 from punchpipe.control.util import get_database_session, load_pipeline_configuration
 
+# The flow_type under which whole-machine samples are recorded
+MACHINE = "machine"
+MINUTE, HOUR = 60, 3600
+# How far back to look for the previous sample of each process, when working out how much it used since then
+PREVIOUS_SAMPLE_WINDOW = timedelta(minutes=5)
+# How long a finished flow's process can stay registered before it's considered orphaned
+FINISHING_GRACE_PERIOD = timedelta(minutes=5)
+# Speedster names the flows it claims after itself. Their processes are its pool's long-lived workers, which are left
+# alone, since the pool would silently drop the flow a killed worker was running.
+SPEEDSTER_RUN_NAME_PREFIX = "speedster"
+
+
+def run_by_speedster(flow_run_name: str | None) -> bool:
+    """Whether a flow with this run name was claimed by speedster"""
+    return flow_run_name is not None and flow_run_name.startswith(SPEEDSTER_RUN_NAME_PREFIX)
+
+
+def register_flow_processes(session, flows) -> None:
+    """Records that this process is running these flows. The caller commits."""
+    process = psutil.Process()
+    hostname = socket.gethostname()
+    now = datetime.now()
+    measurement = measure_process_tree(process)
+    cpu_time_at_start = measurement[1] if measurement is not None else None
+    for flow_entry in flows:
+        session.merge(FlowProcess(flow_id=flow_entry.flow_id, flow_type=flow_entry.flow_type, hostname=hostname,
+                                  pid=process.pid, process_start_time=process.create_time(), registered_at=now,
+                                  cpu_time_at_start=cpu_time_at_start))
+
+
+def unregister_flow_processes(session, flow_ids) -> None:
+    """Records the resources these flows used in this process, and forgets that it's running them"""
+    registrations = session.execute(select(FlowProcess)
+                                    .where(FlowProcess.flow_id.in_(flow_ids))
+                                    .where(FlowProcess.cpu_time_at_start.is_not(None))).scalars().all()
+    measurement = measure_process_tree(psutil.Process())
+    if registrations and measurement is not None:
+        rss, cpu_time, _, _ = measurement
+        now = datetime.now()
+        # A batch of flows runs in one process, so each is charged an equal share of it
+        share = len(registrations)
+        rows = [{"flow_id": registration.flow_id, "flow_type": registration.flow_type, "finished_at": now,
+                 "cpu_seconds": max(cpu_time - registration.cpu_time_at_start, 0) / share, "rss": rss / share}
+                for registration in registrations]
+        # A revived flow is recorded for its last run
+        session.execute(delete(FlowResources).where(FlowResources.flow_id.in_([row["flow_id"] for row in rows])))
+        session.execute(insert(FlowResources), rows)
+    session.execute(delete(FlowProcess).where(FlowProcess.flow_id.in_(flow_ids)))
+    session.commit()
+
+
+def get_registered_process(pid: int, process_start_time: float) -> psutil.Process | None:
+    """Returns the process, if it's still the one that was registered (and not another that has reused the PID)"""
+    try:
+        process = psutil.Process(pid)
+        if abs(process.create_time() - process_start_time) > 1:
+            return None
+        return process
+    except psutil.NoSuchProcess:
+        return None
+
+
+def measure_process_tree(process: psutil.Process) -> tuple[float, float, float, float] | None:
+    """Totals the RSS, cumulative CPU time and cumulative IO of a process and all its descendants"""
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return None
+    rss = cpu_time = read_bytes = write_bytes = 0.0
+    for p in processes:
+        try:
+            with p.oneshot():
+                rss += p.memory_info().rss
+                times = p.cpu_times()
+                # The children_* times cover children that have already finished
+                cpu_time += times.user + times.system + times.children_user + times.children_system
+                try:
+                    io = p.io_counters()
+                    read_bytes += io.read_bytes
+                    write_bytes += io.write_bytes
+                except (AttributeError, psutil.AccessDenied):
+                    pass
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            # Children come and go, and that's fine
+            continue
+    return rss, cpu_time, read_bytes, write_bytes
+
+
+def measure_machine() -> tuple[float, float, float, float]:
+    times = psutil.cpu_times()
+    busy_time = sum(times) - times.idle - getattr(times, "iowait", 0)
+    io = psutil.disk_io_counters()
+    return (psutil.virtual_memory().used, busy_time,
+            io.read_bytes if io else 0.0, io.write_bytes if io else 0.0)
+
+
+@task(cache_policy=NO_CACHE)
+def sample_resources(session, now: datetime, hostname: str) -> int:
+    """Samples the resources used by each running flow on this machine, and by the machine overall"""
+    rows = []
+    rss, cpu_time, read_bytes, write_bytes = measure_machine()
+    rows.append({"sampled_at": now, "hostname": hostname, "flow_type": MACHINE, "flow_id": None, "pid": None,
+                 "rss": rss, "cpu_time": cpu_time, "read_bytes": read_bytes, "write_bytes": write_bytes})
+
+    # A batch of flows shares one process, so its usage is recorded once, under the lowest flow ID
+    processes = {}
+    for registration in session.execute(select(FlowProcess).where(FlowProcess.hostname == hostname)).scalars():
+        key = (registration.pid, registration.process_start_time)
+        if key not in processes or registration.flow_id < processes[key].flow_id:
+            processes[key] = registration
+    for (pid, process_start_time), registration in processes.items():
+        process = get_registered_process(pid, process_start_time)
+        measurement = measure_process_tree(process) if process is not None else None
+        if measurement is None:
+            continue
+        rss, cpu_time, read_bytes, write_bytes = measurement
+        rows.append({"sampled_at": now, "hostname": hostname, "flow_type": registration.flow_type,
+                     "flow_id": registration.flow_id, "pid": pid, "rss": rss, "cpu_time": cpu_time,
+                     "read_bytes": read_bytes, "write_bytes": write_bytes})
+    session.execute(insert(ResourceSample), rows)
+    session.commit()
+    return len(rows) - 1
+
+
+def machine_cpu_percentage(session, now: datetime, hostname: str, busy_time: float) -> float:
+    """CPU usage across all cores since the previous sample, so we don't have to block while psutil measures it"""
+    previous = session.execute(select(ResourceSample.sampled_at, ResourceSample.cpu_time)
+                               .where(ResourceSample.hostname == hostname)
+                               .where(ResourceSample.pid.is_(None))
+                               .where(ResourceSample.sampled_at < now)
+                               .order_by(ResourceSample.sampled_at.desc())
+                               .limit(1)).first()
+    if previous is None or now <= previous.sampled_at:
+        return psutil.cpu_percent(interval=None)
+    elapsed = (now - previous.sampled_at).total_seconds()
+    return 100 * max(busy_time - previous.cpu_time, 0) / (elapsed * psutil.cpu_count())
+
+
+def floor_time(time: datetime, period_seconds: int) -> datetime:
+    if period_seconds == HOUR:
+        return time.replace(minute=0, second=0, microsecond=0)
+    return time.replace(second=0, microsecond=0)
+
+
+def compute_usage(samples, start: datetime) -> dict:
+    """Rolls raw samples up into per-minute usage for each host and flow type
+
+    `samples` must be ordered by series (host, flow type and PID) and then time, and should reach back before `start`,
+    so that usage can be worked out from the previous sample even for the first samples after `start`.
+    """
+    buckets = defaultdict(lambda: {"rss_by_time": defaultdict(float), "pids": set(), "cpu_seconds": 0.0,
+                                   "read_bytes": 0.0, "write_bytes": 0.0})
+    previous = None
+    for sample in samples:
+        series = (sample.hostname, sample.flow_type, sample.pid)
+        same_series = previous is not None and (previous.hostname, previous.flow_type, previous.pid) == series
+        if sample.sampled_at >= start:
+            bucket = buckets[(floor_time(sample.sampled_at, MINUTE), sample.hostname, sample.flow_type)]
+            bucket["rss_by_time"][sample.sampled_at] += sample.rss
+            bucket["pids"].add(sample.pid)
+            if same_series:
+                bucket["cpu_seconds"] += max(sample.cpu_time - previous.cpu_time, 0)
+                bucket["read_bytes"] += max(sample.read_bytes - previous.read_bytes, 0)
+                bucket["write_bytes"] += max(sample.write_bytes - previous.write_bytes, 0)
+            elif sample.pid is not None:
+                # The first time we've seen this flow's process, so it used everything it has so far
+                bucket["cpu_seconds"] += sample.cpu_time
+                bucket["read_bytes"] += sample.read_bytes
+                bucket["write_bytes"] += sample.write_bytes
+        previous = sample
+    return buckets
+
+
+@task(cache_policy=NO_CACHE)
+def rollup_resource_usage(session, now: datetime, default_window: timedelta, margin: timedelta) -> datetime:
+    """Rebuilds the minute and hour usage rollups since the last rollup, less a margin for late samples"""
+    latest = session.execute(select(func.max(ResourceUsage.period_start))
+                             .where(ResourceUsage.period_seconds == MINUTE)).scalar()
+    start = floor_time((latest if latest is not None else now - default_window) - margin, MINUTE)
+
+    samples = session.execute(select(ResourceSample)
+                              .where(ResourceSample.sampled_at >= start - PREVIOUS_SAMPLE_WINDOW)
+                              .order_by(ResourceSample.hostname, ResourceSample.flow_type, ResourceSample.pid,
+                                        ResourceSample.sampled_at)).scalars().all()
+    minute_rows = []
+    for (period_start, hostname, flow_type), bucket in compute_usage(samples, start).items():
+        rss_totals = list(bucket["rss_by_time"].values())
+        minute_rows.append({"period_seconds": MINUTE, "period_start": period_start, "hostname": hostname,
+                            "flow_type": flow_type, "n_samples": len(rss_totals), "n_processes": len(bucket["pids"]),
+                            "mean_rss": sum(rss_totals) / len(rss_totals), "max_rss": max(rss_totals),
+                            "cpu_seconds": bucket["cpu_seconds"], "read_bytes": bucket["read_bytes"],
+                            "write_bytes": bucket["write_bytes"]})
+    session.execute(delete(ResourceUsage)
+                    .where(ResourceUsage.period_seconds == MINUTE)
+                    .where(ResourceUsage.period_start >= start))
+    if minute_rows:
+        session.execute(insert(ResourceUsage), minute_rows)
+
+    # The hours are rebuilt from the minutes
+    hour_start = floor_time(start, HOUR)
+    minutes = session.execute(select(ResourceUsage)
+                              .where(ResourceUsage.period_seconds == MINUTE)
+                              .where(ResourceUsage.period_start >= hour_start)).scalars().all()
+    hours = defaultdict(list)
+    for minute in minutes:
+        hours[(floor_time(minute.period_start, HOUR), minute.hostname, minute.flow_type)].append(minute)
+    hour_rows = []
+    for (period_start, hostname, flow_type), group in hours.items():
+        n_samples = sum(m.n_samples for m in group)
+        hour_rows.append({"period_seconds": HOUR, "period_start": period_start, "hostname": hostname,
+                          "flow_type": flow_type, "n_samples": n_samples,
+                          "n_processes": max(m.n_processes for m in group),
+                          "mean_rss": sum(m.mean_rss * m.n_samples for m in group) / n_samples,
+                          "max_rss": max(m.max_rss for m in group),
+                          "cpu_seconds": sum(m.cpu_seconds for m in group),
+                          "read_bytes": sum(m.read_bytes for m in group),
+                          "write_bytes": sum(m.write_bytes for m in group)})
+    session.execute(delete(ResourceUsage)
+                    .where(ResourceUsage.period_seconds == HOUR)
+                    .where(ResourceUsage.period_start >= hour_start))
+    if hour_rows:
+        session.execute(insert(ResourceUsage), hour_rows)
+    session.commit()
+    return start
+
+
+@task(cache_policy=NO_CACHE)
+def expire_health_data(session, now: datetime, health_config: dict) -> None:
+    """Deletes raw samples, rollups, per-flow resource records, machine health records and launch capacity decisions
+    once they're past their retention periods"""
+    raw_cutoff = now - timedelta(minutes=health_config.get("raw_retention_minutes", 60))
+    session.execute(delete(ResourceSample).where(ResourceSample.sampled_at < raw_cutoff))
+    for period_seconds, option in [(MINUTE, "minute_retention_days"), (HOUR, "hour_retention_days")]:
+        if (days := health_config.get(option, -1)) >= 0:
+            session.execute(delete(ResourceUsage)
+                            .where(ResourceUsage.period_seconds == period_seconds)
+                            .where(ResourceUsage.period_start < now - timedelta(days=days)))
+    if (days := health_config.get("minute_retention_days", -1)) >= 0:
+        session.execute(delete(FlowResources).where(FlowResources.finished_at < now - timedelta(days=days)))
+    if (days := health_config.get("health_retention_days", -1)) >= 0:
+        session.execute(delete(Health).where(Health.datetime < now - timedelta(days=days)))
+        session.execute(delete(LaunchCapacity).where(LaunchCapacity.decided_at < now - timedelta(days=days)))
+    session.commit()
+
+
+def terminate_process_tree(process: psutil.Process, grace_seconds: float) -> int:
+    """Asks a process and its descendants to stop, killing any that haven't after `grace_seconds`"""
+    try:
+        processes = process.children(recursive=True) + [process]
+    except psutil.NoSuchProcess:
+        return 0
+    for p in processes:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    _, still_alive = psutil.wait_procs(processes, timeout=grace_seconds)
+    for p in still_alive:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(still_alive, timeout=grace_seconds)
+    return len(processes)
+
+
+def terminate_flow_processes(session, flow_ids, hostname: str, grace_seconds: float) -> list[int]:
+    """Terminates the registered processes on this host running any of these flows, returning the IDs of the flows
+    whose processes were stopped. The registrations are removed, but the caller commits. Speedster's workers are left
+    running, and keep their registrations."""
+    rows = session.execute(select(FlowProcess, Flow.flow_run_name)
+                           .outerjoin(Flow, Flow.flow_id == FlowProcess.flow_id)
+                           .where(FlowProcess.hostname == hostname)
+                           .where(FlowProcess.flow_id.in_(flow_ids))).all()
+    terminated = []
+    for registration, flow_run_name in rows:
+        if run_by_speedster(flow_run_name):
+            continue
+        process = get_registered_process(registration.pid, registration.process_start_time)
+        if process is not None and process.pid != os.getpid():
+            terminate_process_tree(process, grace_seconds)
+            terminated.append(registration.flow_id)
+        session.delete(registration)
+    return terminated
+
+
+def get_finished_flow_run_ids(flow_run_ids: list[str]) -> set[str]:
+    """Of these Prefect flow runs, returns those that Prefect considers finished (including crashed or cancelled)"""
+    with get_client(sync_client=True) as client:
+        flow_runs = client.read_flow_runs(flow_run_filter=FlowRunFilter(id=FlowRunFilterId(any_=flow_run_ids)))
+    return {str(flow_run.id) for flow_run in flow_runs if flow_run.state is not None and flow_run.state.is_final()}
+
+
+@task(cache_policy=NO_CACHE)
+def reap_flow_processes(logger, session, hostname: str, grace_seconds: float) -> None:
+    """Reconciles this host's flow process registry with the live processes and the flow states
+
+    * A registered process that no longer exists died without cleaning up (e.g. it was killed, or the pipeline was
+      restarted). If its flow still looks like it's running, the flow is marked revivable.
+    * A registered process that's still alive, but whose flow is no longer running (e.g. it's been timed out) or whose
+      Prefect flow run has ended, is an orphan. It's terminated. If the flow still looks like it's running, it's marked
+      revivable, but other states (e.g. timed out by the cleaner) are left alone. Speedster's workers are never
+      orphans, since speedster finds out for itself when their flows are no longer running.
+    """
+    rows = session.execute(select(FlowProcess, Flow.state, Flow.flow_run_name, Flow.flow_run_id, Flow.end_time)
+                           .outerjoin(Flow, Flow.flow_id == FlowProcess.flow_id)
+                           .where(FlowProcess.hostname == hostname)).all()
+    if not rows:
+        return
+
+    live_rows, dead_rows = [], []
+    for row in rows:
+        if get_registered_process(row.FlowProcess.pid, row.FlowProcess.process_start_time) is None:
+            dead_rows.append(row)
+        else:
+            live_rows.append(row)
+
+    finished_flow_runs = set()
+    flow_run_ids = [row.flow_run_id for row in live_rows if row.state == "running" and row.flow_run_id]
+    if flow_run_ids:
+        try:
+            finished_flow_runs = get_finished_flow_run_ids(flow_run_ids)
+        except httpx.HTTPError as e:
+            logger.warning(f"Couldn't check flow run states with Prefect, so only checking the database: {e}")
+
+    # A flow that has just finished may not have unregistered yet, so give those a little time
+    finished_before = datetime.now() - FINISHING_GRACE_PERIOD
+    orphans = [row for row in live_rows
+               if not run_by_speedster(row.flow_run_name)
+               and ((row.state == "running" and row.flow_run_id in finished_flow_runs)
+                    or (row.state != "running" and (row.end_time is None or row.end_time < finished_before)))]
+    for row in orphans:
+        logger.warning(f"Flow {row.FlowProcess.flow_id} ({row.FlowProcess.flow_type}) is {row.state or 'deleted'}, "
+                       f"but its process {row.FlowProcess.pid} is still alive. Terminating it.")
+    terminate_flow_processes(session, [row.FlowProcess.flow_id for row in orphans], hostname, grace_seconds)
+
+    for row in dead_rows:
+        session.delete(row.FlowProcess)
+    # The state is only changed once the processes are gone, so a dying flow can't overwrite it
+    to_revive = ([row.FlowProcess.flow_id for row in dead_rows if row.state == "running"]
+                 + [row.FlowProcess.flow_id for row in orphans if row.state == "running"])
+    if to_revive:
+        session.execute(update(Flow).where(Flow.flow_id.in_(to_revive)).values(state="revivable"))
+        logger.info(f"Marked {len(to_revive)} flows with dead or orphaned processes as revivable: {to_revive}")
+    session.commit()
+
 
 @flow
-def health_monitor(pipeline_config_path: str = None):
+def health_monitor(pipeline_config_path: str | None = None, session=None):
+    logger = get_run_logger()
     config = load_pipeline_configuration(pipeline_config_path)
+    health_config = config.get("control", {}).get("health_monitor", {})
+    if session is None:
+        session = get_database_session()
 
     now = datetime.now()
-    cpu_usage = psutil.cpu_percent(interval=5)
+    hostname = socket.gethostname()
+    _, busy_time, _, _ = measure_machine()
+    cpu_usage = machine_cpu_percentage(session, now, hostname, busy_time)
     memory_usage = psutil.virtual_memory().used / 1E9  # store in GB
     memory_percentage = psutil.virtual_memory().percent
     disk_usage = psutil.disk_usage(config.get("root", "/")).used / 1E9  # store in GB
     disk_percentage = psutil.disk_usage(config.get("root", "/")).percent
     num_pids = len(psutil.pids())
 
-    with get_database_session() as session:
-        new_health_entry = Health(datetime=now,
-                                  cpu_usage=cpu_usage,
-                                  memory_usage=memory_usage,
-                                  memory_percentage=memory_percentage,
-                                  disk_usage=disk_usage,
-                                  disk_percentage=disk_percentage,
-                                  num_pids=num_pids)
-        session.add(new_health_entry)
-        session.commit()
+    new_health_entry = Health(datetime=now,
+                              cpu_usage=cpu_usage,
+                              memory_usage=memory_usage,
+                              memory_percentage=memory_percentage,
+                              disk_usage=disk_usage,
+                              disk_percentage=disk_percentage,
+                              num_pids=num_pids)
+    session.add(new_health_entry)
+    session.commit()
+
+    n_flows = sample_resources(session, now, hostname)
+    start = rollup_resource_usage(session, now,
+                                  default_window=timedelta(minutes=health_config.get("raw_retention_minutes", 60)),
+                                  margin=timedelta(minutes=2))
+    logger.info(f"Sampled {n_flows} flow processes on {hostname}, and rolled up usage since {start}")
+    expire_health_data(session, now, health_config)
 
+    if health_config.get("reap_orphaned_flows", True):
+        reap_flow_processes(logger, session, hostname, health_config.get("termination_grace_seconds", 10))
 
-# TODO add zombie monitor!
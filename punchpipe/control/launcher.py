@@ -1,23 +1,30 @@
+import time
+import uuid
+import heapq
 import asyncio
 from math import ceil
 from random import shuffle
 from typing import List
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import deque, defaultdict
 
+import httpx
 from prefect import flow, get_run_logger, task
 from prefect.cache_policies import NO_CACHE
 from prefect.client import get_client
+from prefect.exceptions import PrefectHTTPStatusError
 from prefect.variables import Variable
-from sqlalchemy import and_, func, select, update
+from sqlalchemy import and_, case, func, select, update
 from sqlalchemy.orm import Session
 
-from punchpipe.control.db import File, Flow
+from punchpipe.control.calibration import get_learned_weights
+from punchpipe.control.capacity import get_launch_capacity
+from punchpipe.control.db import File, Flow, seconds_between
 from punchpipe.control.util import batched, get_database_session, load_pipeline_configuration
 
 
-@task(cache_policy=NO_CACHE)
-def gather_planned_flows(session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled, flow_batch_sizes):
+def select_in_priority_order(session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled,
+                             flow_batch_sizes, priority):
     # We'll have to grab a bunch of possible flows to launch from the DB, and then on our end apply the weights and the
     # maximum-weight limit. But we can use the smallest weight to set an upper bound on how many launchable flows to
     # retrieve.
@@ -29,45 +36,119 @@ def gather_planned_flows(session, weight_to_launch, max_flows_to_launch, flow_we
     flows = (session.query(Flow)
                    .where(Flow.state == "planned")
                    .where(Flow.flow_type.in_(enabled_flows))
-                   .order_by(Flow.is_backprocessing.asc(), Flow.priority.desc(), Flow.creation_time.asc())
+                   .order_by(Flow.is_backprocessing.asc(), priority.desc(), Flow.creation_time.asc())
                    .limit(max_to_select).all())
     selected_flows = []
     selected_weight = 0
     selected_number = 0
-    count_per_type = defaultdict(lambda: 0)
-    while selected_weight < weight_to_launch and selected_number < max_flows_to_launch and len(flows):
-        flow = flows.pop(0)
-        if not flow_enabled[flow.flow_type]:
+    for candidate in flows:
+        if selected_weight >= weight_to_launch or selected_number >= max_flows_to_launch:
+            break
+        if not flow_enabled[candidate.flow_type]:
             continue
-        selected_flows.append(flow)
-        selected_weight += flow_weights[flow.flow_type]
-        selected_number += 1 / flow_batch_sizes[flow.flow_type]
-        count_per_type[flow.flow_type] += 1
-
-    select_flow_ids = [flow.flow_id for flow in selected_flows]
-    output_files = session.query(File).where(File.processing_flow.in_(select_flow_ids)).all()
-    tags_by_flow = {}
-    for flow in selected_flows:
-        tags = set()
-        for output_file in output_files:
-            if output_file.processing_flow == flow.flow_id:
-                tags.add(output_file.file_type + output_file.observatory)
-        tags_by_flow[flow.flow_id] = sorted(tags)
+        selected_flows.append(candidate)
+        selected_weight += flow_weights[candidate.flow_type]
+        selected_number += 1 / flow_batch_sizes[candidate.flow_type]
+    return selected_flows, selected_weight
+
+
+def select_fair_share(session, weight_to_launch, max_flows_to_launch, flow_weights, flow_batch_sizes, flow_shares,
+                      virtual_times, priority):
+    """Selects flows by weighted fair queuing across flow types, so one type's backlog can't starve the others
+
+    Within each type, flows keep the usual order. Each type's virtual time advances by each launched flow's weight
+    divided by the type's share, and the next flow always comes from the type that's furthest behind, so each type
+    with planned flows gets its share of the launched weight. `virtual_times` can be kept between calls so that
+    fairness carries over from one launch to the next. Types with nothing waiting drop out of it, so they can't bank
+    credit while idle.
+    """
+    queues = {}
+    exhausted = set()
+    for flow_type, share in flow_shares.items():
+        if share <= 0:
+            continue
+        # No type could launch more than this many flows
+        limit = ceil(weight_to_launch / flow_weights[flow_type])
+        queues[flow_type] = deque(session.query(Flow)
+                                  .where(Flow.state == "planned")
+                                  .where(Flow.flow_type == flow_type)
+                                  .order_by(Flow.is_backprocessing.asc(), priority.desc(), Flow.creation_time.asc())
+                                  .limit(limit).all())
+        if len(queues[flow_type]) < limit:
+            exhausted.add(flow_type)
+
+    heap = []
+    for order, (flow_type, queue) in enumerate(queues.items()):
+        if queue:
+            heap.append((virtual_times.setdefault(flow_type, 0), order, flow_type))
+    heapq.heapify(heap)
+
+    selected_flows = []
+    selected_weight = 0
+    selected_number = 0
+    while heap and selected_weight < weight_to_launch and selected_number < max_flows_to_launch:
+        virtual_time, order, flow_type = heapq.heappop(heap)
+        selected_flows.append(queues[flow_type].popleft())
+        selected_weight += flow_weights[flow_type]
+        selected_number += 1 / flow_batch_sizes[flow_type]
+        virtual_times[flow_type] = virtual_time + flow_weights[flow_type] / flow_shares[flow_type]
+        if queues[flow_type]:
+            heapq.heappush(heap, (virtual_times[flow_type], order, flow_type))
+
+    for flow_type in list(virtual_times):
+        if flow_type not in queues or (flow_type in exhausted and not queues[flow_type]):
+            del virtual_times[flow_type]
+    if virtual_times:
+        # Measure from the type that's furthest behind, so types that start waiting later join in on level terms
+        lowest = min(virtual_times.values())
+        for flow_type in virtual_times:
+            virtual_times[flow_type] -= lowest
+    return selected_flows, selected_weight
+
+
+@task(cache_policy=NO_CACHE)
+def gather_planned_flows(session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled, flow_batch_sizes,
+                         flow_shares=None, virtual_times=None, priority=None):
+    """Picks the planned flows to launch, up to the given weight and number of flows
+
+    Flows are taken in order of `priority` (by default, the stored priority; see `effective_priority`), or shared out
+    between flow types if `flow_shares` is given.
+    """
+    if priority is None:
+        priority = Flow.priority
+    if flow_shares is not None:
+        selected_flows, selected_weight = select_fair_share(
+            session, weight_to_launch, max_flows_to_launch, flow_weights, flow_batch_sizes,
+            {flow_type: share for flow_type, share in flow_shares.items() if flow_enabled[flow_type]},
+            virtual_times if virtual_times is not None else {}, priority)
+    else:
+        selected_flows, selected_weight = select_in_priority_order(
+            session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled, flow_batch_sizes, priority)
+    count_per_type = defaultdict(lambda: 0)
+    for selected_flow in selected_flows:
+        count_per_type[selected_flow.flow_type] += 1
+
+    # Let the database work out each flow's distinct output types, rather than pairing up every flow with every file
+    tags_by_flow = {flow.flow_id: set() for flow in selected_flows}
+    for select_flow_ids in batched(list(tags_by_flow), 10_000):
+        output_types = session.execute(
+            select(File.processing_flow, File.file_type, File.observatory)
+            .where(File.processing_flow.in_(select_flow_ids))
+            .distinct()
+        ).all()
+        for flow_id, file_type, observatory in output_types:
+            tags_by_flow[flow_id].add(file_type + observatory)
+    tags_by_flow = {flow_id: sorted(tags) for flow_id, tags in tags_by_flow.items()}
 
     number_of_flows = len(selected_flows)
+    flows_by_type = defaultdict(list)
+    for selected_flow in selected_flows:
+        flows_by_type[selected_flow.flow_type].append(selected_flow)
     batched_flows = []
     for flow_type, batch_size in flow_batch_sizes.items():
-        if batch_size <= 1:
-            continue
-        these_flows, other_flows = [], []
-        for flow in selected_flows:
-            if flow.flow_type == flow_type:
-                these_flows.append(flow)
-            else:
-                other_flows.append(flow)
-        batched_flows.extend(batched(these_flows, batch_size))
-        selected_flows = other_flows
-    selected_flows = [[f] for f in selected_flows] + batched_flows
+        if batch_size > 1:
+            batched_flows.extend(batched(flows_by_type[flow_type], batch_size))
+    selected_flows = [[f] for f in selected_flows if flow_batch_sizes[f.flow_type] <= 1] + batched_flows
 
     return selected_flows, tags_by_flow, selected_weight, number_of_flows, count_per_type
 
@@ -93,26 +174,30 @@ def count_flows(session, weights):
     return n_running, n_planned, weight_planned, weight_running
 
 
-@task(cache_policy=NO_CACHE)
-def escalate_long_waiting_flows(session, pipeline_config):
+def effective_priority(pipeline_config, now=None):
+    """A SQL expression for each flow's priority, escalated according to how long it's been waiting
+
+    A flow that's waited longer than one of its type's `priority.seconds` thresholds gets at least the matching
+    `priority.escalation`. This is worked out when flows are selected, rather than by repeatedly updating the priorities
+    stored in the flows table, which took many locking scans of that table.
+    """
+    if now is None:
+        now = datetime.now()
+    escalations = []
     for flow_type in pipeline_config["flows"]:
-        for max_seconds_waiting, escalated_priority in zip(
-            pipeline_config["flows"][flow_type]["priority"]["seconds"],
-            pipeline_config["flows"][flow_type]["priority"]["escalation"],
-        ):
-            since = datetime.now() - timedelta(seconds=max_seconds_waiting)
-            session.query(Flow).where(
-                and_(Flow.priority < escalated_priority,
-                     Flow.state == "planned",
-                     Flow.creation_time < since,
-                     Flow.flow_type == flow_type)
-            ).update({"priority": escalated_priority})
-            # Commit after every update to try to avoid deadlocks. I think the problem scenario is (1) we've updated
-            # a flow's priority, so we have that row locked until we commit, (2) the flow gets launched, so another
-            # process wants to update that flow record and so has a pending transaction on that row, and (3) we
-            # continue going through our loops, where each update call has to lock the whole table so it can scan
-            # every record, and so it has to wait for the other process, which has its pending lock/update
-            session.commit()
+        priority_config = pipeline_config["flows"][flow_type].get("priority", {})
+        for max_seconds_waiting, escalated_priority in zip(priority_config.get("seconds", []),
+                                                           priority_config.get("escalation", [])):
+            escalations.append((escalated_priority,
+                                and_(Flow.flow_type == flow_type,
+                                     Flow.creation_time < now - timedelta(seconds=max_seconds_waiting),
+                                     Flow.priority < escalated_priority)))
+    if not escalations:
+        return Flow.priority
+    # With the highest escalations checked first, the first that applies is the one the flow gets
+    escalations.sort(key=lambda escalation: escalation[0], reverse=True)
+    return case(*[(condition, escalated_priority) for escalated_priority, condition in escalations],
+                else_=Flow.priority)
 
 
 def determine_launchable_flow_count(weight_planned, weight_running, max_weight_running, max_weight_to_launch,
@@ -128,8 +213,70 @@ def determine_launchable_flow_count(weight_planned, weight_running, max_weight_r
     return min(amount_to_launch, weight_planned), max_flows_to_launch
 
 
+class LaunchPacer:
+    """Spaces out flow launches so they go out at a steady rate rather than in bursts
+
+    Parameters
+    ----------
+    launches_per_second : float
+        The maximum launch rate. If None or zero, launches aren't limited.
+    """
+    def __init__(self, launches_per_second: float | None = None):
+        self.next_launch = 0
+        self.set_rate(launches_per_second)
+
+    def set_rate(self, launches_per_second: float | None) -> None:
+        self.interval = 1 / launches_per_second if launches_per_second else 0
+
+    async def wait(self, n: int = 1) -> None:
+        """Waits until the next `n` launches can go out"""
+        now = time.monotonic()
+        if self.next_launch > now:
+            await asyncio.sleep(self.next_launch - now)
+        self.next_launch = max(now, self.next_launch) + n * self.interval
+
+
+# Deployment IDs by name, so they don't have to be looked up for every launch. They're refreshed if a name is missing
+# or an ID has gone stale, which happens when `serve` recreates the deployments, and otherwise every ten minutes.
+_deployment_ids = {}
+_deployment_ids_read_at = 0
+DEPLOYMENT_CACHE_SECONDS = 600
+
+
+async def get_deployment_id(client, name: str, refresh: bool = False):
+    global _deployment_ids, _deployment_ids_read_at
+    if refresh or name not in _deployment_ids or time.monotonic() - _deployment_ids_read_at > DEPLOYMENT_CACHE_SECONDS:
+        _deployment_ids = {d.name: d.id for d in await client.read_deployments()}
+        _deployment_ids_read_at = time.monotonic()
+    return _deployment_ids[name]
+
+
+async def submit_flow_run(client, semaphore: asyncio.Semaphore, deployment_name: str, parameters: dict,
+                          tags: list[str], retries: int):
+    """Creates a flow run, retrying with backoff if that fails. Returns None if it couldn't be created."""
+    logger = get_run_logger()
+    # Prefect returns the existing flow run if a retry repeats a submission that went through
+    idempotency_key = str(uuid.uuid4())
+    async with semaphore:
+        refresh = False
+        for attempt in range(retries + 1):
+            try:
+                deployment_id = await get_deployment_id(client, deployment_name, refresh)
+                return await client.create_flow_run_from_deployment(deployment_id, parameters=parameters, tags=tags,
+                                                                    idempotency_key=idempotency_key)
+            except (httpx.HTTPError, KeyError) as e:
+                # A KeyError means no deployment has this name (yet), and the next attempt will look the names up again
+                # If the deployment wasn't found, it was probably recreated, so look up its new ID
+                refresh = isinstance(e, PrefectHTTPStatusError) and e.response.status_code == 404
+                logger.warning(f"Submitting {deployment_name} with {parameters} failed (attempt {attempt + 1}): {e!r}")
+            if attempt < retries:
+                await asyncio.sleep(min(2 ** attempt, 30))
+    return None
+
+
 @task(cache_policy=NO_CACHE)
-async def launch_ready_flows(session: Session, flow_info: List[List[Flow]], tags_by_flow: dict[int, str], pipeline_config: dict) -> None:
+async def launch_ready_flows(session: Session, flow_info: List[List[Flow]], tags_by_flow: dict[int, str],
+                             pipeline_config: dict, pacer: LaunchPacer = None) -> None:
     """Given a list of ready-to-launch flow_ids, this task creates flow runs in Prefect for them.
     These flow runs are automatically marked as scheduled in Prefect and will be picked up by a work queue and
     agent as soon as possible.
@@ -140,6 +287,11 @@ async def launch_ready_flows(session: Session, flow_info: List[List[Flow]], tags
         A SQLAlchemy session for database interactions
     flow_info : List[int]
         A list of flow IDs from the punchpipe database identifying which flows to launch
+    pipeline_config : dict
+        The pipeline configuration
+    pacer : LaunchPacer
+        Sets the pace of the launches. If not provided, launches are spread evenly through the launch time window,
+        up to the configured max_launches_per_second
 
     Returns
     -------
@@ -156,12 +308,8 @@ async def launch_ready_flows(session: Session, flow_info: List[List[Flow]], tags
     # scheduling window.
     shuffle(flow_info)
 
-    async with get_client() as client:
-        # determine the deployment ids for each kind of flow
-        deployments = await client.read_deployments()
-        deployment_ids = {d.name: d.id for d in deployments}
-
-        # We want to stagger launches through a time window. If our configured time window is 5 minutes, we'll use 4
+    if pacer is None:
+        # We want to spread launches through a time window. If our configured time window is 5 minutes, we'll use 4
         # full minutes, plus a portion of the fifth, aiming to end after 4m35s to leave margin so the flow is fully
         # finished after 5 minutes.
         # First we work out the remainder part, figuring out where we are relative to the 35th second of the current
@@ -169,29 +317,32 @@ async def launch_ready_flows(session: Session, flow_info: List[List[Flow]], tags
         total_delay_time = 35 - datetime.now().second
         total_delay_time = max(0, total_delay_time)
         total_delay_time += (pipeline_config['control']['launcher']['launch_time_window_minutes'] - 1) * 60
-        # Launch a chunk every 10 seconds through this window
-        n_chunks = total_delay_time // 10
-        n_chunks = max(n_chunks, 1)
-        chunk_size = ceil(len(flow_info) / n_chunks)
         logger.info(f"Total delay time: {total_delay_time}")
-        if chunk_size >= len(flow_info):
-            delay_time = 0
-        else:
-            delay_time = total_delay_time / (n_chunks - 1)
-        awaitables = []
-        responses = []
-        all_chunks = list(batched(flow_info, chunk_size))
-        for chunk_number, chunk in enumerate(all_chunks):
-            start = datetime.now().timestamp()
+        launches_per_second = len(flow_info) / total_delay_time if total_delay_time else None
+        max_launches_per_second = pipeline_config['control']['launcher'].get('max_launches_per_second')
+        if launches_per_second is None or (max_launches_per_second and max_launches_per_second < launches_per_second):
+            launches_per_second = max_launches_per_second
+        pacer = LaunchPacer(launches_per_second)
+
+    launcher_config = pipeline_config['control']['launcher']
+    # Each chunk of batches is marked launched with one UPDATE and then sent off. Chunks are about a second's worth of
+    # launches, so that launches still go out smoothly.
+    chunk_size = max(1, round(1 / pacer.interval)) if pacer.interval else 100
+    semaphore = asyncio.Semaphore(launcher_config.get('max_concurrent_submissions', 20))
+    retries = launcher_config.get('submission_retries', 3)
 
-            for batch in chunk:
-                for flow in batch:
-                    flow.state = "launched"
-                    flow.launch_time = datetime.now()
+    async with get_client() as client:
+        start = time.monotonic()
+        submissions = []
+        n_actual_flows = 0
+        for chunk in batched(flow_info, chunk_size):
+            # Each chunk is marked as launched just before it's sent, so that flows waiting their turn stay planned
+            await pacer.wait(len(chunk))
+            session.execute(update(Flow)
+                            .where(Flow.flow_id.in_([flow.flow_id for batch in chunk for flow in batch]))
+                            .values(state="launched", launch_time=datetime.now()))
             session.commit()
 
-            # Launch the chunk
-            n_actual_flows = 0
             for batch in chunk:
                 flow_ids = [flow.flow_id for flow in batch]
                 flow_types = set(flow.flow_type for flow in batch)
@@ -202,59 +353,139 @@ async def launch_ready_flows(session: Session, flow_info: List[List[Flow]], tags
                 unique_tags = list(unique_tags)
                 if len(flow_ids) > 1:
                     unique_tags.append("batch")
-                this_deployment_id = deployment_ids[batch[0].flow_type + "_process_flow"]
                 parameters = {"flow_id": flow_ids[0] if len(flow_ids) == 1 else flow_ids}
-                awaitables.append(client.create_flow_run_from_deployment(
-                    this_deployment_id, parameters=parameters, tags=unique_tags)
-                )
+                # Don't wait on the submission, so that a slow response doesn't hold up the next launch
+                submissions.append(asyncio.create_task(submit_flow_run(
+                    client, semaphore, batch[0].flow_type + "_process_flow", parameters, unique_tags, retries)))
                 n_actual_flows += len(flow_ids)
 
-            responses.extend(await asyncio.gather(*awaitables))
-            awaitables = []
-            logger.info(f"Chunk {chunk_number}/{len(all_chunks)} sent, containing {n_actual_flows} flows "
-                        f"in {len(chunk)} batches")
-            if delay_time:
-                # Stagger the launches
-                await asyncio.sleep(delay_time - (datetime.now().timestamp() - start))
-        # TODO This doesn't seem to be an effective way to check for a failed flow submission, but we should
-        # do something like this that works
-        ok_responses = [r for r in responses if r.name not in [None, ''] and r.state_name == 'Scheduled']
-        bad_responses = [r for r in responses if r not in ok_responses]
-
-        if len(bad_responses):
-            bad_flow_ids = []
-            for r in bad_responses:
-                flow_id = r.parameters['flow_id']
-                if isinstance(flow_id, list):
-                    bad_flow_ids.extend(flow_id)
-                else:
-                    bad_flow_ids.append(flow_id)
-            session.execute(
-                update(Flow)
-                .where(Flow.state == 'launched')
-                .where(Flow.flow_id.in_(bad_flow_ids))
-                .values(state='planned')
-            )
-            session.commit()
-            for r in bad_responses:
-                logger.warning(f"Got bad response {repr(r)}")
-
-
-def load_flow_data(pipeline_config):
+        responses = await asyncio.gather(*submissions)
+        elapsed = time.monotonic() - start
+        logger.info(f"Sent {n_actual_flows} flows in {len(flow_info)} submissions over {elapsed:.1f} seconds "
+                    f"({len(flow_info) / max(elapsed, 1e-3):.1f} submissions per second)")
+
+    # TODO This doesn't seem to be an effective way to check for a failed flow submission, but we should
+    # do something like this that works
+    bad_flow_ids = []
+    for batch, response in zip(flow_info, responses):
+        if response is None or response.name in [None, ''] or response.state_name != 'Scheduled':
+            bad_flow_ids.extend(flow.flow_id for flow in batch)
+            logger.warning(f"Got bad response {repr(response)} for flows {[flow.flow_id for flow in batch]}")
+    if len(bad_flow_ids):
+        session.execute(
+            update(Flow)
+            .where(Flow.state == 'launched')
+            .where(Flow.flow_id.in_(bad_flow_ids))
+            .values(state='planned')
+        )
+        session.commit()
+
+
+def load_flow_data(pipeline_config, session=None):
+    """Reads each flow type's launch settings from the config
+
+    Flow types with `launch_weight: auto` use the weight learned by the calibrator, which requires a session. Until one
+    has been learned, they get a weight of 1.
+    """
     flow_weights = dict()
     flow_enabled = dict()
     flow_batch_size = dict()
+    learned_weights = None
     for flow_type in pipeline_config["flows"]:
         flow_enabled[flow_type] = pipeline_config["flows"][flow_type].get("enabled", True) is True
         flow_weights[flow_type] = pipeline_config["flows"][flow_type].get("launch_weight", 1)
+        if flow_weights[flow_type] == "auto":
+            if learned_weights is None:
+                learned_weights = get_learned_weights(session) if session is not None else {}
+            flow_weights[flow_type] = learned_weights.get(flow_type, 1)
         flow_batch_size[flow_type] = pipeline_config["flows"][flow_type].get("batch_size", 1)
     return flow_weights, flow_enabled, flow_batch_size
 
 
+def measure_batch_timing(session, flow_types, since) -> dict[str, tuple[float, float]]:
+    """Each flow type's mean time per flow and mean overhead per Prefect run, from recently completed flows
+
+    The flows in a batch share a flow run, and all start when the run does and end when it finishes, so each run's
+    duration is shared among its flows. The overhead is the time from launch to the start of the run.
+    """
+    runs = session.execute(
+        select(Flow.flow_type, func.count(), func.min(seconds_between(Flow.launch_time, Flow.start_time)),
+               func.max(seconds_between(Flow.start_time, Flow.end_time)))
+        .where(Flow.state == "completed")
+        .where(Flow.flow_type.in_(flow_types))
+        .where(Flow.end_time >= since)
+        .where(Flow.launch_time.is_not(None))
+        .where(Flow.flow_run_name.is_not(None))
+        # Speedster runs all its flows under a name per process, without Prefect's overhead
+        .where(Flow.flow_run_name.not_like("speedster%"))
+        .group_by(Flow.flow_type, Flow.flow_run_name)).all()
+    totals = defaultdict(lambda: [0, 0, 0.0, 0.0])
+    for flow_type, n_flows, overhead, duration in runs:
+        totals[flow_type][0] += 1
+        totals[flow_type][1] += n_flows
+        totals[flow_type][2] += max(overhead, 0)
+        totals[flow_type][3] += duration
+    return {flow_type: (duration / n_flows, overhead / n_runs)
+            for flow_type, (n_runs, n_flows, overhead, duration) in totals.items()}
+
+
+def choose_batch_size(n_planned: int, duration: float, overhead: float, max_batch_size: int, config: dict) -> int:
+    """Picks how many flows to run in each Prefect run
+
+    Near real time, each flow gets its own run so it finishes as soon as possible. With a backlog of at least
+    `backlog_flows`, batches grow until the per-run overhead is at most `target_overhead_fraction` of each run, as long
+    as a batch takes no more than `max_batch_seconds`.
+    """
+    if n_planned < config.get("backlog_flows", 100):
+        return 1
+    target = config.get("target_overhead_fraction", 0.1)
+    batch_size = ceil(overhead * (1 - target) / (target * max(duration, 1e-3)))
+    batch_size = min(batch_size, int(config.get("max_batch_seconds", 900) // max(duration, 1e-3)))
+    return max(1, min(batch_size, max_batch_size))
+
+
+def determine_batch_sizes(session, pipeline_config, flow_batch_sizes, logger, now=None) -> dict:
+    """Works out the batch size for each flow type with `batch_size: auto`, from its backlog and recent timings"""
+    auto_types = [flow_type for flow_type, batch_size in flow_batch_sizes.items() if batch_size == "auto"]
+    if not auto_types:
+        return flow_batch_sizes
+    if now is None:
+        now = datetime.now()
+    config = pipeline_config["control"]["launcher"].get("adaptive_batching", {})
+    n_planned = dict(session.execute(select(Flow.flow_type, func.count())
+                                     .where(Flow.state == "planned")
+                                     .where(Flow.flow_type.in_(auto_types))
+                                     .group_by(Flow.flow_type)).all())
+    timing = measure_batch_timing(session, auto_types, now - timedelta(hours=config.get("lookback_hours", 6)))
+    flow_batch_sizes = dict(flow_batch_sizes)
+    for flow_type in auto_types:
+        max_batch_size = pipeline_config["flows"][flow_type].get("max_batch_size", 10)
+        if flow_type not in timing:
+            flow_batch_sizes[flow_type] = 1
+            logger.info(f"Running {flow_type} flows singly until there are recent timings for them")
+            continue
+        duration, overhead = timing[flow_type]
+        flow_batch_sizes[flow_type] = choose_batch_size(n_planned.get(flow_type, 0), duration, overhead,
+                                                        max_batch_size, config)
+        logger.info(f"Batching {flow_type} flows {flow_batch_sizes[flow_type]} at a time: "
+                    f"{n_planned.get(flow_type, 0)} planned, {duration:.1f} s per flow, "
+                    f"{overhead:.1f} s overhead per run")
+    return flow_batch_sizes
+
+
+def load_flow_shares(pipeline_config):
+    """Each flow type's share of launches in fair-share mode, or None if flows are launched strictly by priority"""
+    if not pipeline_config["control"]["launcher"].get("fair_share", False):
+        return None
+    return {flow_type: pipeline_config["flows"][flow_type].get("launch_share", 1)
+            for flow_type in pipeline_config["flows"]}
+
+
 @flow
 async def launcher(pipeline_config_path=None):
     """The main launcher flow for Prefect, responsible for identifying flows, based on priority,
-        that are ready to run and creating flow runs for them. It also escalates long-waiting flows' priorities.
+        that are ready to run and creating flow runs for them. Long-waiting flows' priorities are escalated as they're
+        selected.
 
     See EM 41 or the internal requirements document for more details
 
@@ -267,18 +498,22 @@ async def launcher(pipeline_config_path=None):
     if pipeline_config_path is None:
         pipeline_config_path = await Variable.get("punchpipe_config", "punchpipe_config.yaml")
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
-    flow_weights, flow_enabled, flow_batch_sizes = load_flow_data(pipeline_config)
-    logger.info(f"Enabled flows: {', '.join([flow for flow, enabled in flow_enabled.items() if enabled])}")
 
     logger.info("Establishing database connection")
     session = get_database_session()
 
-    escalate_long_waiting_flows(session, pipeline_config)
+    flow_weights, flow_enabled, flow_batch_sizes = load_flow_data(pipeline_config, session)
+    flow_batch_sizes = determine_batch_sizes(session, pipeline_config, flow_batch_sizes, logger)
+    logger.info(f"Enabled flows: {', '.join([flow for flow, enabled in flow_enabled.items() if enabled])}")
+
+    if pipeline_config["control"]["launcher"].get("continuous", False):
+        await launch_continuously(session, pipeline_config_path)
+        return
 
     # Perform the launcher flow responsibilities
     num_running_flows, num_planned_flows, weight_planned, weight_running = count_flows(session, flow_weights)
     logger.info(f"There are {num_running_flows} flows running right now (weight {weight_running:.2f}) and {num_planned_flows} planned flows (weight {weight_planned:.2f}).")
-    max_weight_running = pipeline_config["control"]["launcher"]["max_weight_running"]
+    max_weight_running = get_launch_capacity(session, pipeline_config["control"]["launcher"], weight_running, logger)
     max_weight_to_launch = pipeline_config["control"]["launcher"]["max_weight_to_launch_at_once"]
     max_flows_to_launch = pipeline_config["control"]["launcher"]["max_flows_to_launch_at_once"]
 
@@ -286,7 +521,8 @@ async def launcher(pipeline_config_path=None):
         weight_planned, weight_running, max_weight_running, max_weight_to_launch, max_flows_to_launch)
 
     flows_to_launch, tags_by_flow, selected_weight, number_of_flows, counts_per_type = gather_planned_flows(
-        session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled, flow_batch_sizes)
+        session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled, flow_batch_sizes,
+        load_flow_shares(pipeline_config), priority=effective_priority(pipeline_config))
     ids = [[flow.flow_id for flow in batch] for batch in flows_to_launch]
     logger.info(f"{number_of_flows} flows (weight {selected_weight:.2f}) with IDs of {ids} will be launched.")
     counts = [f"{counts_per_type[type]} {type}" for type in sorted(counts_per_type.keys())]
@@ -294,3 +530,43 @@ async def launcher(pipeline_config_path=None):
         logger.info("This consists of " + ", ".join(counts))
     await launch_ready_flows(session, flows_to_launch, tags_by_flow, pipeline_config)
     logger.info("Launcher flow exit.")
+
+
+async def launch_continuously(session, pipeline_config_path: str) -> None:
+    """Keeps launching flows as soon as there's room for them, rather than once per launch window
+
+    The running weight is refreshed from the database every `poll_seconds`, and launches are paced to at most
+    `max_launches_per_second`. The config file is re-read on every poll so that changes take effect without a restart.
+    Tasks are called directly, so that the endless loop doesn't fill Prefect with task runs.
+    """
+    logger = get_run_logger()
+    pacer = LaunchPacer()
+    # Each flow type's fair-share progress, kept from poll to poll
+    virtual_times = {}
+    logger.info("Launching continuously")
+    while True:
+        pipeline_config = load_pipeline_configuration(pipeline_config_path)
+        launcher_config = pipeline_config["control"]["launcher"]
+        flow_weights, flow_enabled, flow_batch_sizes = load_flow_data(pipeline_config, session)
+        pacer.set_rate(launcher_config.get("max_launches_per_second"))
+        # End the previous transaction, so we see the flows that have finished since the last poll
+        session.commit()
+
+        num_running_flows, num_planned_flows, weight_planned, weight_running = count_flows.fn(session, flow_weights)
+        max_weight_running = get_launch_capacity(session, launcher_config, weight_running, logger)
+        if weight_planned and weight_running < max_weight_running:
+            logger.info(f"There are {num_running_flows} flows running right now (weight {weight_running:.2f}) and "
+                        f"{num_planned_flows} planned flows (weight {weight_planned:.2f}).")
+            weight_to_launch, max_flows_to_launch = determine_launchable_flow_count(
+                weight_planned, weight_running, max_weight_running,
+                launcher_config["max_weight_to_launch_at_once"], launcher_config["max_flows_to_launch_at_once"])
+            flow_batch_sizes = determine_batch_sizes(session, pipeline_config, flow_batch_sizes, logger)
+            flows_to_launch, tags_by_flow, selected_weight, number_of_flows, counts_per_type = gather_planned_flows.fn(
+                session, weight_to_launch, max_flows_to_launch, flow_weights, flow_enabled, flow_batch_sizes,
+                load_flow_shares(pipeline_config), virtual_times, effective_priority(pipeline_config))
+            if flows_to_launch:
+                counts = [f"{counts_per_type[type]} {type}" for type in sorted(counts_per_type.keys())]
+                logger.info(f"Launching {number_of_flows} flows (weight {selected_weight:.2f}): " + ", ".join(counts))
+                await launch_ready_flows.fn(session, flows_to_launch, tags_by_flow, pipeline_config, pacer)
+                continue
+        await asyncio.sleep(launcher_config.get("poll_seconds", 5))
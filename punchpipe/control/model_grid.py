@@ -0,0 +1,225 @@
+"""Bookkeeping for the regularly-spaced grids of model files produced by the background-model schedulers
+
+Stray light, F corona, starfield and LQ F corona models are produced on a fixed time grid starting at a configured
+`t0`. Each grid slot is represented in the `files` table by a placeholder with state 'waiting' until the scheduler
+finds enough inputs to produce it. Rather than stepping through the whole grid and loading every existing model row on
+every scheduler run, the `model_grids` table remembers the last slot that has been materialized, so only new slots are
+added, and the `model_queue` table holds the slots still waiting, so they can be read back without scanning `files`.
+"""
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import and_, delete, exists, select
+
+from punchpipe import __version__
+from punchpipe.control.db import File, ModelGrid, ModelQueueEntry
+
+
+def grid_slot_times(t0: datetime, increment: timedelta, first_index: int = 0, now: datetime | None = None
+                    ) -> list[datetime]:
+    """Lists the grid slots from `first_index` up to and including the first slot at or after `now`"""
+    if now is None:
+        now = datetime.now()
+    last_index = max(0, int(np.ceil((now - t0) / increment)))
+    return [t0 + i * increment for i in range(first_index, last_index + 1)]
+
+
+def _encode_model_keys(model_keys: list[tuple[str, str, str]]) -> str:
+    return ",".join("".join(key) for key in model_keys)
+
+
+def materialize_model_grid(session, flow_type: str, level: str, model_keys: list[tuple[str, str, str]],
+                           t0: datetime, increment: timedelta, pipeline_config: dict,
+                           now: datetime | None = None) -> int:
+    """Adds 'waiting' placeholder files for every grid slot that has appeared since the last call
+
+    Parameters
+    ----------
+    session
+        A database Session
+    flow_type
+        The flow type that produces this grid of models
+    level
+        The level of the model files
+    model_keys
+        (file_type, observatory, polarization) for each model produced at every grid slot
+    t0
+        The first slot of the grid
+    increment
+        The spacing between grid slots
+    pipeline_config
+        The pipeline configuration
+    now
+        The current time, which bounds the grid
+
+    Returns
+    -------
+    int
+        The number of placeholder files that were added
+    """
+    encoded_keys = _encode_model_keys(model_keys)
+    spacing_seconds = increment.total_seconds()
+    grid = session.query(ModelGrid).where(ModelGrid.flow_type == flow_type).one_or_none()
+
+    if (grid is None or grid.t0 != t0 or grid.spacing_seconds != spacing_seconds
+            or grid.model_keys != encoded_keys or grid.last_slot is None):
+        # We don't know (or can't trust) how far the grid was built, so reconcile against the files table once. This
+        # is the same full scan every run used to do, but from here on we only have to look at new slots.
+        if grid is None:
+            grid = ModelGrid(flow_type=flow_type)
+            session.add(grid)
+        grid.t0, grid.spacing_seconds, grid.model_keys = t0, spacing_seconds, encoded_keys
+        first_index = 0
+        existing = (session.query(File.file_id, File.file_type, File.observatory, File.date_obs, File.state)
+                    .where(File.level == level)
+                    .where(File.file_type.in_({key[0] for key in model_keys}))
+                    .all())
+        existing_keys = {(row.file_type, row.observatory, row.date_obs) for row in existing}
+        session.execute(delete(ModelQueueEntry).where(ModelQueueEntry.flow_type == flow_type))
+        session.add_all([ModelQueueEntry(flow_type=flow_type, file_id=row.file_id, date_obs=row.date_obs)
+                         for row in existing if row.state == 'waiting'])
+    else:
+        first_index = round((grid.last_slot - t0) / increment) + 1
+        existing_keys = set()
+
+    slot_times = grid_slot_times(t0, increment, first_index, now)
+    new_models = []
+    for t in slot_times:
+        for file_type, observatory, polarization in model_keys:
+            if (file_type, observatory, t) in existing_keys:
+                continue
+            new_models.append(File(state='waiting',
+                                   level=level,
+                                   file_type=file_type,
+                                   observatory=observatory,
+                                   polarization=polarization,
+                                   date_obs=t,
+                                   date_created=datetime.now(),
+                                   file_version=pipeline_config["file_version"],
+                                   software_version=__version__))
+    session.add_all(new_models)
+    # Flush so the new placeholders have IDs we can queue
+    session.flush()
+    session.add_all([ModelQueueEntry(flow_type=flow_type, file_id=model.file_id, date_obs=model.date_obs)
+                     for model in new_models])
+    if slot_times:
+        grid.last_slot = slot_times[-1]
+    session.commit()
+    return len(new_models)
+
+
+def get_waiting_models(session, flow_type: str) -> list[File]:
+    """Returns the placeholder files still waiting to be produced for this flow type, most recent first
+
+    Queue entries whose placeholder is gone or no longer 'waiting' (e.g. it was scheduled or marked impossible) are
+    pruned along the way.
+    """
+    still_waiting = exists().where(and_(File.file_id == ModelQueueEntry.file_id, File.state == 'waiting'))
+    session.execute(delete(ModelQueueEntry)
+                    .where(ModelQueueEntry.flow_type == flow_type)
+                    .where(~still_waiting))
+    return (session.query(File)
+            .join(ModelQueueEntry, ModelQueueEntry.file_id == File.file_id)
+            .where(ModelQueueEntry.flow_type == flow_type)
+            .order_by(ModelQueueEntry.date_obs.desc())
+            .all())
+
+
+def dequeue_models(session, models: list[File]) -> None:
+    """Removes placeholder files from the waiting queue, e.g. because they've been scheduled"""
+    file_ids = [model.file_id for model in models]
+    if file_ids:
+        session.execute(delete(ModelQueueEntry).where(ModelQueueEntry.file_id.in_(file_ids)))
+
+
+def reset_model_grids(session, flow_types) -> None:
+    """Forgets how far these grids were built, so the next scheduler run reconciles them against the files table
+
+    This is needed whenever model files are deleted (e.g. when a flow is revived), since those slots are behind the
+    grid's high-water mark and would otherwise never be recreated.
+    """
+    flow_types = list(flow_types)
+    if flow_types:
+        session.execute(delete(ModelGrid).where(ModelGrid.flow_type.in_(flow_types)))
+
+
+def count_inputs_in_windows(session, slot_times: list[datetime], before: timedelta, after: timedelta,
+                            *criteria) -> tuple[np.ndarray, np.ndarray]:
+    """Counts input files in the windows on either side of many grid slots at once
+
+    Instead of issuing separate queries for each slot, this reads the `date_obs` of every matching file across the span
+    of all the windows in one index-range query, and then counts per window with a binary search.
+
+    Parameters
+    ----------
+    session
+        A database Session
+    slot_times
+        The center of each window
+    before
+        How far before each slot the first window extends
+    after
+        How far after each slot the second window extends
+    criteria
+        Filters selecting the input files
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The number of files with date_obs in [t - before, t] and in [t, t + after] for each slot time t
+    """
+    if not len(slot_times):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    dates = session.execute(select(File.date_obs)
+                            .where(*criteria)
+                            .where(File.date_obs >= min(slot_times) - before)
+                            .where(File.date_obs <= max(slot_times) + after)
+                            .order_by(File.date_obs.asc())).scalars().all()
+    dates = np.array(dates, dtype='datetime64[us]')
+    slots = np.array(slot_times, dtype='datetime64[us]')
+    window_starts = slots - np.timedelta64(before)
+    window_ends = slots + np.timedelta64(after)
+    n_before = np.searchsorted(dates, slots, side='right') - np.searchsorted(dates, window_starts, side='left')
+    n_after = np.searchsorted(dates, window_ends, side='right') - np.searchsorted(dates, slots, side='left')
+    return n_before, n_after
+
+
+def count_inputs_around_models(session, models: list[File], before: timedelta, after: timedelta, input_spec,
+                               *criteria) -> dict[File, tuple[int, int]]:
+    """Counts the inputs on either side of each model, with one query per kind of input
+
+    Parameters
+    ----------
+    session
+        A database Session
+    models
+        The placeholder model files
+    before
+        How far before each model the first window extends
+    after
+        How far after each model the second window extends
+    input_spec
+        A function giving (level, file_types, observatory) of the inputs to a model
+    criteria
+        Any further filters on the input files
+
+    Returns
+    -------
+    dict[File, tuple[int, int]]
+        The number of 'created' or 'progressed' inputs before and after each model
+    """
+    models_by_spec = defaultdict(list)
+    for model in models:
+        models_by_spec[input_spec(model)].append(model)
+    counts = {}
+    for (level, file_types, observatory), group in models_by_spec.items():
+        n_before, n_after = count_inputs_in_windows(
+            session, [model.date_obs for model in group], before, after,
+            File.state.in_(["created", "progressed"]),
+            File.level == level,
+            File.file_type.in_(file_types),
+            File.observatory == observatory,
+            *criteria)
+        counts.update(zip(group, zip(n_before.tolist(), n_after.tolist())))
+    return counts
@@ -7,6 +7,8 @@ from prefect import get_run_logger, tags
 from prefect.context import MissingContextError, get_run_context
 
 from punchpipe.control.db import File, Flow
+from punchpipe.control.health import register_flow_processes, unregister_flow_processes
+from punchpipe.control.profiling import finish_query_profile, start_query_profile
 from punchpipe.control.util import (
     get_database_session,
     load_pipeline_configuration,
@@ -24,6 +26,8 @@ def generic_process_flow_logic(flow_id: int | list[int], core_flow_to_launch, pi
     else:
         flow_ids = flow_id
 
+    profile = None
+    registered = False
     try:
         logger = get_run_logger()
         logger.info(f"Running under PID {os.getpid()}")
@@ -34,6 +38,7 @@ def generic_process_flow_logic(flow_id: int | list[int], core_flow_to_launch, pi
         flow_db_entries = session.query(Flow).where(Flow.flow_id.in_(flow_ids)).all()
         if len(flow_db_entries) != len(flow_ids):
             raise RuntimeError("Did not find the right number of flows")
+        profile = start_query_profile(session, pipeline_config, flow_db_entries[0].flow_type)
 
         file_db_entry_lists = []
 
@@ -47,7 +52,7 @@ def generic_process_flow_logic(flow_id: int | list[int], core_flow_to_launch, pi
             try:
                 flow_run_context = get_run_context()
                 flow_db_entry.flow_run_name = flow_run_context.flow_run.name
-                flow_db_entry.flow_run_id = flow_run_context.flow_run.id
+                flow_db_entry.flow_run_id = str(flow_run_context.flow_run.id)
             except MissingContextError:
                 # We're not in a flow context---probably we're running under speedster
                 pass
@@ -75,7 +80,9 @@ def generic_process_flow_logic(flow_id: int | list[int], core_flow_to_launch, pi
                 session.commit()
                 raise
             file_db_entry_lists.append(file_db_entry_list)
+        register_flow_processes(session, flow_db_entries)
         session.commit()
+        registered = True
 
         for flow_db_entry, file_db_entry_list in zip(flow_db_entries, file_db_entry_lists):
             # load the call data and launch the core flow
@@ -124,7 +131,14 @@ def generic_process_flow_logic(flow_id: int | list[int], core_flow_to_launch, pi
         session.query(Flow).filter(Flow.flow_id.in_(flow_ids)).update(
             {"state": "failed",
              "end_time": datetime.now()})
-        session.query(File).filter(File.processing_flow.in_(flow_ids)).update(
-            {"state": "failed"})
+        # Through the ORM rather than as a bulk update, so the state changes are journaled for the status summary
+        for file_db_entry in session.query(File).filter(File.processing_flow.in_(flow_ids)):
+            file_db_entry.state = "failed"
         session.commit()
         raise
+    finally:
+        if registered:
+            unregister_flow_processes(session, flow_ids)
+        if profile is not None:
+            profile.flow_run_name = flow_db_entries[0].flow_run_name
+            finish_query_profile(profile, session, pipeline_config, logger)
@@ -0,0 +1,146 @@
+"""Opt-in profiling of the SQL statements issued during a flow run
+
+Every engine made by `get_database_engine` is instrumented, but statements are only recorded while a profile is active
+(see `start_query_profile`), so the cost when profiling is off is a context-variable lookup per statement. Statements
+are grouped by a fingerprint with the literal values stripped out, so the same query with different parameters is
+counted together.
+"""
+import re
+import time
+import weakref
+from datetime import datetime
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from punchpipe.control.db import QueryProfile
+
+_active_profile = ContextVar("active_query_profile", default=None)
+_instrumented_engines = weakref.WeakSet()
+
+_FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def fingerprint_statement(statement: str) -> str:
+    """Reduces a SQL statement to its shape, replacing literal and parameter values (and lists of them) with ?"""
+    for pattern, replacement in _FINGERPRINT_PATTERNS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+@dataclass
+class StatementStats:
+    count: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    rows: int = 0
+
+
+class QueryProfiler:
+    """Collects statement timings for one flow run"""
+
+    def __init__(self, flow_type: str | None, flow_run_name: str | None):
+        self.flow_type = flow_type
+        self.flow_run_name = flow_run_name
+        self.statements = {}
+        self._token = None
+
+    def record(self, statement: str, elapsed: float, rows: int) -> None:
+        stats = self.statements.setdefault(fingerprint_statement(statement), StatementStats())
+        stats.count += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        stats.rows += max(rows, 0)
+
+    def top(self, n: int) -> list[tuple[str, StatementStats]]:
+        return sorted(self.statements.items(), key=lambda item: item[1].total_time, reverse=True)[:n]
+
+    def summary(self, n: int) -> str:
+        n_statements = sum(stats.count for stats in self.statements.values())
+        total_time = sum(stats.total_time for stats in self.statements.values())
+        header = (f"Ran {n_statements} SQL statements ({len(self.statements)} distinct) taking {total_time:.3f} s. "
+                  f"Top {min(n, len(self.statements))} by total time:")
+        lines = [header]
+        for statement, stats in self.top(n):
+            lines.append(f"{stats.total_time:8.3f} s total, {stats.max_time:7.3f} s max, {stats.count:6d} calls, "
+                         f"{stats.rows:8d} rows: {statement[:300]}")
+        return "\n".join(lines)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active_profile.get() is not None:
+        conn.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _active_profile.get()
+    start_times = conn.info.get("query_start_times")
+    if profile is None or not start_times:
+        return
+    profile.record(statement, time.perf_counter() - start_times.pop(), cursor.rowcount)
+
+
+def instrument_engine(engine) -> None:
+    """Attaches the profiling hooks to an engine, if they aren't already attached"""
+    if engine in _instrumented_engines:
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    _instrumented_engines.add(engine)
+
+
+def start_query_profile(session, pipeline_config: dict, flow_type: str | None = None,
+                        flow_run_name: str | None = None) -> QueryProfiler | None:
+    """Starts recording the statements run in this context, if profiling is enabled in the configuration"""
+    if not pipeline_config.get("profiling", {}).get("enabled", False):
+        return None
+    instrument_engine(session.get_bind())
+    profile = QueryProfiler(flow_type, flow_run_name)
+    profile._token = _active_profile.set(profile)
+    return profile
+
+
+def finish_query_profile(profile: QueryProfiler | None, session, pipeline_config: dict, logger) -> None:
+    """Stops recording, logs the most expensive statements, and saves the profile to the database"""
+    if profile is None:
+        return
+    _active_profile.reset(profile._token)
+    if not profile.statements:
+        return
+    logger.info(profile.summary(pipeline_config["profiling"].get("top_n", 10)))
+    now = datetime.now()
+    try:
+        session.add_all([QueryProfile(recorded_at=now, flow_type=profile.flow_type,
+                                      flow_run_name=profile.flow_run_name, fingerprint=statement, count=stats.count,
+                                      total_time=stats.total_time, max_time=stats.max_time, rows=stats.rows)
+                         for statement, stats in profile.statements.items()])
+        session.commit()
+    except SQLAlchemyError as e:
+        # A profile is never worth failing (or masking the failure of) the flow it describes
+        session.rollback()
+        logger.warning(f"Could not save the query profile: {e}")
+
+
+def get_top_statements(session, since: datetime, n: int = 20, flow_type: str | None = None) -> list:
+    """Aggregates the saved profiles since some time, returning the statements that took the most total time"""
+    query = (select(QueryProfile.fingerprint,
+                    func.sum(QueryProfile.count).label("count"),
+                    func.sum(QueryProfile.total_time).label("total_time"),
+                    func.max(QueryProfile.max_time).label("max_time"),
+                    func.sum(QueryProfile.rows).label("rows"),
+                    func.count(func.distinct(QueryProfile.flow_run_name)).label("n_runs"))
+             .where(QueryProfile.recorded_at >= since)
+             .group_by(QueryProfile.fingerprint)
+             .order_by(func.sum(QueryProfile.total_time).desc())
+             .limit(n))
+    if flow_type is not None:
+        query = query.where(QueryProfile.flow_type == flow_type)
+    return session.execute(query).all()
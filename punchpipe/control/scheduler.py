@@ -1,12 +1,54 @@
 import inspect
+import functools
 import itertools
 from datetime import UTC, datetime, timedelta
 
 from prefect import get_run_logger
+from prefect.context import MissingContextError, get_run_context
 
 from punchpipe.control.db import File, FileRelationship, Flow
+from punchpipe.control.profiling import finish_query_profile, start_query_profile
 from punchpipe.control.util import get_database_session, load_pipeline_configuration
 
+# How far behind the primary a replica can be for the scheduler's read-only queries
+MAX_STALENESS_SECONDS = 10
+
+
+def profile_scheduler_flow(scheduler_flow):
+    """Records the SQL statements of a whole scheduler flow run, if profiling is enabled
+
+    Apply this beneath ``@flow``. The profile covers the entire flow body, so it includes any input checks a scheduler
+    makes before (or instead of) calling `generic_scheduler_flow_logic`.
+    """
+    flow_type = scheduler_flow.__name__.replace("_scheduler_flow", "")
+    signature = inspect.signature(scheduler_flow)
+
+    @functools.wraps(scheduler_flow)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        pipeline_config = arguments.get("pipeline_config_path")
+        if not isinstance(pipeline_config, dict):
+            pipeline_config = load_pipeline_configuration(pipeline_config)
+        if not pipeline_config.get("profiling", {}).get("enabled", False):
+            return scheduler_flow(*args, **kwargs)
+
+        try:
+            flow_run_name = get_run_context().flow_run.name
+        except MissingContextError:
+            # We're not in a flow context, e.g. we're being called directly
+            flow_run_name = None
+        session = arguments.get("session")
+        profile_session = session if session is not None else get_database_session()
+        profile = start_query_profile(profile_session, pipeline_config, flow_type, flow_run_name)
+        try:
+            return scheduler_flow(*args, **kwargs)
+        finally:
+            finish_query_profile(profile, profile_session, pipeline_config, get_run_logger())
+            if profile_session is not session:
+                profile_session.close()
+
+    return wrapper
+
 
 def generic_scheduler_flow_logic(
     query_ready_files_func, construct_child_file_info, construct_child_flow_info, pipeline_config,
@@ -57,31 +99,40 @@ def generic_scheduler_flow_logic(
 
     if session is None:
         session = get_database_session()
+        # For queries that only inform how much to schedule, a slightly-behind replica is fine
+        read_session = get_database_session(read_only=True, max_staleness=MAX_STALENESS_SECONDS)
+    else:
+        read_session = session
 
     # Extract the calling flow's type from the name of the calling function. The calling function's name is fixed by
     # the logic in cli.py that finds the code for a flow named in the configuration file.
     calling_function = inspect.currentframe().f_back.f_code.co_qualname
-    if "_scheduler_flow" in calling_function:
-        flow_type = calling_function.replace('_scheduler_flow', '')
-        logger.info(f"This is flow type {flow_type}")
-        if not pipeline_config["flows"][flow_type].get("enabled", True):
-            logger.info(f"Flow {flow_type} is not enabled---halting scheduler")
-            return 0
-        if cap_planned_flows:
-            n_already_scheduled = (session.query(Flow)
-                                          .where(Flow.flow_type == flow_type)
-                                          .where(Flow.state == 'planned')
-                                          .count())
-            if n_already_scheduled >= max_start:
-                logger.info(f"This flow already has {n_already_scheduled} flows scheduled; stopping.")
+    try:
+        if "_scheduler_flow" in calling_function:
+            flow_type = calling_function.replace('_scheduler_flow', '')
+            logger.info(f"This is flow type {flow_type}")
+            if not pipeline_config["flows"][flow_type].get("enabled", True):
+                logger.info(f"Flow {flow_type} is not enabled---halting scheduler")
                 return 0
-            max_start -= n_already_scheduled
-            logger.info(f"{n_already_scheduled} flows already scheduled; will schedule up to {max_start} more.")
-
-    # Not every level*_query_ready_files function needs this max_n parameter---some instead have a use_n that's similar
-    # at first glance, but fills a different role and needs to be tuned differently. To avoid confusion there, we don't
-    # require every implementation to accept a max_n parameter---instead, we send that parameter only to those functions
-    # that accept it.
+            if cap_planned_flows:
+                n_already_scheduled = (read_session.query(Flow)
+                                       .where(Flow.flow_type == flow_type)
+                                       .where(Flow.state == 'planned')
+                                       .count())
+                if n_already_scheduled >= max_start:
+                    logger.info(f"This flow already has {n_already_scheduled} flows scheduled; stopping.")
+                    return 0
+                max_start -= n_already_scheduled
+                logger.info(f"{n_already_scheduled} flows already scheduled; will schedule up to {max_start} more.")
+    finally:
+        # The early returns above mustn't leave the replica session's connection checked out
+        if read_session is not session:
+            read_session.close()
+
+    # Not every level*_query_ready_files function needs this max_n parameter---some instead have a use_n that's
+    # similar at first glance, but fills a different role and needs to be tuned differently. To avoid confusion
+    # there, we don't require every implementation to accept a max_n parameter---instead, we send that parameter
+    # only to those functions that accept it.
     if 'max_n' in inspect.signature(query_ready_files_func).parameters:
         extra_args = {'max_n': max_start}
     else:
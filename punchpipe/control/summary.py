@@ -0,0 +1,198 @@
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+from prefect import flow, get_run_logger, task
+from prefect.cache_policies import NO_CACHE
+from sqlalchemy import delete, func, insert, select
+
+from punchpipe.control.db import (
+    File,
+    FileHourlyCounts,
+    FileStateChange,
+    FileStatusSummary,
+    Flow,
+    FlowHourlyStats,
+    FlowStatusSummary,
+    SummaryProgress,
+)
+from punchpipe.control.util import get_database_session, load_pipeline_configuration
+
+
+def floor_hour(time: datetime) -> datetime:
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def get_progress(session, job: str) -> datetime | None:
+    return session.execute(select(SummaryProgress.done_until).where(SummaryProgress.job == job)).scalar()
+
+
+def set_progress(session, job: str, done_until: datetime) -> None:
+    """Records how far a job has got. The caller commits."""
+    session.merge(SummaryProgress(job=job, done_until=done_until))
+
+
+def delete_file_state_changes(session, change_ids: list[int], batch_size: int = 10_000) -> None:
+    for i in range(0, len(change_ids), batch_size):
+        session.execute(delete(FileStateChange).where(FileStateChange.change_id.in_(change_ids[i:i + batch_size])))
+
+
+@task(cache_policy=NO_CACHE)
+def summarize_flow_states(session, now: datetime) -> int:
+    """Recounts the flows in each state for the monitor's status cards"""
+    # Two queries, rather than one with an OR, so that each can use its own index
+    planned = (session.execute(select(Flow.flow_level, Flow.flow_type, Flow.state, func.count())
+                               .where(Flow.state.in_(("planned", "launched")))
+                               .group_by(Flow.flow_level, Flow.flow_type, Flow.state))
+               .all())
+    recent = (session.execute(select(Flow.flow_level, Flow.flow_type, Flow.state, func.count())
+                              .where(Flow.start_time > now - timedelta(hours=24))
+                              .group_by(Flow.flow_level, Flow.flow_type, Flow.state))
+              .all())
+    counts = defaultdict(int)
+    for level, flow_type, state, count in planned + recent:
+        # A flow that's been reset to planned can still have its start time from a previous attempt
+        counts[(level, flow_type, state)] = max(counts[(level, flow_type, state)], count)
+    rows = [{"flow_level": level, "flow_type": flow_type, "state": state, "count": count, "updated_at": now}
+            for (level, flow_type, state), count in counts.items()]
+    session.execute(delete(FlowStatusSummary))
+    if rows:
+        session.execute(insert(FlowStatusSummary), rows)
+    session.commit()
+    return len(rows)
+
+
+@task(cache_policy=NO_CACHE)
+def apply_file_state_changes(session, now: datetime) -> int:
+    """Applies the journaled changes in the number of files in each state to the monitor's status counts, returning how
+    many changes there were"""
+    session.commit()
+    changes = session.execute(select(FileStateChange.change_id, FileStateChange.level, FileStateChange.file_type,
+                                     FileStateChange.state, FileStateChange.delta)).all()
+    if not changes:
+        return 0
+    deltas = defaultdict(int)
+    for _, level, file_type, state, delta in changes:
+        deltas[(level, file_type, state)] += delta
+    summaries = {(row.level, row.file_type, row.state): row
+                 for row in session.execute(select(FileStatusSummary)).scalars()}
+    for (level, file_type, state), delta in deltas.items():
+        if delta == 0:
+            continue
+        summary = summaries.get((level, file_type, state))
+        if summary is None:
+            session.add(FileStatusSummary(level=level, file_type=file_type, state=state, count=delta, updated_at=now))
+        elif summary.count + delta == 0:
+            session.delete(summary)
+        else:
+            summary.count += delta
+            summary.updated_at = now
+    delete_file_state_changes(session, [change_id for change_id, *_ in changes])
+    session.commit()
+    return len(changes)
+
+
+@task(cache_policy=NO_CACHE)
+def recount_file_states(session, now: datetime) -> int:
+    """Recounts the files in each state from scratch, catching any changes that weren't journaled
+
+    The journal is read in the same transaction as the files, so (with MariaDB's default repeatable-read isolation)
+    the changes cleared from it are exactly those already reflected in the new counts.
+    """
+    session.commit()
+    change_ids = session.execute(select(FileStateChange.change_id)).scalars().all()
+    counts = (session.execute(select(File.level, File.file_type, File.state, func.count())
+                              .group_by(File.level, File.file_type, File.state))
+              .all())
+    rows = [{"level": level, "file_type": file_type, "state": state, "count": count, "updated_at": now}
+            for level, file_type, state, count in counts]
+    session.execute(delete(FileStatusSummary))
+    if rows:
+        session.execute(insert(FileStatusSummary), rows)
+    delete_file_state_changes(session, change_ids)
+    set_progress(session, "file_status_recount", now)
+    session.commit()
+    return len(rows)
+
+
+@task(cache_policy=NO_CACHE)
+def update_hourly_stats(session, now: datetime, lookback_hours: float, backfill_days: float) -> datetime:
+    """Rebuilds the hourly flow and file statistics from the most recent hours
+
+    Flows get their end time and files their creation time as they finish, so only the latest hours change. Each run
+    rebuilds the hours since the previous run, less a margin of `lookback_hours`, or the last `backfill_days` on the
+    first run.
+    """
+    latest = get_progress(session, "hourly_stats")
+    if latest is None:
+        latest = now - timedelta(days=backfill_days)
+    start = floor_hour(latest - timedelta(hours=lookback_hours))
+
+    flow_stats = defaultdict(lambda: [0, 0.0])
+    finished_flows = session.execute(select(Flow.flow_type, Flow.state, Flow.start_time, Flow.end_time)
+                                     .where(Flow.end_time >= start)).all()
+    for flow_type, state, start_time, end_time in finished_flows:
+        stats = flow_stats[(floor_hour(end_time), flow_type, state)]
+        stats[0] += 1
+        if start_time is not None:
+            stats[1] += (end_time - start_time).total_seconds()
+
+    file_counts = defaultdict(int)
+    created_files = session.execute(select(File.level, File.file_type, File.observatory, File.date_created)
+                                    .where(File.date_created >= start)).all()
+    for level, file_type, observatory, date_created in created_files:
+        file_counts[(floor_hour(date_created), level, file_type, observatory)] += 1
+
+    session.execute(delete(FlowHourlyStats).where(FlowHourlyStats.hour >= start))
+    session.execute(delete(FileHourlyCounts).where(FileHourlyCounts.hour >= start))
+    if flow_stats:
+        session.execute(insert(FlowHourlyStats),
+                        [{"hour": hour, "flow_type": flow_type, "state": state, "count": count,
+                          "total_duration": duration}
+                         for (hour, flow_type, state), (count, duration) in flow_stats.items()])
+    if file_counts:
+        session.execute(insert(FileHourlyCounts),
+                        [{"hour": hour, "level": level, "file_type": file_type, "observatory": observatory,
+                          "count": count}
+                         for (hour, level, file_type, observatory), count in file_counts.items()])
+    set_progress(session, "hourly_stats", now)
+    session.commit()
+    return start
+
+
+@task(cache_policy=NO_CACHE)
+def expire_hourly_stats(session, now: datetime, retention_days: float) -> None:
+    cutoff = now - timedelta(days=retention_days)
+    session.execute(delete(FlowHourlyStats).where(FlowHourlyStats.hour < cutoff))
+    session.execute(delete(FileHourlyCounts).where(FileHourlyCounts.hour < cutoff))
+    session.commit()
+
+
+@flow
+def summarizer(pipeline_config_path: str, session=None):
+    """Refreshes the summary tables read by the monitor and the watchdog"""
+    logger = get_run_logger()
+
+    pipeline_config = load_pipeline_configuration(pipeline_config_path)
+    summarizer_config = pipeline_config['control'].get('summarizer', {})
+    if session is None:
+        session = get_database_session()
+
+    now = datetime.now()
+    n_flow_rows = summarize_flow_states(session, now)
+    last_recount = get_progress(session, "file_status_recount")
+    if last_recount is None or now - last_recount >= timedelta(hours=summarizer_config.get('recount_hours', 24)):
+        n_file_rows = recount_file_states(session, now)
+        logger.info(f"Recounted {n_file_rows} file status groups")
+    n_changes = apply_file_state_changes(session, now)
+    start = update_hourly_stats(session, now,
+                                summarizer_config.get('lookback_hours', 1),
+                                summarizer_config.get('backfill_days', 7))
+    logger.info(f"Summarized {n_flow_rows} flow status groups, applied {n_changes} file state changes, and rebuilt "
+                f"hourly stats since {start}")
+
+    retention_days = summarizer_config.get('retention_days', -1)
+    if retention_days < 0:
+        logger.warning("There is no retention_days option for the summarizer in the config, so keeping all hourly "
+                       "stats.")
+    else:
+        expire_hourly_stats(session, now, retention_days)
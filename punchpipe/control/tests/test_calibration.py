@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+from pytest_mock_resources import create_mysql_fixture
+
+from punchpipe.control.calibration import compare_weights, measure_flow_types, recommend_weight
+from punchpipe.control.db import Base, Flow, FlowResources, FlowWeight, ResourceUsage
+from punchpipe.control.health import MACHINE, MINUTE
+from punchpipe.control.launcher import load_flow_data
+
+NOW = datetime(2025, 6, 1, 12)
+
+
+def add_flow_resources(session, flows, cpu_seconds, rss):
+    session.flush()
+    for flow in flows:
+        session.add(FlowResources(flow_id=flow.flow_id, flow_type=flow.flow_type, finished_at=flow.end_time,
+                                  cpu_seconds=cpu_seconds, rss=rss))
+
+
+def session_fn(session):
+    level1_flows = []
+    for i in range(10):
+        start = NOW - timedelta(hours=1, minutes=i)
+        level1_flows.append(Flow(flow_level="1", flow_type="level1", state="completed", creation_time=start,
+                                 start_time=start, end_time=start + timedelta(seconds=60 + 10 * i), priority=1))
+    level1_flows.append(Flow(flow_level="1", flow_type="level1", state="failed", creation_time=NOW, start_time=NOW,
+                             end_time=NOW + timedelta(seconds=1), priority=1))
+    session.add_all(level1_flows)
+    add_flow_resources(session, level1_flows, cpu_seconds=100, rss=1e9)
+    # Too old to count
+    session.add(Flow(flow_level="1", flow_type="level1", state="completed", creation_time=NOW - timedelta(days=30),
+                     start_time=NOW - timedelta(days=30), end_time=NOW - timedelta(days=29), priority=1))
+    # No resource usage recorded for these
+    session.add(Flow(flow_level="2", flow_type="level2", state="completed", creation_time=NOW, start_time=NOW,
+                     end_time=NOW + timedelta(seconds=5), priority=1))
+    # Batches of four flows, each batch run by one process
+    levelq_flows = []
+    for i in range(8):
+        start = NOW - timedelta(hours=1)
+        levelq_flows.append(Flow(flow_level="Q", flow_type="levelq_CNN", state="completed", creation_time=start,
+                                 start_time=start, end_time=start + timedelta(seconds=100), priority=1,
+                                 flow_run_name=f"run-{i // 4}"))
+    session.add_all(levelq_flows)
+    add_flow_resources(session, levelq_flows, cpu_seconds=100, rss=5e8)
+    # Flows too short for the health monitor to ever sample
+    level0_flows = []
+    for i in range(30):
+        start = NOW - timedelta(hours=1, minutes=i)
+        level0_flows.append(Flow(flow_level="0", flow_type="level0", state="completed", creation_time=start,
+                                 start_time=start, end_time=start + timedelta(seconds=2), priority=1))
+    session.add_all(level0_flows)
+    add_flow_resources(session, level0_flows, cpu_seconds=4, rss=2e9)
+    session.add(ResourceUsage(period_seconds=MINUTE, period_start=NOW - timedelta(hours=1), hostname="host",
+                              flow_type="levelq_CNN", n_samples=4, n_processes=2, mean_rss=8e9, max_rss=8e9,
+                              cpu_seconds=800, read_bytes=0, write_bytes=0))
+    for minute, n_processes, max_rss, cpu_seconds in [(0, 2, 4e9, 300), (1, 1, 3e9, 250), (2, 4, 4e9, 550)]:
+        for flow_type in ["level1", MACHINE]:
+            session.add(ResourceUsage(period_seconds=MINUTE, period_start=NOW - timedelta(hours=1, minutes=minute),
+                                      hostname="host", flow_type=flow_type, n_samples=4, n_processes=n_processes,
+                                      mean_rss=max_rss, max_rss=max_rss, cpu_seconds=cpu_seconds, read_bytes=0,
+                                      write_bytes=0))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
+
+def test_measure_flow_types(db):
+    measurements = measure_flow_types.fn(db, NOW - timedelta(days=7))
+    assert set(measurements) == {"level0", "level1", "levelq_CNN"}
+    level1 = measurements["level1"]
+    assert level1["n_flows"] == 10
+    assert abs(level1["duration_p50"] - 105) < 0.1
+    # Each of the 11 flows that finished used 100 CPU seconds, running for 105 s on average
+    assert abs(level1["cpu_seconds"] - 100) < 1e-6
+    assert abs(level1["cores"] - 100 / 105) < 1e-3
+    assert level1["peak_rss"] == 3e9
+
+
+def test_measure_flow_types_batched(db):
+    levelq = measure_flow_types.fn(db, NOW - timedelta(days=7))["levelq_CNN"]
+    # Each of the two processes peaked at 4 GB, running a batch of four flows
+    assert levelq["peak_rss"] == 1e9
+    assert levelq["cpu_seconds"] == 100
+    assert recommend_weight(levelq, memory_per_weight=1e9, min_weight=0.1) == 1
+
+
+def test_measure_flow_types_unsampled(db):
+    level0 = measure_flow_types.fn(db, NOW - timedelta(days=7))["level0"]
+    # Every flow recorded what it used, though none was ever sampled
+    assert level0["cpu_seconds"] == 4
+    assert abs(level0["cores"] - 2) < 1e-3
+    assert level0["peak_rss"] == 2e9
+
+
+def test_recommend_weight():
+    measurement = dict(cores=0.9, peak_rss=2e9)
+    assert recommend_weight(measurement, memory_per_weight=4e9, min_weight=0.1) == 0.9
+    assert recommend_weight(measurement, memory_per_weight=1e9, min_weight=0.1) == 2
+    assert recommend_weight(dict(cores=0.01, peak_rss=0), memory_per_weight=1e9, min_weight=0.1) == 0.1
+
+
+def test_auto_launch_weights(db):
+    pipeline_config = {"flows": {"level1": {"launch_weight": "auto"}, "level2": {"launch_weight": 2}}}
+    assert load_flow_data(pipeline_config, db)[0] == {"level1": 1, "level2": 2}
+
+    db.add(FlowWeight(flow_type="level1", computed_at=NOW, n_flows=10, duration_p50=100, duration_p90=150,
+                      duration_p99=160, cpu_seconds=100, cores=1, peak_rss=3e9, weight=1.5))
+    db.commit()
+    assert load_flow_data(pipeline_config, db)[0] == {"level1": 1.5, "level2": 2}
+
+    rows = {row["flow_type"]: row for row in compare_weights(pipeline_config, db)}
+    assert rows["level1"]["learned"] == 1.5
+    assert "learned" not in rows["level2"]
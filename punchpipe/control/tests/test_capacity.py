@@ -0,0 +1,63 @@
+import time
+import logging
+from datetime import datetime, timedelta
+
+from pytest_mock_resources import create_mysql_fixture
+
+from punchpipe.control.capacity import CAPACITY_DEFAULTS, adjust_capacity, get_launch_capacity, measure_pressure
+from punchpipe.control.db import Base, LaunchCapacity
+
+CONFIG = {**CAPACITY_DEFAULTS, "min_weight_running": 20, "max_weight_running": 100}
+CALM = {"cpu": 50, "memory": 40, "iowait": 2}
+
+
+def test_adjust_capacity():
+    # Pressure on any resource cuts capacity, unless the running weight is still draining down to it
+    assert adjust_capacity(50, 50, {**CALM, "memory": 90}, CONFIG, 0) == (40, "lower", "memory 90% > 85%")
+    assert adjust_capacity(50, 60, {**CALM, "memory": 90}, CONFIG, 1000)[:2] == (50, "hold")
+    assert adjust_capacity(22, 22, {**CALM, "iowait": 40}, CONFIG, 1000)[:2] == (20, "lower")
+    assert adjust_capacity(20, 20, {**CALM, "iowait": 40}, CONFIG, 1000)[:2] == (20, "hold")
+
+    # Capacity only grows when the machine is quiet, capacity is what's holding back launches, and it hasn't just changed
+    assert adjust_capacity(50, 48, CALM, CONFIG, 1000)[:2] == (55, "raise")
+    assert adjust_capacity(50, 30, CALM, CONFIG, 1000)[:2] == (50, "hold")
+    assert adjust_capacity(50, 48, CALM, CONFIG, 60)[:2] == (50, "hold")
+    assert adjust_capacity(50, 48, {**CALM, "cpu": 90}, CONFIG, 1000)[:2] == (50, "hold")
+    assert adjust_capacity(100, 100, CALM, CONFIG, 1000)[:2] == (100, "hold")
+
+    # The configured bounds win over a previous decision
+    assert adjust_capacity(200, 0, {**CALM, "cpu": 90}, CONFIG, 1000)[0] == 100
+
+
+db = create_mysql_fixture(Base, session=True)
+
+
+def test_get_launch_capacity(db):
+    launcher_config = {"max_weight_running": 50}
+    logger = logging.getLogger()
+    assert get_launch_capacity(db, launcher_config, 10, logger) == 50
+    assert db.query(LaunchCapacity).count() == 0
+
+    launcher_config["adaptive_capacity"] = {"enabled": True, "min_weight_running": 20, "max_weight_running": 100,
+                                            "memory_high": 101, "cpu_high": 101, "iowait_high": 101}
+    now = datetime(2025, 6, 1, 12)
+    capacity = get_launch_capacity(db, launcher_config, 10, logger, now)
+    assert capacity == 50
+    decision = db.query(LaunchCapacity).one()
+    assert decision.previous_weight == 50
+    assert decision.action == "hold"
+
+    # Until the interval has passed, the last decision stands
+    db.query(LaunchCapacity).update({"max_weight_running": 30})
+    db.commit()
+    assert get_launch_capacity(db, launcher_config, 10, logger, now + timedelta(seconds=10)) == 30
+    get_launch_capacity(db, launcher_config, 10, logger, now + timedelta(seconds=40))
+    assert db.query(LaunchCapacity).count() == 2
+
+
+def test_measure_pressure_does_not_block(db):
+    start = time.monotonic()
+    pressure = measure_pressure(db, datetime.now(), 5)
+    # The launcher is async, so a blocking measurement would stall its pending submissions
+    assert time.monotonic() - start < 0.5
+    assert set(pressure) == {"cpu", "memory", "iowait"}
@@ -1,5 +1,6 @@
 import os
 import asyncio
+import logging
 from datetime import datetime, timedelta
 
 import pytest
@@ -7,9 +8,20 @@ import yaml
 from prefect.logging import disable_run_logger
 from prefect.testing.utilities import prefect_test_harness
 from pytest_mock_resources import create_mysql_fixture
-
-from punchpipe.control.cleaner import cleaner
-from punchpipe.control.db import Base, File, FileRelationship, Flow
+from sqlalchemy import select
+
+from punchpipe.control.cleaner import archive_old_flows, archive_old_packets, cleaner
+from punchpipe.control.db import (
+    ENG_CEB,
+    PACKETNAME2ARCHIVE,
+    SCI_XFI,
+    Base,
+    File,
+    FileRelationship,
+    Flow,
+    FlowAll,
+    FlowArchive,
+)
 from punchpipe.control.util import load_pipeline_configuration
 
 loop: asyncio.AbstractEventLoop
@@ -327,3 +339,71 @@ async def test_reset_L2(db, tmpdir, populated_tmpdir_config):
 
     relationships = db.query(FileRelationship).filter(FileRelationship.child == reset_file.file_id).all()
     assert len(relationships) == 0
+
+
+def test_archive_old_flows(db):
+    old = datetime.now() - timedelta(days=60)
+    for state in ["completed", "completed", "failed"]:
+        db.add(Flow(flow_level="1", flow_type="level1", state=state, creation_time=old, end_time=old, priority=1))
+    for state in ["planned", "running"]:
+        db.add(Flow(flow_level="1", flow_type="level1", state=state, creation_time=old, priority=1))
+    # Planned long ago, but only just finished
+    db.add(Flow(flow_level="1", flow_type="level1", state="completed", creation_time=old, end_time=datetime.now(),
+                priority=1))
+    db.commit()
+    hot_flow_ids = [f.flow_id for f in db.query(Flow).all()]
+    archived_ids = [f.flow_id for f in db.query(Flow).where(Flow.end_time == old).all()]
+
+    config = load_pipeline_configuration(os.path.join(TEST_DIR, "punchpipe_config.yaml"))
+    archive_old_flows.fn(logging.getLogger(), db, config)
+
+    assert sorted(f.flow_id for f in db.query(FlowArchive).all()) == sorted(archived_ids)
+    assert sorted(f.flow_id for f in db.query(Flow).all()) == sorted(set(hot_flow_ids) - set(archived_ids))
+
+
+def test_archived_flows_still_resolve(db):
+    old = datetime.now() - timedelta(days=60)
+    flow = Flow(flow_level="1", flow_type="level1", state="completed", creation_time=old, end_time=old, priority=1)
+    db.add(flow)
+    db.commit()
+    file = File(level="1", file_type="PM", observatory="1", state="created", file_version="1", software_version="1",
+                date_obs=old, processing_flow=flow.flow_id)
+    db.add(file)
+    db.commit()
+    flow_id, file_id = flow.flow_id, file.file_id
+
+    config = load_pipeline_configuration(os.path.join(TEST_DIR, "punchpipe_config.yaml"))
+    archive_old_flows.fn(logging.getLogger(), db, config)
+    assert db.execute(select(Flow).where(Flow.flow_id == flow_id)).first() is None
+
+    # As the monitor's files page joins files to the flows that made them
+    flow_type = db.execute(select(FlowAll.flow_type)
+                           .join(File, File.processing_flow == FlowAll.flow_id)
+                           .where(File.file_id == file_id)).scalar()
+    assert flow_type == "level1"
+
+
+def test_archive_old_packets(db):
+    now = datetime.now()
+    packet_info = dict(tlm_id=1, spacecraft_id=1, packet_index=0, ccsds_sequence_count=0, ccsds_packet_length=0)
+    science_info = dict(flash_block=0, compression_settings=0, acquisition_settings=0, packet_group=0)
+    old_used = SCI_XFI(timestamp=now - timedelta(days=10), is_used=True, **packet_info, **science_info)
+    old_unused = SCI_XFI(timestamp=now - timedelta(days=10), is_used=False, **packet_info, **science_info)
+    new_used = SCI_XFI(timestamp=now - timedelta(days=1), is_used=True, **packet_info, **science_info)
+    oldest_eng = ENG_CEB(timestamp=now - timedelta(days=40), **packet_info)
+    old_eng = ENG_CEB(timestamp=now - timedelta(days=30), **packet_info)
+    recent_eng = ENG_CEB(timestamp=now - timedelta(days=5), **packet_info)
+    # This spacecraft hasn't sent a packet in a long time, so its only one is still its current state
+    quiet_eng = ENG_CEB(timestamp=now - timedelta(days=60), **{**packet_info, "spacecraft_id": 2})
+    db.add_all([old_used, old_unused, new_used, oldest_eng, old_eng, recent_eng, quiet_eng])
+    db.commit()
+    old_used_id, oldest_eng_id = old_used.id, oldest_eng.id
+
+    config = load_pipeline_configuration(os.path.join(TEST_DIR, "punchpipe_config.yaml"))
+    archive_old_packets.fn(logging.getLogger(), db, config)
+
+    assert sorted(p.id for p in db.query(SCI_XFI).all()) == sorted([old_unused.id, new_used.id])
+    # The most recent engineering packet before the cutoff is kept for each spacecraft
+    assert sorted(p.id for p in db.query(ENG_CEB).all()) == sorted([old_eng.id, recent_eng.id, quiet_eng.id])
+    assert db.execute(select(PACKETNAME2ARCHIVE["SCI_XFI"].c.id)).scalars().all() == [old_used_id]
+    assert db.execute(select(PACKETNAME2ARCHIVE["ENG_CEB"].c.id)).scalars().all() == [oldest_eng_id]
@@ -0,0 +1,13 @@
+import os
+
+from punchpipe.cli import construct_flows_to_serve
+from punchpipe.control.util import load_pipeline_configuration
+
+REPO_CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "config.yaml")
+
+
+def test_construct_control_flows_from_repo_config():
+    # Every key under `control` in the shipped config has to be a control flow, or serving the control flows fails
+    flows = construct_flows_to_serve(REPO_CONFIG_PATH, include_data=False, include_control=True)
+    config = load_pipeline_configuration(REPO_CONFIG_PATH)
+    assert sorted(flow.name for flow in flows) == sorted(config["control"])
@@ -0,0 +1,134 @@
+import ast
+from pathlib import Path
+from datetime import datetime
+
+from pytest_mock_resources import create_mysql_fixture
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, literal, select
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+
+from punchpipe.control.db import FILE_STATES, Base, CodedString, Flow, FlowAll, FlowArchive, seconds_between
+
+REPO_DIR = Path(__file__).parents[3]
+
+
+def session_fn(session):
+    now = datetime(2025, 1, 1)
+    session.add(Flow(flow_id=1, flow_level="1", flow_type="level1", state="planned", creation_time=now, priority=1))
+    session.add(FlowArchive(flow_id=2, flow_level="1", flow_type="level1", state="completed", creation_time=now,
+                            priority=1))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
+
+def test_coded_string_round_trip():
+    for column_type, values in [(CodedString(2), ["CR", "PM", "X", ""]),
+                                (CodedString(1), ["0", "Q", "4"]),
+                                (CodedString(values=FILE_STATES), FILE_STATES)]:
+        for value in values:
+            assert column_type.decode(column_type.encode(value)) == value
+
+
+def _is_file_state(node) -> bool:
+    return (isinstance(node, ast.Attribute) and node.attr == "state"
+            and isinstance(node.value, ast.Name) and node.value.id == "File")
+
+
+def _involves_files_table(node) -> bool:
+    """Whether a query or update chain is built from `query(File)` or `update(File)`"""
+    return any(isinstance(n, ast.Call) and n.args and isinstance(n.args[0], ast.Name) and n.args[0].id == "File"
+               and ((isinstance(n.func, ast.Attribute) and n.func.attr == "query")
+                    or (isinstance(n.func, ast.Name) and n.func.id == "update"))
+               for n in ast.walk(node))
+
+
+def _strings(node) -> list[str]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return [value for element in node.elts for value in _strings(element)]
+    return []
+
+
+def find_file_states(tree) -> set[str]:
+    """Collects the state strings a module writes to, or compares against, the files table's state column"""
+    states = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id == "File":
+                states.update(s for kw in node.keywords if kw.arg == "state" for s in _strings(kw.value))
+            elif isinstance(node.func, ast.Attribute) and _is_file_state(node.func.value) and node.func.attr == "in_":
+                states.update(s for arg in node.args for s in _strings(arg))
+            elif (isinstance(node.func, ast.Attribute) and node.func.attr in ("update", "values")
+                  and _involves_files_table(node.func.value)):
+                states.update(s for kw in node.keywords if kw.arg == "state" for s in _strings(kw.value))
+                for arg in node.args:
+                    if isinstance(arg, ast.Dict):
+                        states.update(s for key, value in zip(arg.keys, arg.values)
+                                      if _strings(key) == ["state"] for s in _strings(value))
+            states.update(s for kw in node.keywords if kw.arg == "new_input_file_state" for s in _strings(kw.value))
+        elif isinstance(node, ast.Compare) and _is_file_state(node.left):
+            states.update(s for comparator in node.comparators for s in _strings(comparator))
+        elif isinstance(node, ast.Assign):
+            # Flow states are set the same way, but on objects named after flows
+            for target in node.targets:
+                if (isinstance(target, ast.Attribute) and target.attr == "state" and isinstance(target.value, ast.Name)
+                        and "flow" not in target.value.id.lower()):
+                    states.update(_strings(node.value))
+    return states
+
+
+def test_every_file_state_in_use_can_be_coded():
+    states = set()
+    for directory in ["punchpipe", "scripts"]:
+        for path in (REPO_DIR / directory).rglob("*.py"):
+            if "tests" not in path.parts:
+                states |= find_file_states(ast.parse(path.read_text()))
+    assert {"planned", "created", "upgraded"} <= states
+    # file_name_to_full_path builds a File with an empty state only to work out its path, and never saves it
+    states.discard("")
+    column_type = CodedString(values=FILE_STATES)
+    for state in states:
+        column_type.encode(state)
+
+
+def test_coded_string_packing_keeps_prefixes_together():
+    column_type = CodedString(2)
+    codes = sorted(column_type.encode(value) for value in ["LA", "L", "LZ", "K~", "MA"])
+    assert [column_type.decode(code) for code in codes] == ["K~", "L", "LA", "LZ", "MA"]
+
+
+def test_coded_string_startswith_is_a_range():
+    table = Table("t", MetaData(), Column("id", Integer, primary_key=True), Column("file_type", CodedString(2)))
+    clause = table.c.file_type.startswith("L").compile(dialect=mysql.dialect(), compile_kwargs={"literal_binds": True})
+    assert str(clause) == f"t.file_type BETWEEN {ord('L') * 256} AND {ord('L') * 256 + 255}"
+
+
+def test_schema_uses_mariadb_types_only_on_mariadb():
+    assert "DATETIME(6)" in str(CreateTable(Flow.__table__).compile(dialect=mysql.dialect()))
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    Base.metadata.drop_all(engine)
+
+
+def test_seconds_between():
+    start, end = literal(datetime(2025, 1, 1, 0, 0, 0)), literal(datetime(2025, 1, 1, 0, 2, 30, 500000))
+    with create_engine("sqlite://").connect() as connection:
+        assert abs(connection.execute(select(seconds_between(start, end))).scalar() - 150.5) < 1e-3
+    assert "TIMESTAMPDIFF(MICROSECOND" in str(seconds_between(start, end).compile(dialect=mysql.dialect()))
+
+
+def test_flows_all_view_on_mysql(db):
+    assert sorted(db.execute(select(FlowAll.flow_id)).scalars()) == [1, 2]
+
+
+def test_flows_all_view_on_sqlite():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session_fn(session)
+        session.commit()
+        assert sorted(session.execute(select(FlowAll.flow_id)).scalars()) == [1, 2]
+    Base.metadata.drop_all(engine)
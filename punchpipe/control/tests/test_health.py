@@ -0,0 +1,132 @@
+import os
+import sys
+import logging
+import subprocess
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+import psutil
+from pytest_mock_resources import create_mysql_fixture
+
+from punchpipe.control.db import Base, Flow, FlowProcess, FlowResources, ResourceSample, ResourceUsage
+from punchpipe.control.health import (
+    HOUR,
+    MACHINE,
+    MINUTE,
+    compute_usage,
+    reap_flow_processes,
+    register_flow_processes,
+    rollup_resource_usage,
+    sample_resources,
+    unregister_flow_processes,
+)
+
+NOW = datetime(2025, 6, 1, 12, 30, 30)
+
+db = create_mysql_fixture(Base, session=True)
+
+
+def make_sample(seconds_ago, flow_type="level1", pid=100, rss=1e9, cpu_time=0.0, read_bytes=0.0, write_bytes=0.0):
+    return SimpleNamespace(sampled_at=NOW - timedelta(seconds=seconds_ago), hostname="host", flow_type=flow_type,
+                           pid=pid, rss=rss, cpu_time=cpu_time, read_bytes=read_bytes, write_bytes=write_bytes)
+
+
+def test_compute_usage():
+    samples = [make_sample(150, cpu_time=10), make_sample(90, cpu_time=40, rss=2e9), make_sample(30, cpu_time=70),
+               make_sample(30, pid=200, cpu_time=5, rss=3e9),
+               make_sample(150, flow_type=MACHINE, pid=None, cpu_time=1000),
+               make_sample(30, flow_type=MACHINE, pid=None, cpu_time=1240)]
+    usage = compute_usage(samples, start=NOW - timedelta(seconds=100))
+
+    level1 = usage[(datetime(2025, 6, 1, 12, 30), "host", "level1")]
+    # The two processes sampled at the same time add up
+    assert level1["rss_by_time"] == {NOW - timedelta(seconds=30): 4e9}
+    # 30 s from the earlier process, plus everything the newly-seen process has used
+    assert level1["cpu_seconds"] == 35
+    assert usage[(datetime(2025, 6, 1, 12, 29), "host", "level1")]["cpu_seconds"] == 30
+    assert usage[(datetime(2025, 6, 1, 12, 30), "host", MACHINE)]["cpu_seconds"] == 240
+
+
+def test_rollup_resource_usage(db):
+    for seconds_ago, cpu_time in [(200, 0), (130, 60), (70, 90), (10, 150)]:
+        db.add(ResourceSample(sampled_at=NOW - timedelta(seconds=seconds_ago), hostname="host", flow_type="level1",
+                              flow_id=1, pid=100, rss=1e9, cpu_time=cpu_time, read_bytes=0, write_bytes=0))
+    db.commit()
+    rollup_resource_usage.fn(db, NOW, default_window=timedelta(minutes=60), margin=timedelta(minutes=2))
+
+    minutes = {row.period_start: row.cpu_seconds
+               for row in db.query(ResourceUsage).where(ResourceUsage.period_seconds == MINUTE).all()}
+    assert minutes == {datetime(2025, 6, 1, 12, 27): 0, datetime(2025, 6, 1, 12, 28): 60,
+                       datetime(2025, 6, 1, 12, 29): 30, datetime(2025, 6, 1, 12, 30): 60}
+    hour = db.query(ResourceUsage).where(ResourceUsage.period_seconds == HOUR).one()
+    assert hour.cpu_seconds == 150
+    assert hour.n_samples == 4
+
+    # Rerunning doesn't double-count
+    rollup_resource_usage.fn(db, NOW, default_window=timedelta(minutes=60), margin=timedelta(minutes=2))
+    assert db.query(ResourceUsage).where(ResourceUsage.period_seconds == HOUR).one().cpu_seconds == 150
+
+
+def test_flow_processes_are_sampled(db):
+    flows = [Flow(flow_id=1, flow_level="1", flow_type="level1", state="running", creation_time=NOW, priority=1),
+             Flow(flow_id=2, flow_level="1", flow_type="level1", state="running", creation_time=NOW, priority=1)]
+    register_flow_processes(db, flows)
+    db.commit()
+    assert {p.pid for p in db.query(FlowProcess).all()} == {os.getpid()}
+    hostname = db.query(FlowProcess).first().hostname
+
+    # The two flows are a batch in one process, so they're sampled once
+    assert sample_resources.fn(db, NOW, hostname) == 1
+    samples = db.query(ResourceSample).where(ResourceSample.flow_type == "level1").all()
+    assert len(samples) == 1
+    assert samples[0].flow_id == 1
+    assert samples[0].rss > 0
+
+    unregister_flow_processes(db, [1, 2])
+    assert sample_resources.fn(db, NOW + timedelta(minutes=1), hostname) == 0
+    # Each flow in the batch is recorded with an equal share of what the process used
+    resources = db.query(FlowResources).order_by(FlowResources.flow_id).all()
+    assert [r.flow_id for r in resources] == [1, 2]
+    assert resources[0].rss == resources[1].rss > 0
+    assert resources[0].cpu_seconds == resources[1].cpu_seconds >= 0
+
+
+def test_reap_flow_processes(db):
+    hostname = "test-host"
+    orphan = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    flows = [(1, "timed_out", orphan), (2, "running", finished)]
+    for flow_id, state, process in flows:
+        db.add(Flow(flow_id=flow_id, flow_level="1", flow_type="level1", state=state, creation_time=NOW, priority=1))
+        db.add(FlowProcess(flow_id=flow_id, flow_type="level1", hostname=hostname, pid=process.pid,
+                           process_start_time=psutil.Process(orphan.pid).create_time(), registered_at=NOW))
+    db.commit()
+
+    reap_flow_processes.fn(logging.getLogger(), db, hostname, grace_seconds=5)
+
+    # The timed-out flow's process was an orphan, so it's terminated but the flow stays timed out, while the flow whose
+    # process died is made revivable
+    assert orphan.wait(timeout=5) is not None
+    states = {flow.flow_id: flow.state for flow in db.query(Flow).all()}
+    assert states == {1: "timed_out", 2: "revivable"}
+    assert db.query(FlowProcess).count() == 0
+
+
+def test_reap_leaves_speedster_workers_alone(db):
+    hostname = "test-host"
+    worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    db.add(Flow(flow_id=1, flow_level="1", flow_type="level1", state="timed_out", creation_time=NOW, priority=1,
+                flow_run_name=f"speedster:{worker.pid}@{hostname}"))
+    db.add(FlowProcess(flow_id=1, flow_type="level1", hostname=hostname, pid=worker.pid,
+                       process_start_time=psutil.Process(worker.pid).create_time(), registered_at=NOW))
+    db.commit()
+
+    try:
+        reap_flow_processes.fn(logging.getLogger(), db, hostname, grace_seconds=5)
+        # Killing a pool worker would lose its flow, so it's left to finish and unregister itself
+        assert worker.poll() is None
+        assert db.query(FlowProcess).count() == 1
+    finally:
+        worker.kill()
+        worker.wait()
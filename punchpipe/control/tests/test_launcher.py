@@ -1,19 +1,32 @@
 import os
 import math
-from datetime import UTC, datetime
-
+import time
+import asyncio
+import logging
+from types import SimpleNamespace
+from datetime import UTC, datetime, timedelta
+from unittest.mock import patch
+
+import httpx
 import pytest
-from freezegun import freeze_time
+from prefect.exceptions import PrefectHTTPStatusError
 from prefect.logging import disable_run_logger
 from prefect.testing.utilities import prefect_test_harness
 from pytest_mock_resources import create_mysql_fixture
+from sqlalchemy import select
 
+from punchpipe.control import launcher
 from punchpipe.control.db import Base, File, Flow
 from punchpipe.control.launcher import (
+    LaunchPacer,
+    choose_batch_size,
     count_flows,
+    determine_batch_sizes,
     determine_launchable_flow_count,
-    escalate_long_waiting_flows,
+    effective_priority,
     gather_planned_flows,
+    launch_ready_flows,
+    submit_flow_run,
 )
 from punchpipe.control.util import load_pipeline_configuration
 
@@ -103,21 +116,27 @@ def test_count_running_flows(db, flow_weights):
     assert weight_planned == 5
 
 
-def test_escalate_long_waiting_flows(db):
+def test_effective_priority(db, flow_weights, flow_batch_sizes):
     pipeline_config_path = os.path.join(TEST_DIR, "punchpipe_config.yaml")
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
 
-    with freeze_time(datetime(2023, 2, 2, 0, 0, 0)) as frozen_datetime:
-        escalate_long_waiting_flows.fn(db, pipeline_config)
-        assert db.query(Flow).where(Flow.flow_id == 1).one().priority == 5
+    def priority_at(now):
+        return db.execute(select(effective_priority(pipeline_config, now)).where(Flow.flow_id == 1)).scalar()
 
-        frozen_datetime.move_to(datetime(2023, 2, 2, 0, 0, 31))
-        escalate_long_waiting_flows.fn(db, pipeline_config)
-        assert db.query(Flow).where(Flow.flow_id == 1).one().priority == 10
+    assert priority_at(datetime(2023, 2, 2, 0, 0, 0)) == 5
+    assert priority_at(datetime(2023, 2, 2, 0, 0, 31)) == 10
+    assert priority_at(datetime(2024, 2, 2, 0, 0, 0)) == 30
+    # The stored priority is left alone
+    assert db.query(Flow).where(Flow.flow_id == 1).one().priority == 5
 
-        frozen_datetime.move_to(datetime(2024, 2, 2, 0, 0, 0))
-        escalate_long_waiting_flows.fn(db, pipeline_config)
-        assert db.query(Flow).where(Flow.flow_id == 1).one().priority == 30
+    # Flows are launched in order of their escalated priority
+    pipeline_config = {"flows": {"level0": {"priority": {"seconds": [30], "escalation": [1000]}}}}
+    flows, *_ = gather_planned_flows.fn(db, 6, 3, flow_weights, {"level0": True, "level1": True}, flow_batch_sizes,
+                                        priority=effective_priority(pipeline_config, datetime(2023, 2, 2, 0, 0, 31)))
+    assert [batch[0].flow_id for batch in flows] == [1, 3, 2]
+    flows, *_ = gather_planned_flows.fn(db, 6, 3, flow_weights, {"level0": True, "level1": True}, flow_batch_sizes,
+                                        priority=effective_priority(pipeline_config, datetime(2023, 2, 2, 0, 0, 1)))
+    assert [batch[0].flow_id for batch in flows] == [3, 1, 2]
 
 
 def test_filter_for_launchable_flows(db, flow_weights):
@@ -166,5 +185,176 @@ def test_filter_for_launchable_flows_with_empty_db(db_empty, flow_weights):
         assert max_flows_to_launch == 20
 
 
-def test_launch_ready_flows():
-    pass
+def test_launch_ready_flows(db):
+    class FakeClient:
+        """Stands in for the Prefect client, rejecting any run of flow 2"""
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def read_deployments(self):
+            return [SimpleNamespace(name="level0_process_flow", id=0), SimpleNamespace(name="level1_process_flow", id=1)]
+
+        async def create_flow_run_from_deployment(self, deployment_id, parameters, tags, idempotency_key):
+            return SimpleNamespace(parameters=parameters, name="run",
+                                   state_name="Failed" if parameters["flow_id"] == 2 else "Scheduled")
+
+    pipeline_config = {"control": {"launcher": {"submission_retries": 0}}}
+    flows = [[flow] for flow in db.query(Flow).order_by(Flow.flow_id).all()]
+    with disable_run_logger(), patch("punchpipe.control.launcher.get_client", FakeClient):
+        launcher._deployment_ids = {}
+        asyncio.run(launch_ready_flows.fn(db, flows, {1: [], 2: [], 3: []}, pipeline_config, LaunchPacer()))
+    states = {flow.flow_id: (flow.state, flow.launch_time is not None) for flow in db.query(Flow).all()}
+    assert states == {1: ("launched", True), 2: ("planned", True), 3: ("launched", True)}
+
+
+def test_gather_planned_flows_tags(db, flow_weights):
+    for file_type, observatory, flow_id in [("PM", "1", 2), ("PM", "1", 2), ("PZ", "2", 2), ("CR", "4", 3)]:
+        db.add(File(level=1, file_type=file_type, observatory=observatory, state='planned', file_version='none',
+                    software_version='none', date_obs=datetime.now(UTC), processing_flow=flow_id))
+    db.commit()
+    flows, tags_by_flow, selected_weight, number_of_flows, count_per_type = gather_planned_flows.fn(
+        db, 6, 3, flow_weights, {"level0": True, "level1": True}, {"level0": 1, "level1": 2})
+    assert tags_by_flow == {1: [], 2: ["PM1", "PZ2"], 3: ["CR4"]}
+    # The level1 flows are batched together, after the unbatched level0 flow
+    assert [[flow.flow_id for flow in batch] for batch in flows] == [[1], [3, 2]]
+
+
+def test_launch_pacer():
+    async def time_launches(pacer, n):
+        start = time.monotonic()
+        for _ in range(n):
+            await pacer.wait()
+        return time.monotonic() - start
+
+    # The first launch goes right away, and the rest are evenly spaced
+    assert 0.35 < asyncio.run(time_launches(LaunchPacer(10), 5)) < 0.6
+    assert asyncio.run(time_launches(LaunchPacer(), 100)) < 0.1
+
+    async def time_chunks(pacer):
+        start = time.monotonic()
+        await pacer.wait(5)
+        await pacer.wait(1)
+        return time.monotonic() - start
+
+    # A chunk of launches goes out together, and holds back the next launch for as long as its launches would have
+    assert 0.45 < asyncio.run(time_chunks(LaunchPacer(10))) < 0.7
+
+
+def test_gather_planned_flows_fair_share(db_empty):
+    # A backlog of high-priority level1 flows would normally hold back every level2 flow
+    for i in range(20):
+        db_empty.add(Flow(flow_level=1, flow_type='level1', state='planned',
+                          creation_time=datetime(2023, 2, 2, 0, 0, i), priority=100))
+    for i in range(10):
+        db_empty.add(Flow(flow_level=2, flow_type='level2', state='planned',
+                          creation_time=datetime(2023, 2, 2, 0, 0, i), priority=1))
+    db_empty.commit()
+    weights = {"level1": 1, "level2": 2}
+    enabled = {"level1": True, "level2": True}
+    batch_sizes = {"level1": 1, "level2": 1}
+
+    flows, tags_by_flow, selected_weight, number_of_flows, count_per_type = gather_planned_flows.fn(
+        db_empty, 12, 100, weights, enabled, batch_sizes)
+    assert dict(count_per_type) == {"level1": 12}
+
+    # With equal shares, the launched weight is split evenly
+    virtual_times = {}
+    flows, tags_by_flow, selected_weight, number_of_flows, count_per_type = gather_planned_flows.fn(
+        db_empty, 12, 100, weights, enabled, batch_sizes, {"level1": 1, "level2": 1}, virtual_times)
+    assert dict(count_per_type) == {"level1": 6, "level2": 3}
+    assert selected_weight == 12
+    # Within each type, flows go in the usual order
+    level1_times = [flow.creation_time for batch in flows for flow in batch if flow.flow_type == "level1"]
+    assert level1_times == sorted(level1_times)
+
+    flows, tags_by_flow, selected_weight, number_of_flows, count_per_type = gather_planned_flows.fn(
+        db_empty, 16, 100, weights, enabled, batch_sizes, {"level1": 3, "level2": 1}, {})
+    assert dict(count_per_type) == {"level1": 12, "level2": 2}
+
+    # Progress carries over between calls, so launching one flow at a time still splits the weight evenly
+    launched = []
+    virtual_times = {}
+    for _ in range(6):
+        flows, *_ = gather_planned_flows.fn(
+            db_empty, 1, 100, weights, enabled, batch_sizes, {"level1": 1, "level2": 1}, virtual_times)
+        for batch in flows:
+            for flow in batch:
+                flow.state = "launched"
+                launched.append(flow.flow_type)
+        db_empty.commit()
+    assert launched.count("level1") == 2 * launched.count("level2")
+
+
+def test_submit_flow_run():
+    class FakeClient:
+        """Stands in for the Prefect client. The deployment gets a new ID after the first lookup, and the first attempt
+        to create a run with the new ID fails."""
+        def __init__(self):
+            self.n_reads = 0
+            self.attempts = []
+
+        async def read_deployments(self):
+            self.n_reads += 1
+            return [SimpleNamespace(name="level1_process_flow", id=self.n_reads)]
+
+        async def create_flow_run_from_deployment(self, deployment_id, parameters, tags, idempotency_key):
+            self.attempts.append((deployment_id, idempotency_key))
+            request = httpx.Request("POST", "http://prefect")
+            if deployment_id == 1:
+                response = httpx.Response(404, request=request)
+                raise PrefectHTTPStatusError("Not found", request=request, response=response)
+            if len(self.attempts) == 2:
+                raise httpx.ConnectError("Connection refused", request=request)
+            return SimpleNamespace(parameters=parameters, name="run", state_name="Scheduled")
+
+    async def submit(client, retries):
+        return await submit_flow_run(client, asyncio.Semaphore(1), "level1_process_flow", {"flow_id": 1}, [], retries)
+
+    with disable_run_logger(), patch("asyncio.sleep"):
+        client = FakeClient()
+        launcher._deployment_ids = {}
+        assert asyncio.run(submit(client, retries=3)).name == "run"
+        # The stale ID is refreshed, the failed attempt is retried, and every attempt is the same submission
+        assert [deployment_id for deployment_id, _ in client.attempts] == [1, 2, 2]
+        assert len({key for _, key in client.attempts}) == 1
+        assert client.n_reads == 2
+
+        client = FakeClient()
+        launcher._deployment_ids = {}
+        assert asyncio.run(submit(client, retries=1)) is None
+
+
+def test_choose_batch_size():
+    config = {"backlog_flows": 100, "target_overhead_fraction": 0.1, "max_batch_seconds": 900}
+    # Near real time, flows run one at a time
+    assert choose_batch_size(10, duration=20, overhead=10, max_batch_size=50, config=config) == 1
+    # In a backlog, 10 s of overhead is at most 10% of a run of five 20 s flows
+    assert choose_batch_size(500, duration=20, overhead=10, max_batch_size=50, config=config) == 5
+    assert choose_batch_size(500, duration=20, overhead=10, max_batch_size=3, config=config) == 3
+    # Batches of slow flows are kept short
+    assert choose_batch_size(500, duration=300, overhead=400, max_batch_size=50, config=config) == 3
+
+
+def test_determine_batch_sizes(db_empty):
+    now = datetime(2025, 6, 1, 12)
+    # Two runs: one batch of three flows taking a minute, one single flow taking 15 s, each 10 s after launch
+    for flow_run_name, n_flows, duration in [("run-a", 3, 60), ("run-b", 1, 15)]:
+        for _ in range(n_flows):
+            db_empty.add(Flow(flow_level=1, flow_type='level1', state='completed', creation_time=now,
+                              launch_time=now - timedelta(seconds=100), start_time=now - timedelta(seconds=90),
+                              end_time=now - timedelta(seconds=90 - duration), flow_run_name=flow_run_name,
+                              priority=1))
+    for i in range(200):
+        db_empty.add(Flow(flow_level=1, flow_type='level1', state='planned', creation_time=now, priority=1))
+    db_empty.commit()
+
+    pipeline_config = {"control": {"launcher": {"adaptive_batching": {"backlog_flows": 100}}},
+                       "flows": {"level1": {"max_batch_size": 20}, "level0": {}}}
+    batch_sizes = determine_batch_sizes(db_empty, pipeline_config, {"level0": 1, "level1": "auto"},
+                                        logging.getLogger(), now)
+    # 75 s over 4 flows, and 10 s of overhead per run
+    assert batch_sizes == {"level0": 1, "level1": choose_batch_size(200, 75 / 4, 10, 20, {})}
+    assert batch_sizes["level1"] > 1
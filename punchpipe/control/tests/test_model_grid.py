@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+from pytest_mock_resources import create_mysql_fixture
+from sqlalchemy import event
+
+from punchpipe.control.db import Base, File, ModelGrid, ModelQueueEntry
+from punchpipe.control.model_grid import (
+    count_inputs_in_windows,
+    dequeue_models,
+    get_waiting_models,
+    grid_slot_times,
+    materialize_model_grid,
+    reset_model_grids,
+)
+from punchpipe.control.util import count_up_to
+
+T0 = datetime(2025, 1, 1)
+INCREMENT = timedelta(hours=12)
+MODEL_KEYS = [("CF", "M", "C"), ("PF", "M", "P")]
+
+
+def session_fn(session):
+    for i in range(48):
+        session.add(File(level="2",
+                         file_type="CT",
+                         observatory="M",
+                         state="created",
+                         file_version="none",
+                         software_version="none",
+                         date_obs=T0 + timedelta(hours=i)))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
+
+def test_grid_slot_times_includes_first_slot_after_now():
+    slots = grid_slot_times(T0, INCREMENT, now=T0 + timedelta(hours=13))
+    assert slots == [T0, T0 + INCREMENT, T0 + 2 * INCREMENT]
+
+
+def test_grid_slot_times_from_index():
+    slots = grid_slot_times(T0, INCREMENT, 2, now=T0 + timedelta(hours=24))
+    assert slots == [T0 + 2 * INCREMENT]
+
+
+def test_materialize_model_grid_is_incremental(db):
+    config = {"file_version": "1"}
+    n_new = materialize_model_grid(db, "construct_f_corona_background", "3", MODEL_KEYS, T0, INCREMENT, config,
+                                   now=T0 + timedelta(hours=24))
+    assert n_new == 6
+    assert db.query(ModelQueueEntry).count() == 6
+    assert db.query(ModelGrid).one().last_slot == T0 + 2 * INCREMENT
+
+    # Nothing new has appeared
+    n_new = materialize_model_grid(db, "construct_f_corona_background", "3", MODEL_KEYS, T0, INCREMENT, config,
+                                   now=T0 + timedelta(hours=24))
+    assert n_new == 0
+
+    n_new = materialize_model_grid(db, "construct_f_corona_background", "3", MODEL_KEYS, T0, INCREMENT, config,
+                                   now=T0 + timedelta(hours=30))
+    assert n_new == 2
+    assert db.query(File).where(File.state == "waiting").count() == 8
+
+
+def test_waiting_models_are_pruned_and_dequeued(db):
+    config = {"file_version": "1"}
+    materialize_model_grid(db, "construct_f_corona_background", "3", MODEL_KEYS, T0, INCREMENT, config,
+                           now=T0 + timedelta(hours=24))
+    waiting = get_waiting_models(db, "construct_f_corona_background")
+    assert len(waiting) == 6
+    assert waiting[0].date_obs == T0 + 2 * INCREMENT
+
+    waiting[0].state = "impossible"
+    dequeue_models(db, [waiting[1]])
+    db.commit()
+    assert len(get_waiting_models(db, "construct_f_corona_background")) == 4
+
+
+def test_reset_model_grid_recreates_deleted_models(db):
+    config = {"file_version": "1"}
+    materialize_model_grid(db, "construct_f_corona_background", "3", MODEL_KEYS, T0, INCREMENT, config,
+                           now=T0 + timedelta(hours=24))
+    db.delete(db.query(File).where(File.state == "waiting").where(File.date_obs == T0).first())
+    reset_model_grids(db, ["construct_f_corona_background"])
+    db.commit()
+
+    n_new = materialize_model_grid(db, "construct_f_corona_background", "3", MODEL_KEYS, T0, INCREMENT, config,
+                                   now=T0 + timedelta(hours=24))
+    assert n_new == 1
+    assert len(get_waiting_models(db, "construct_f_corona_background")) == 6
+
+
+def test_count_inputs_in_windows(db):
+    slots = [T0, T0 + timedelta(hours=10), T0 + timedelta(hours=47), T0 + timedelta(hours=100)]
+    n_before, n_after = count_inputs_in_windows(db, slots, timedelta(hours=5), timedelta(hours=5),
+                                                File.level == "2", File.file_type == "CT")
+    assert n_before.tolist() == [1, 6, 6, 0]
+    assert n_after.tolist() == [6, 6, 1, 0]
+
+
+def test_count_up_to(db):
+    query = db.query(File.file_id).where(File.file_type == "CT").order_by(File.date_obs.desc())
+    assert count_up_to(query) == 48
+    assert count_up_to(query, 10) == 10
+    assert count_up_to(query.where(File.date_obs < T0 + timedelta(hours=3)), 10) == 3
+
+
+def test_count_up_to_selects_only_the_primary_key(db):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # Queries for full rows are counted by their primary key alone, so a covering index can answer them
+    engine = db.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        query = db.query(File).where(File.file_type == "CT").order_by(File.date_obs.desc())
+        assert count_up_to(query, 10) == 10
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert "state" not in statements[-1]
+    assert "ORDER BY" not in statements[-1]
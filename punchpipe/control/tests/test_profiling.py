@@ -0,0 +1,88 @@
+import logging
+from datetime import datetime, timedelta
+
+from prefect import flow
+from prefect.testing.utilities import prefect_test_harness
+from pytest_mock_resources import create_mysql_fixture
+
+from punchpipe.control.db import Base, File, FileRelationship, QueryProfile
+from punchpipe.control.profiling import (
+    fingerprint_statement,
+    finish_query_profile,
+    get_top_statements,
+    start_query_profile,
+)
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+
+
+def session_fn(session):
+    session.add(File(level="1", file_type="QR", observatory="4", state="created", file_version="none",
+                     software_version="none", date_obs=datetime(2025, 1, 1)))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
+
+def query_nothing_ready(session, pipeline_config, reference_time=None):
+    session.query(File).where(File.state == "created").all()
+    return []
+
+
+@flow
+@profile_scheduler_flow
+def profiled_scheduling(pipeline_config_path: dict, session=None):
+    # Stands in for the input checks some schedulers make before the generic logic
+    session.query(FileRelationship).count()
+    return generic_scheduler_flow_logic(query_nothing_ready, None, None, pipeline_config_path, session=session)
+
+
+def test_fingerprint_statement():
+    assert (fingerprint_statement("SELECT * FROM files\n WHERE state = 'created' AND file_id IN (1, 2, 3)")
+            == "SELECT * FROM files WHERE state = ? AND file_id IN (...)")
+    assert (fingerprint_statement("SELECT * FROM files WHERE level = %(level_1)s LIMIT %s")
+            == fingerprint_statement("SELECT * FROM files WHERE level = %(level_2)s LIMIT %s"))
+
+
+def test_profiling_disabled(db):
+    assert start_query_profile(db, {}) is None
+    finish_query_profile(None, db, {}, logging.getLogger())
+    assert db.query(QueryProfile).count() == 0
+
+
+def test_profile_is_recorded(db):
+    config = {"profiling": {"enabled": True, "top_n": 5}}
+    profile = start_query_profile(db, config, flow_type="level1", flow_run_name="test-run")
+    for _ in range(3):
+        db.query(File).where(File.state == "created").all()
+    finish_query_profile(profile, db, config, logging.getLogger())
+
+    # Nothing is recorded once the profile is finished
+    db.query(File).all()
+    assert sum(profile.statements[s].count for s in profile.statements) == 3
+
+    rows = get_top_statements(db, datetime.now() - timedelta(hours=1))
+    assert len(rows) == 1
+    assert rows[0].count == 3
+    assert rows[0].n_runs == 1
+    assert get_top_statements(db, datetime.now() - timedelta(hours=1), flow_type="level2") == []
+
+
+def test_scheduler_profile_has_flow_run_name(db):
+    config = {"scheduler": {"max_start": 10}, "profiling": {"enabled": True}}
+    with prefect_test_harness():
+        profiled_scheduling(config, session=db)
+
+    profiles = db.query(QueryProfile).all()
+    assert len(profiles) == 2
+    assert all(profile.flow_run_name is not None for profile in profiles)
+    assert all(profile.flow_type == "profiled_scheduling" for profile in profiles)
+
+
+def test_scheduler_profile_includes_queries_before_the_generic_logic(db):
+    config = {"scheduler": {"max_start": 10}, "profiling": {"enabled": True}}
+    with prefect_test_harness():
+        profiled_scheduling(config, session=db)
+
+    fingerprints = [profile.fingerprint for profile in db.query(QueryProfile).all()]
+    assert any("relationships" in fingerprint for fingerprint in fingerprints)
+    assert any("files" in fingerprint for fingerprint in fingerprints)
@@ -0,0 +1,45 @@
+import pytest
+from prefect.logging import disable_run_logger
+
+from punchpipe.control import scheduler
+from punchpipe.control.scheduler import generic_scheduler_flow_logic
+
+
+class FakeSession:
+    """Stands in for a database session, with this many flows already planned"""
+    def __init__(self, n_planned):
+        self.n_planned = n_planned
+        self.closed = False
+
+    def query(self, *args):
+        return self
+
+    def where(self, *args):
+        return self
+
+    def count(self):
+        return self.n_planned
+
+    def close(self):
+        self.closed = True
+
+
+def example_scheduler_flow(pipeline_config):
+    return generic_scheduler_flow_logic(None, None, None, pipeline_config)
+
+
+@pytest.mark.parametrize("enabled", [False, True])
+def test_read_session_is_closed_when_stopping_early(monkeypatch, enabled):
+    sessions = []
+
+    def get_database_session(**kwargs):
+        sessions.append(FakeSession(n_planned=10))
+        return sessions[-1]
+
+    monkeypatch.setattr(scheduler, "get_database_session", get_database_session)
+    # Either the flow is disabled, or it already has max_start flows planned
+    config = {"scheduler": {"max_start": 10}, "flows": {"example": {"enabled": enabled}}}
+    with disable_run_logger():
+        assert example_scheduler_flow(config) == 0
+    read_session = sessions[1]
+    assert read_session.closed
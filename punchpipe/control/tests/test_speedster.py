@@ -0,0 +1,366 @@
+import os
+import time
+import signal
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from collections import Counter
+from unittest.mock import patch
+
+import yaml
+from pytest_mock_resources import create_mysql_fixture
+from sqlalchemy import select, update
+
+from punchpipe import speedster
+from punchpipe.control.db import Base, Flow
+from punchpipe.speedster import claim_flows, flow_fits, load_limits, release_unstarted_flows
+
+NOW = datetime(2025, 6, 1, 12)
+PIPELINE_CONFIG = {"flows": {"level1": {"enabled": "speedy"}, "level2": {"enabled": True}}}
+
+
+def session_fn(session):
+    for i in range(10):
+        session.add(Flow(flow_level="1", flow_type="level1", state="planned", creation_time=NOW + timedelta(minutes=i),
+                         priority=1))
+    session.add(Flow(flow_level="2", flow_type="level2", state="planned", creation_time=NOW, priority=1))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
+
+def test_claim_flows(db):
+    flow_ids, types, count_per_type = claim_flows(db, ["level1"], PIPELINE_CONFIG, 4, claim_name="speedster:1")
+    assert len(flow_ids) == 4
+    assert types == ["level1"] * 4
+    assert count_per_type == {"level1": 4}
+
+    others, _, _ = claim_flows(db, ["level1"], PIPELINE_CONFIG, 10, claim_name="speedster:2")
+    assert len(others) == 6
+    assert not set(flow_ids) & set(others)
+
+    claimed = db.execute(select(Flow.flow_run_name, Flow.state).where(Flow.flow_id.in_(flow_ids))).all()
+    assert set(claimed) == {("speedster:1", "launched")}
+    assert claim_flows(db, ["level1"], PIPELINE_CONFIG, 10)[0] == []
+
+
+def test_claim_flows_skips_flows_claimed_elsewhere(db):
+    gather_planned_flows = speedster.gather_planned_flows
+    n_calls = []
+
+    def gather_then_lose_race(session, enabled_flows, pipeline_config, max_n=None):
+        flow_ids, types, count_per_type = gather_planned_flows(session, enabled_flows, pipeline_config, max_n)
+        if not n_calls:
+            # Another process claims two of the candidates after we've read them but before we claim them
+            session.execute(update(Flow).where(Flow.flow_id.in_(flow_ids[:2])).values(state="launched",
+                                                                                      flow_run_name="speedster:2"))
+        n_calls.append(max_n)
+        return flow_ids, types, count_per_type
+
+    with patch.object(speedster, "gather_planned_flows", gather_then_lose_race):
+        flow_ids, _, _ = claim_flows(db, ["level1"], PIPELINE_CONFIG, 5, claim_name="speedster:1")
+
+    # The two lost are made up from the next candidates
+    assert n_calls == [5, 2]
+    assert len(flow_ids) == 5
+    names = dict(db.execute(select(Flow.flow_id, Flow.flow_run_name).where(Flow.flow_type == "level1")).all())
+    assert all(names[flow_id] == "speedster:1" for flow_id in flow_ids)
+    assert list(names.values()).count("speedster:2") == 2
+
+
+def test_release_unstarted_flows(db):
+    flow_ids, _, _ = claim_flows(db, ["level1"], PIPELINE_CONFIG, 3, claim_name="speedster:1")
+    db.execute(update(Flow).where(Flow.flow_id == flow_ids[0]).values(state="running"))
+    db.commit()
+
+    release_unstarted_flows(db, flow_ids)
+    states = dict(db.execute(select(Flow.flow_id, Flow.state).where(Flow.flow_id.in_(flow_ids))).all())
+    assert states == {flow_ids[0]: "running", flow_ids[1]: "planned", flow_ids[2]: "planned"}
+
+
+def test_flow_fits():
+    flow_weights = {"levelq_CNN": 4, "level1": 1}
+    concurrency_limits = {"levelq_CNN": 2}
+
+    def fits(flow_type, running, weight_running):
+        return flow_fits(flow_type, Counter(running), weight_running, flow_weights, concurrency_limits, 8)
+
+    assert fits("levelq_CNN", {"level1": 2}, 2)
+    # Over the weight budget
+    assert not fits("levelq_CNN", {"level1": 5}, 5)
+    assert fits("level1", {"level1": 5}, 5)
+    # At the type's concurrency limit, though there's weight to spare
+    assert not fits("levelq_CNN", {"levelq_CNN": 2}, 4)
+    # Anything can start when nothing's running
+    assert flow_fits("levelq_CNN", Counter(), 0, {"levelq_CNN": 20}, {}, 8)
+
+
+def test_load_limits():
+    pipeline_config = {"flows": {"levelq_CNN": {"launch_weight": 4, "concurrency_limit": 2}, "level1": {}}}
+    flow_weights, concurrency_limits, max_weight_running = load_limits(pipeline_config, None, 16)
+    assert flow_weights == {"levelq_CNN": 4, "level1": 1}
+    assert concurrency_limits == {"levelq_CNN": 2}
+    assert max_weight_running == 16
+
+    pipeline_config["speedster"] = {"max_weight_running": 10}
+    assert load_limits(pipeline_config, None, 16)[2] == 10
+
+
+class FakePool:
+    """Stands in for speedster's worker pool, "running" each flow on a timer and recording what ran at once"""
+    def __init__(self, duration, weights=None):
+        self.duration = duration
+        self.weights = weights or {}
+        self.lock = threading.Lock()
+        self.running = Counter()
+        self.weight_running = 0
+        self.started = []
+        self.finished = []
+        # The number of each type running and the total weight, as of each start
+        self.history = []
+        self.timers = []
+        self.terminated = False
+
+    def apply_async(self, func, args, callback, error_callback):
+        flow_id, flow_type, _ = args[0]
+        with self.lock:
+            self.running[flow_type] += 1
+            self.weight_running += self.weights.get(flow_type, 1)
+            self.started.append(flow_id)
+            self.history.append((Counter(self.running), self.weight_running))
+        timer = threading.Timer(self.duration(flow_id, flow_type), self.finish, (flow_id, flow_type, callback))
+        self.timers.append(timer)
+        timer.start()
+        return SimpleNamespace(ready=lambda: flow_id in self.finished)
+
+    def finish(self, flow_id, flow_type, callback):
+        with self.lock:
+            self.running[flow_type] -= 1
+            self.weight_running -= self.weights.get(flow_type, 1)
+            self.finished.append(flow_id)
+        callback(flow_id)
+
+    def terminate(self):
+        self.terminated = True
+        for timer in self.timers:
+            timer.cancel()
+
+    def join(self):
+        pass
+
+
+class FakeSession:
+    def rollback(self):
+        pass
+
+
+def stub_claims(planned, pool, stop_when_done=True):
+    """A claim_flows that hands out `planned` (flow ID, type) pairs in order, logging each claim
+
+    Once everything has been claimed and run, it stops dispatch as Ctrl-C would.
+    """
+    claims = []
+
+    def claim(session, enabled_flows, pipeline_config, max_n):
+        with pool.lock:
+            outstanding = len(pool.started) - len(pool.finished)
+        claims.append(dict(enabled_flows=sorted(enabled_flows), max_n=max_n, outstanding=outstanding))
+        if stop_when_done and not planned and outstanding == 0:
+            raise KeyboardInterrupt
+        taken = [flow for flow in planned if flow[1] in enabled_flows][:max_n]
+        for flow in taken:
+            planned.remove(flow)
+        types = [flow_type for _, flow_type in taken]
+        return [flow_id for flow_id, _ in taken], types, Counter(types)
+
+    return claim, claims
+
+
+def write_config(tmp_path, flows, speedster_config=None):
+    config = {"flows": {flow_type: {"enabled": "speedy", **settings} for flow_type, settings in flows.items()}}
+    if speedster_config is not None:
+        config["speedster"] = speedster_config
+    path = tmp_path / "config.yaml"
+    path.write_text(yaml.dump(config))
+    return str(path)
+
+
+def run_dispatch(pool, planned, config_path, stop_when_done=True, **kwargs):
+    claim, claims = stub_claims(planned, pool, stop_when_done)
+    released = []
+    with (patch.object(speedster, "claim_flows", claim),
+          patch.object(speedster, "release_unstarted_flows", lambda session, flow_ids: released.extend(flow_ids)),
+          patch.object(speedster, "find_stopped_flows", lambda session, flow_ids: set())):
+        speedster.dispatch(pool, FakeSession(), config_path, **kwargs)
+    return claims, released
+
+
+def test_dispatch_refills_as_flows_finish(tmp_path):
+    config_path = write_config(tmp_path, {"level1": {}})
+    pool = FakePool(lambda flow_id, flow_type: 0.01 * (1 + flow_id % 3))
+    planned = [(i, "level1") for i in range(30)]
+    claims, released = run_dispatch(pool, planned, config_path, n_workers=2, prefetch=4, stagger=0,
+                                    min_backoff=0.01, max_backoff=0.05, report_seconds=0.05)
+
+    assert sorted(pool.finished) == list(range(30))
+    assert released == []
+    # The pool only ever has as many flows as workers; the rest wait in speedster's queue
+    assert max(sum(running.values()) for running, _ in pool.history) == 2
+    assert claims[0]["max_n"] == 6
+    # Later claims top the queue up once half the prefetch has been taken, and never overfill it
+    assert len(claims) > 2
+    for claim in claims[1:]:
+        if claim["max_n"]:
+            assert claim["max_n"] >= 2
+            assert claim["outstanding"] + claim["max_n"] <= 6
+
+
+def test_dispatch_drains_and_exits_after_max_claims(tmp_path):
+    config_path = write_config(tmp_path, {"level1": {}})
+    pool = FakePool(lambda flow_id, flow_type: 0.02)
+    planned = [(i, "level1") for i in range(10)]
+    claims, released = run_dispatch(pool, planned, config_path, stop_when_done=False, n_workers=2, prefetch=2,
+                                     max_claims=1, stagger=0, report_seconds=0.05)
+
+    assert len(claims) == 1
+    # Every claimed flow is run before dispatch returns, and the rest are left planned
+    assert sorted(pool.finished) == [0, 1, 2, 3]
+    assert [flow_id for flow_id, _ in planned] == list(range(4, 10))
+    assert not pool.terminated
+    assert released == []
+
+
+def test_dispatch_backs_off_when_nothing_is_planned(tmp_path):
+    config_path = write_config(tmp_path, {"level1": {}})
+    pool = FakePool(lambda flow_id, flow_type: 0.01)
+    planned = []
+    times = []
+    claim, _ = stub_claims(planned, pool, stop_when_done=False)
+
+    def timed_claim(*args):
+        times.append(time.monotonic())
+        if len(times) == 4:
+            # Work turns up, which resets the backoff
+            planned.append((1, "level1"))
+        if len(times) == 6:
+            raise KeyboardInterrupt
+        return claim(*args)
+
+    with (patch.object(speedster, "claim_flows", timed_claim),
+          patch.object(speedster, "release_unstarted_flows", lambda session, flow_ids: None)):
+        speedster.dispatch(pool, FakeSession(), config_path, n_workers=2, prefetch=2, stagger=0, min_backoff=0.1,
+                           max_backoff=0.4, report_seconds=10)
+
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert gaps[0] >= 0.1
+    assert gaps[1] >= 0.2
+    assert gaps[2] >= 0.4
+    assert gaps[4] < 0.3
+    assert pool.finished == [1]
+
+
+def test_dispatch_halt_releases_unstarted_flows(tmp_path):
+    config_path = write_config(tmp_path, {"level1": {}})
+    pool = FakePool(lambda flow_id, flow_type: 60)
+    planned = [(i, "level1") for i in range(10)]
+    claim, _ = stub_claims(planned, pool, stop_when_done=False)
+    n_calls = []
+
+    def claim_then_interrupt(*args):
+        n_calls.append(1)
+        if len(n_calls) == 2:
+            raise KeyboardInterrupt
+        return claim(*args)
+
+    released = []
+    with (patch.object(speedster, "claim_flows", claim_then_interrupt),
+          patch.object(speedster, "release_unstarted_flows", lambda session, flow_ids: released.extend(flow_ids))):
+        speedster.dispatch(pool, FakeSession(), config_path, n_workers=2, prefetch=4, flows_per_claim=3, stagger=0,
+                           min_backoff=0.01, report_seconds=10)
+
+    assert pool.terminated
+    # Both the running flows and the one still queued are handed back
+    assert sorted(pool.started) == [0, 1]
+    assert sorted(released) == [0, 1, 2]
+
+
+def test_dispatch_keeps_within_weight_and_concurrency_limits(tmp_path):
+    weights = {"levelq_CNN": 3, "level1": 1}
+    config_path = write_config(tmp_path, {"levelq_CNN": {"launch_weight": 3, "concurrency_limit": 1},
+                                          "level1": {"launch_weight": 1}},
+                               speedster_config={"max_weight_running": 5})
+    pool = FakePool(lambda flow_id, flow_type: 0.01 * (1 + flow_id % 4), weights)
+    planned = [(i, "levelq_CNN" if i % 3 == 0 else "level1") for i in range(45)]
+    claims, released = run_dispatch(pool, planned, config_path, n_workers=4, prefetch=4, flows_per_claim=3,
+                                    stagger=0, min_backoff=0.01, max_backoff=0.05, report_seconds=0.05)
+
+    assert sorted(pool.finished) == list(range(45))
+    assert set(released) <= set(pool.finished)
+    for running, weight_running in pool.history:
+        assert running["levelq_CNN"] <= 1
+        assert weight_running <= 5
+        assert sum(running.values()) <= 4
+    # Light flows run alongside the heavy ones, rather than waiting behind them
+    assert any(running["levelq_CNN"] == 1 and running["level1"] == 2 for running, _ in pool.history)
+    # No more of a type are claimed than can run
+    assert any(claim["enabled_flows"] == ["level1"] for claim in claims)
+
+
+def test_dispatch_does_not_starve_heavy_flows(tmp_path):
+    weights = {"levelq_CNN": 3, "level1": 1}
+    config_path = write_config(tmp_path, {"levelq_CNN": {"launch_weight": 3}, "level1": {"launch_weight": 1}},
+                               speedster_config={"max_weight_running": 4})
+    # The light flows finish one at a time, so without a reservation there'd never be room for the heavy one
+    pool = FakePool(lambda flow_id, flow_type: 0.02 * (1 + flow_id % 4), weights)
+    planned = [(0, "level1"), (1, "level1"), (2, "levelq_CNN")] + [(i, "level1") for i in range(3, 60)]
+    claims, released = run_dispatch(pool, planned, config_path, n_workers=4, prefetch=4, stagger=0,
+                                    min_backoff=0.01, max_backoff=0.05, report_seconds=0.05)
+
+    assert sorted(pool.finished) == list(range(60))
+    assert max(weight_running for _, weight_running in pool.history) <= 4
+    # Passed over at most n_workers times, after which it has the budget reserved for it
+    assert pool.started.index(2) < 15
+
+
+def test_find_stopped_flows(db):
+    flow_ids, _, _ = claim_flows(db, ["level1"], PIPELINE_CONFIG, 4, claim_name="speedster:1")
+    db.execute(update(Flow).where(Flow.flow_id == flow_ids[0]).values(state="running"))
+    db.execute(update(Flow).where(Flow.flow_id == flow_ids[1]).values(state="revivable"))
+    db.commit()
+    assert speedster.find_stopped_flows(db, flow_ids + [1000]) == {flow_ids[1], 1000}
+
+
+def run_or_die(inputs):
+    flow_id, _, _ = inputs
+    if flow_id == 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+    time.sleep(0.01)
+    return flow_id
+
+
+def test_dispatch_frees_the_slots_of_killed_workers(tmp_path):
+    config_path = write_config(tmp_path, {"level1": {}})
+    planned = [(i, "level1") for i in range(6)]
+
+    def claim(session, enabled_flows, pipeline_config, max_n):
+        taken = planned[:max_n]
+        del planned[:max_n]
+        types = [flow_type for _, flow_type in taken]
+        return [flow_id for flow_id, _ in taken], types, Counter(types)
+
+    # The health monitor would make the killed flow revivable, while the others are still running
+    def find_stopped_flows(session, flow_ids):
+        return {0} & set(flow_ids)
+
+    with (multiprocessing.Pool(2) as pool,
+          patch.object(speedster, "worker_run_flow", run_or_die),
+          patch.object(speedster, "claim_flows", claim),
+          patch.object(speedster, "find_stopped_flows", find_stopped_flows)):
+        # Without freeing the killed worker's slot, dispatch would wait for it forever
+        thread = threading.Thread(target=speedster.dispatch, daemon=True,
+                                  args=(pool, FakeSession(), config_path, 2, 4),
+                                  kwargs=dict(max_claims=1, stagger=0, report_seconds=0.05, reconcile_seconds=0.05))
+        thread.start()
+        thread.join(timeout=30)
+        assert not thread.is_alive()
@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+
+from pytest_mock_resources import create_mysql_fixture
+
+from punchpipe.control.db import (
+    Base,
+    File,
+    FileHourlyCounts,
+    FileStateChange,
+    FileStatusSummary,
+    Flow,
+    FlowHourlyStats,
+    FlowStatusSummary,
+)
+from punchpipe.control.summary import (
+    apply_file_state_changes,
+    recount_file_states,
+    summarize_flow_states,
+    update_hourly_stats,
+)
+
+NOW = datetime(2025, 6, 1, 12, 30)
+
+
+def session_fn(session):
+    for state, start_time, end_time in [("planned", None, None),
+                                        ("planned", None, None),
+                                        ("launched", None, None),
+                                        ("running", NOW - timedelta(minutes=5), None),
+                                        ("completed", NOW - timedelta(minutes=50), NOW - timedelta(minutes=40)),
+                                        ("completed", NOW - timedelta(minutes=30), NOW - timedelta(minutes=10)),
+                                        ("failed", NOW - timedelta(minutes=25), NOW - timedelta(minutes=20)),
+                                        # Too old to show up in the status counts
+                                        ("completed", NOW - timedelta(days=3), NOW - timedelta(days=3))]:
+        session.add(Flow(flow_level="1", flow_type="level1", state=state, creation_time=NOW - timedelta(days=4),
+                         start_time=start_time, end_time=end_time, priority=1))
+    for state, date_created in [("created", NOW - timedelta(minutes=40)),
+                                ("created", NOW - timedelta(minutes=10)),
+                                ("progressed", NOW - timedelta(hours=2)),
+                                ("planned", None)]:
+        session.add(File(level="1", file_type="PM", observatory="1", state=state, file_version="1",
+                         software_version="none", date_obs=datetime(2025, 1, 1), date_created=date_created))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
+
+def test_status_summaries(db):
+    summarize_flow_states.fn(db, NOW)
+    counts = {row.state: row.count for row in db.query(FlowStatusSummary).all()}
+    assert counts == {"planned": 2, "launched": 1, "running": 1, "completed": 2, "failed": 1}
+
+    # The files were journaled as they were added
+    assert apply_file_state_changes.fn(db, NOW) > 0
+    counts = {row.state: row.count for row in db.query(FileStatusSummary).all()}
+    assert counts == {"created": 2, "progressed": 1, "planned": 1}
+    assert db.query(FileStateChange).count() == 0
+
+    # Running again replaces the old counts
+    db.query(Flow).where(Flow.state == "launched").update({"state": "running", "start_time": NOW})
+    db.commit()
+    summarize_flow_states.fn(db, NOW)
+    counts = {row.state: row.count for row in db.query(FlowStatusSummary).all()}
+    assert counts["running"] == 2
+    assert "launched" not in counts
+
+
+def test_hourly_stats(db):
+    update_hourly_stats.fn(db, NOW, lookback_hours=1, backfill_days=7)
+    stats = {(row.hour, row.state): (row.count, row.total_duration) for row in db.query(FlowHourlyStats).all()}
+    this_hour = datetime(2025, 6, 1, 12)
+    assert stats[(this_hour, "completed")] == (1, 1200)
+    assert stats[(datetime(2025, 6, 1, 11), "completed")] == (1, 600)
+    assert stats[(this_hour, "failed")] == (1, 300)
+    assert len(stats) == 4
+
+    counts = {row.hour: row.count for row in db.query(FileHourlyCounts).all()}
+    assert counts == {this_hour: 1, datetime(2025, 6, 1, 11): 1, datetime(2025, 6, 1, 10): 1}
+
+    # Later runs only rebuild the latest hours, keeping the earlier ones
+    db.add(Flow(flow_level="1", flow_type="level1", state="completed", creation_time=NOW, start_time=NOW,
+                end_time=NOW + timedelta(minutes=1), priority=1))
+    db.commit()
+    start = update_hourly_stats.fn(db, NOW + timedelta(minutes=5), lookback_hours=1, backfill_days=7)
+    assert start == datetime(2025, 6, 1, 11)
+    stats = {(row.hour, row.state): row.count for row in db.query(FlowHourlyStats).all()}
+    assert stats[(this_hour, "completed")] == 2
+    assert len(stats) == 4
+
+    # Even with nothing finishing for a while, each run only goes back as far as the previous one
+    start = update_hourly_stats.fn(db, NOW + timedelta(hours=5), lookback_hours=1, backfill_days=7)
+    assert start == datetime(2025, 6, 1, 11)
+    start = update_hourly_stats.fn(db, NOW + timedelta(hours=6), lookback_hours=1, backfill_days=7)
+    assert start == datetime(2025, 6, 1, 16)
+
+
+def file_state_counts(db):
+    return {row.state: row.count for row in db.query(FileStatusSummary).all()}
+
+
+def test_file_state_changes_are_applied_incrementally(db):
+    apply_file_state_changes.fn(db, NOW)
+
+    planned = db.query(File).where(File.state == "planned").one()
+    planned.state = "creating"
+    db.commit()
+    progressed = db.query(File).where(File.state == "progressed").one()
+    db.delete(progressed)
+    db.commit()
+    # Rolled back, so never counted
+    db.query(File).where(File.state == "created").first().state = "failed"
+    db.flush()
+    db.rollback()
+    db.add(File(level="1", file_type="PM", observatory="2", state="planned", file_version="1",
+                software_version="none", date_obs=datetime(2025, 1, 1)))
+    db.commit()
+
+    assert apply_file_state_changes.fn(db, NOW) > 0
+    assert file_state_counts(db) == {"created": 2, "creating": 1, "planned": 1}
+
+
+def test_recount_file_states_catches_unjournaled_changes(db):
+    apply_file_state_changes.fn(db, NOW)
+    # A bulk update bypasses the journal
+    db.query(File).where(File.state == "created").update({"state": "progressed"})
+    db.commit()
+    apply_file_state_changes.fn(db, NOW)
+    assert file_state_counts(db)["created"] == 2
+
+    recount_file_states.fn(db, NOW)
+    assert file_state_counts(db) == {"progressed": 3, "planned": 1}
+    assert db.query(FileStateChange).count() == 0
@@ -1,8 +1,29 @@
 import os
+import time
+from datetime import datetime, timedelta
 
-from punchpipe.control.util import load_quicklook_scaling
+from pytest_mock_resources import create_mysql_fixture
+
+from punchpipe.control.db import Base, File
+from punchpipe.control.util import load_quicklook_scaling, query_nearest_in_time
 
 TESTDATA_DIR = os.path.dirname(__file__)
+T0 = datetime(2025, 1, 1)
+
+
+def session_fn(session):
+    for minutes in [-30, -7, -3, 0, 4, 9, 20]:
+        session.add(File(level="1",
+                         file_type="QR",
+                         observatory="4",
+                         state="created",
+                         file_version="none",
+                         software_version="none",
+                         date_obs=T0 + timedelta(minutes=minutes)))
+
+
+db = create_mysql_fixture(Base, session_fn, session=True)
+
 
 def test_load_quicklook_scaling():
     vmin, vmax = load_quicklook_scaling(level="0", product="CR", obscode="2", path=TESTDATA_DIR +"/punchpipe_config.yaml")
@@ -23,3 +44,102 @@ def test_load_quicklook_scaling_no_product():
 
     assert vmin == 100
     assert vmax == 800
+
+
+def test_query_nearest_in_time(db):
+    files = query_nearest_in_time(db.query(File), T0)
+    assert [(f.date_obs - T0) / timedelta(minutes=1) for f in files] == [0, -3, 4, -7, 9, 20, -30]
+
+
+def test_query_nearest_in_time_limit(db):
+    files = query_nearest_in_time(db.query(File), T0 + timedelta(minutes=21), limit=3)
+    assert [(f.date_obs - T0) / timedelta(minutes=1) for f in files] == [20, 9, 4]
+
+
+def test_query_nearest_in_time_min_separation(db):
+    files = query_nearest_in_time(db.query(File), T0, limit=3, min_separation=timedelta(minutes=4))
+    assert [(f.date_obs - T0) / timedelta(minutes=1) for f in files] == [-7, 9, 20]
+
+
+def test_database_engines_are_cached(monkeypatch):
+    from sqlalchemy import create_engine, text
+
+    from punchpipe.control import util
+
+    monkeypatch.setattr(util, "_create_engine", lambda block_name, engine_kwargs: create_engine(
+        "sqlite://", **{k: v for k, v in engine_kwargs.items() if k in ("pool_pre_ping", "pool_recycle")}))
+    util.dispose_database_engines()
+
+    session, engine = util.get_database_session(get_engine=True)
+    assert util.get_database_session(get_engine=True)[1] is engine
+    assert util.get_database_engine(dict(pool_recycle=60)) is not engine
+
+    session.execute(text("select 1"))
+    session.close()
+    assert sum(stats["total_checkouts"] for stats in util.get_database_pool_stats()) == 1
+
+    # This is what happens in a forked child
+    util.dispose_database_engines(close=False)
+    assert util.get_database_engine() is not engine
+    util.dispose_database_engines()
+
+
+def test_read_only_sessions_use_a_fresh_enough_replica(monkeypatch):
+    from sqlalchemy import create_engine
+
+    from punchpipe.control import util
+
+    monkeypatch.setattr(util, "_create_engine", lambda block_name, engine_kwargs: create_engine("sqlite://"))
+    util.dispose_database_engines()
+    primary = util.get_database_engine()
+    replica = util.get_database_engine(block_name=util.REPLICA_BLOCK_NAME)
+
+    assert util.get_database_session(get_engine=True)[1] is primary
+    assert util.get_database_session(get_engine=True, read_only=True)[1] is replica
+
+    util._replica_lags[replica] = (time.monotonic(), 30.0)
+    assert util.get_database_session(get_engine=True, read_only=True, max_staleness=60)[1] is replica
+    assert util.get_database_session(get_engine=True, read_only=True, max_staleness=10)[1] is primary
+    util.dispose_database_engines()
+
+
+def test_read_only_sessions_without_a_replica(monkeypatch):
+    from sqlalchemy import create_engine
+
+    from punchpipe.control import util
+
+    def create_primary_only(block_name, engine_kwargs):
+        if block_name == util.REPLICA_BLOCK_NAME:
+            raise ValueError("Unable to find block document")
+        return create_engine("sqlite://")
+
+    monkeypatch.setattr(util, "_create_engine", create_primary_only)
+    monkeypatch.setattr(util, "_missing_blocks", set())
+    util.dispose_database_engines()
+    assert util.get_database_session(get_engine=True, read_only=True)[1] is util.get_database_engine()
+    util.dispose_database_engines()
+
+
+def test_engines_check_the_files_schema(monkeypatch, tmp_path):
+    import pytest
+    from sqlalchemy import create_engine, insert
+
+    from punchpipe.control import util
+    from punchpipe.control.db import FILES_SCHEMA_MARKER, FileCodeLookup
+
+    url = f"sqlite:///{tmp_path / 'punchpipe.db'}"
+    monkeypatch.setattr(util, "_create_engine", lambda block_name, engine_kwargs: create_engine(url))
+    util.dispose_database_engines()
+    # Before the tables are created, and with the schema this process expects
+    util.get_database_engine()
+    util.dispose_database_engines()
+    Base.metadata.create_all(create_engine(url))
+    util.get_database_engine()
+    util.dispose_database_engines()
+
+    with create_engine(url).begin() as connection:
+        connection.execute(insert(FileCodeLookup), [FILES_SCHEMA_MARKER])
+    # This process maps the coded columns as strings, so its queries would silently match nothing
+    with pytest.raises(RuntimeError, match="PUNCHPIPE_COMPACT_FILES"):
+        util.get_database_engine()
+    util.dispose_database_engines()
@@ -1,25 +1,200 @@
 import os
+import time
+import heapq
 from math import inf
-from datetime import UTC, datetime
+from datetime import UTC, datetime, timedelta
 from itertools import islice
+from collections import defaultdict
 
 import yaml
 from ndcube import NDCube
 from prefect.variables import Variable
 from prefect_sqlalchemy import SqlAlchemyConnector
 from punchbowl.data import get_base_file_name, write_ndcube_to_fits, write_ndcube_to_quicklook
-from sqlalchemy import or_
+from sqlalchemy import create_engine, event, func, inspect, make_url, or_, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool, StaticPool
 from yaml.loader import FullLoader
 
-from punchpipe.control.db import File
+from punchpipe.control.db import File, check_files_schema
+from punchpipe.control.profiling import instrument_engine
 
 DEFAULT_SCALING = (5e-13, 5e-11)
 
-def get_database_session(get_engine=False, engine_kwargs={}):
-    """Sets up a session to connect to the MariaDB punchpipe database"""
-    credentials = SqlAlchemyConnector.load("mariadb-creds", _sync=True)
-    engine = credentials.get_engine(**engine_kwargs)
+# Settings for the connection pool behind each engine. Callers can override any of these through `engine_kwargs`.
+DEFAULT_ENGINE_KWARGS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    # Check connections are still alive before handing them out, since MariaDB drops idle connections
+    "pool_pre_ping": True,
+    "pool_recycle": 3600,
+}
+
+# Engines are expensive to build (loading the credentials block is a round trip to the Prefect API, and each engine
+# has its own pool), so each process keeps one per credentials block and set of engine settings.
+_engines = {}
+_pool_checkouts = defaultdict(int)
+
+
+def _engine_key(block_name: str, engine_kwargs: dict) -> tuple:
+    return block_name, tuple(sorted((key, repr(value)) for key, value in engine_kwargs.items()))
+
+
+# Setting this to a SQLAlchemy URL (e.g. sqlite:////tmp/punchpipe.db) points the whole pipeline at that database instead
+# of the one in the Prefect credentials block. This is meant for benchmarks and local testing without a MariaDB server.
+DATABASE_URL_VARIABLE = "PUNCHPIPE_DATABASE_URL"
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Let the scheduler, launcher and flows read while another process writes, and wait on locks instead of erroring
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+
+def _create_engine(block_name: str, engine_kwargs: dict):
+    if database_url := os.environ.get(DATABASE_URL_VARIABLE):
+        if block_name != "mariadb-creds":
+            # There's no replica (or other secondary database) when running against a local database
+            raise ValueError(f"{block_name} is not available when {DATABASE_URL_VARIABLE} is set")
+        url = make_url(database_url)
+        if url.get_backend_name() != "sqlite":
+            return create_engine(url, **engine_kwargs)
+        if url.database in (None, "", ":memory:"):
+            # An in-memory database only exists within its connection, so every session has to share that one
+            engine_kwargs = {k: v for k, v in engine_kwargs.items() if k not in ("pool_size", "max_overflow")}
+            engine_kwargs.update(poolclass=StaticPool, connect_args={"check_same_thread": False})
+        engine = create_engine(url, **engine_kwargs)
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+        return engine
+    credentials = SqlAlchemyConnector.load(block_name, _sync=True)
+    return credentials.get_engine(**engine_kwargs)
+
+
+def get_database_engine(engine_kwargs: dict | None = None, block_name: str = "mariadb-creds",
+                        check_schema: bool = True):
+    """Returns this process's engine for the given credentials block and engine settings, creating it if needed
+
+    A new engine checks that the database's files table uses the schema this process expects, unless `check_schema` is
+    False.
+    """
+    engine_kwargs = {**DEFAULT_ENGINE_KWARGS, **(engine_kwargs or {})}
+    key = _engine_key(block_name, engine_kwargs)
+    engine = _engines.get(key)
+    if engine is None:
+        engine = _create_engine(block_name, engine_kwargs)
+        if check_schema:
+            with engine.connect() as connection:
+                check_files_schema(connection)
+
+        def count_checkout(dbapi_connection, connection_record, connection_proxy):
+            _pool_checkouts[key] += 1
+
+        event.listen(engine, "checkout", count_checkout)
+        instrument_engine(engine)
+        cached_engine = _engines.setdefault(key, engine)
+        if cached_engine is not engine:
+            # Another thread got there first
+            engine.dispose()
+            engine = cached_engine
+    return engine
+
+
+def dispose_database_engines(close: bool = True) -> None:
+    """Drops every cached engine, so the next session starts a fresh pool
+
+    With `close=False`, the pooled connections are abandoned rather than closed, which is what a forked child must do
+    with connections it inherited from its parent, since the parent is still using them.
+    """
+    for engine in _engines.values():
+        engine.dispose(close=close)
+    _engines.clear()
+    _pool_checkouts.clear()
+    _replica_lags.clear()
+
+
+os.register_at_fork(after_in_child=lambda: dispose_database_engines(close=False))
+
+
+def get_database_pool_stats() -> list[dict]:
+    """Reports the state of the connection pool behind each cached engine"""
+    stats = []
+    for key, engine in _engines.items():
+        pool = engine.pool
+        is_queue_pool = isinstance(pool, QueuePool)
+        stats.append({"block_name": key[0],
+                      "engine_kwargs": dict(key[1]),
+                      "size": pool.size() if is_queue_pool else None,
+                      "checked_out": pool.checkedout() if is_queue_pool else None,
+                      "overflow": pool.overflow() if is_queue_pool else None,
+                      "total_checkouts": _pool_checkouts[key]})
+    return stats
+
+
+# Read-only sessions can be pointed at a replica (e.g. a second MariaDB following the primary) by creating this block
+REPLICA_BLOCK_NAME = "mariadb-replica-creds"
+# How often to re-check how far behind the replica is, in seconds
+REPLICA_LAG_CHECK_INTERVAL = 10
+_replica_lags = {}
+_missing_blocks = set()
+
+
+def get_replica_lag(engine) -> float | None:
+    """Returns how many seconds a replica is behind its primary, or None if it isn't replicating"""
+    if engine.dialect.name not in ("mysql", "mariadb"):
+        # We can't tell how old a snapshot (e.g. a SQLite copy in the tests) is, so we treat it as current
+        return 0.0
+    try:
+        with engine.connect() as connection:
+            status = connection.execute(text("SHOW SLAVE STATUS")).mappings().first()
+    except SQLAlchemyError:
+        return None
+    if status is None or status["Seconds_Behind_Master"] is None:
+        return None
+    return float(status["Seconds_Behind_Master"])
+
+
+def _get_replica_engine(engine_kwargs: dict | None, max_staleness: float | None):
+    """Returns the replica engine if there is one and it's fresh enough for this caller, otherwise None"""
+    if REPLICA_BLOCK_NAME in _missing_blocks:
+        return None
+    try:
+        engine = get_database_engine(engine_kwargs, block_name=REPLICA_BLOCK_NAME)
+    except ValueError:
+        # The block doesn't exist, so there's no replica, and we don't need to keep asking Prefect
+        _missing_blocks.add(REPLICA_BLOCK_NAME)
+        return None
+
+    checked_at, lag = _replica_lags.get(engine, (-inf, None))
+    if time.monotonic() - checked_at > REPLICA_LAG_CHECK_INTERVAL:
+        lag = get_replica_lag(engine)
+        _replica_lags[engine] = (time.monotonic(), lag)
+    if lag is None or (max_staleness is not None and lag > max_staleness):
+        return None
+    return engine
+
+
+def get_database_session(get_engine=False, engine_kwargs=None, read_only=False, max_staleness: float | None = None):
+    """Sets up a session to connect to the MariaDB punchpipe database
+
+    Parameters
+    ----------
+    get_engine
+        Whether to also return the engine
+    engine_kwargs
+        Settings for the engine, overriding DEFAULT_ENGINE_KWARGS
+    read_only
+        If True, and a replica is configured and working, the session reads from the replica, keeping load off the
+        primary. Don't write through such a session!
+    max_staleness
+        For read-only sessions, how many seconds behind the primary the replica may be before we fall back to the
+        primary. If None, any delay is accepted.
+    """
+    engine = _get_replica_engine(engine_kwargs, max_staleness) if read_only else None
+    if engine is None:
+        engine = get_database_engine(engine_kwargs)
     session = Session(engine)
 
     if get_engine:
@@ -29,11 +204,14 @@ def get_database_session(get_engine=False, engine_kwargs={}):
 
 
 def update_file_state(session, file_id, new_state):
-    session.query(File).where(File.file_id == file_id).update({"state": new_state})
+    # Through the ORM rather than as a bulk update, so the state change is journaled for the status summary
+    file = session.get(File, file_id)
+    if file is not None:
+        file.state = new_state
     session.commit()
 
 
-def load_pipeline_configuration(path: str = None) -> dict:
+def load_pipeline_configuration(path: str | None = None) -> dict:
     if path is None:
         path = Variable.get("punchpipe_config", "punchpipe_config.yaml")
     with open(path) as f:
@@ -42,7 +220,8 @@ def load_pipeline_configuration(path: str = None) -> dict:
     return config
 
 
-def load_quicklook_scaling(level: str = None, product: str = None, obscode: str = None, path: str = None) -> (float, float):
+def load_quicklook_scaling(level: str | None = None, product: str | None = None, obscode: str | None = None,
+                           path: str | None = None) -> (float, float):
     if path is None:
         path = Variable.get("punchpipe_config", "punchpipe_config.yaml")
     with open(path) as f:
@@ -118,6 +297,61 @@ def get_files_in_time_window(level: str,
             .filter(File.date_obs <= end_time).all())
 
 
+def count_up_to(query, limit: int | None = None) -> int:
+    """Counts the rows a query would return, without loading them and stopping once `limit` rows are found
+
+    This gives the same answer as `len(query.limit(limit).all())`, but the database only has to walk its index rather
+    than send back full rows. Whatever the query selects, only the primary key is counted, so that a covering index can
+    answer it, and the ordering is dropped, since it doesn't change the count.
+    """
+    entity = query.column_descriptions[0]["entity"]
+    if entity is not None:
+        query = query.with_entities(*inspect(entity).primary_key)
+    query = query.order_by(None)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.session.query(func.count()).select_from(query.subquery()).scalar()
+
+
+def query_nearest_in_time(query, target: datetime, limit: int | None = None,
+                          min_separation: timedelta = timedelta(0)) -> list[File]:
+    """Returns the files selected by a query, ordered by how close their date_obs is to a target time
+
+    Ordering by `abs(timestampdiff(...))` makes the database evaluate that expression for every matching row and then
+    sort them all. Instead, we walk the date_obs index outward from the target in both directions, taking at most `limit`
+    files each way, and merge the two (already sorted) lists here.
+
+    Parameters
+    ----------
+    query
+        A Query for File objects. It should not have its own ordering or limit.
+    target
+        The time to be close to
+    limit
+        The maximum number of files to return, or None for all of them
+    min_separation
+        If given, only files more than this far from the target are returned
+
+    Returns
+    -------
+    list[File]
+        The closest files, nearest first
+    """
+    if min_separation:
+        before = query.filter(File.date_obs < target - min_separation)
+        after = query.filter(File.date_obs > target + min_separation)
+    else:
+        before = query.filter(File.date_obs <= target)
+        after = query.filter(File.date_obs > target)
+    before = before.order_by(File.date_obs.desc())
+    after = after.order_by(File.date_obs.asc())
+    if limit is not None:
+        before = before.limit(limit)
+        after = after.limit(limit)
+    nearest = heapq.merge(before.all(), after.all(), key=lambda f: abs(f.date_obs - target))
+    return list(islice(nearest, limit))
+
+
 def batched(iterable, n):
     # batched('ABCDEFG', 3) → ABC DEF G
     # This is basically itertools.batched, but that only exists in Python >= 3.12
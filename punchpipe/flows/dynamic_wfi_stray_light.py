@@ -3,58 +3,55 @@ import typing as t
 from datetime import UTC, datetime, timedelta
 from collections import defaultdict
 
+import numpy as np
 from prefect import flow, get_run_logger
 from punchbowl.level1.dynamic_stray_light import construct_dynamic_stray_light_model
 from sqlalchemy import func
 
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
+from punchpipe.control.model_grid import (
+    count_inputs_around_models,
+    dequeue_models,
+    get_waiting_models,
+    materialize_model_grid,
+)
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
-from punchpipe.control.util import get_database_session, load_pipeline_configuration
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+from punchpipe.control.util import batched, get_database_session, load_pipeline_configuration
 from punchpipe.flows.util import file_name_to_full_path
 
 fiducial_utime = datetime(2025, 1, 1,  tzinfo=UTC).timestamp() - 4 * 60
 
 
-def db_to_utime(file):
-    t = file.date_obs.replace(tzinfo=UTC)
-    t = t.timestamp()
-    return t
+def db_to_utimes(files) -> np.ndarray:
+    """Converts the (naive, UTC) `date_obs` of each file to a Unix timestamp in one go"""
+    date_obs = np.array([file.date_obs for file in files], dtype='datetime64[us]')
+    return date_obs.astype(np.int64) / 1e6
 
 
-def phase_in_window(file):
-    utime = db_to_utime(file)
-    phase = int(((utime - fiducial_utime))/60) % 8
-    return phase
+def phases_in_window(utimes: np.ndarray) -> np.ndarray:
+    """Works out where in the 8-minute WFI cycle each timestamp falls"""
+    # Truncate towards zero, then wrap into 0-7 the same way Python's % does for negative numbers
+    return ((utimes - fiducial_utime) / 60).astype(np.int64) % 8
 
 
 def make_phases(fglob):
-    phases = [[],[],[],[],[],[],[],[]]
-    for fname in fglob:
-        phase = phase_in_window(fname)
-        phases[phase] += [fname]
-    return phases
+    phase_of_file = phases_in_window(db_to_utimes(fglob))
+    return [[fglob[i] for i in np.flatnonzero(phase_of_file == phase)] for phase in range(8)]
 
 
 def collect_pairs_by_phase(phases, phase1, phase2):
     if not len(phases[phase1]) or not len(phases[phase2]):
         return []
-    pairs = []
-    j = 0
-    for i in range(len(phases[phase1])):
-        ti = db_to_utime(phases[phase1][i])
-        tj = db_to_utime(phases[phase2][j])
-        while(tj > ti and j>0):
-            j=j-1
-            tj = db_to_utime(phases[phase2][j])
-        while(tj <= ti and j<len(phases[phase2])-1):
-            j=j+1
-            tj = db_to_utime(phases[phase2][j])
-        dt_min = (tj - ti)/60
-        if(dt_min>0 and dt_min<8):
-            pairs += [[phases[phase1][i], phases[phase2][j]]]
-    return pairs
+    t1 = db_to_utimes(phases[phase1])
+    t2 = db_to_utimes(phases[phase2])
+    # For each phase1 file, find the first phase2 file strictly after it (or the last phase2 file, if there's none
+    # after), and keep the pair if it's within one cycle
+    j = np.minimum(np.searchsorted(t2, t1, side='right'), len(t2) - 1)
+    dt_min = (t2[j] - t1) / 60
+    matched = np.flatnonzero((dt_min > 0) & (dt_min < 8))
+    return [[phases[phase1][i], phases[phase2][j[i]]] for i in matched]
 
 
 def construct_dynamic_stray_light_check_for_inputs(session,
@@ -208,6 +205,7 @@ def construct_dynamic_stray_light_file_info(level1_files: t.List[File],
             ),]
 
 @flow
+@profile_scheduler_flow
 def construct_dynamic_stray_light_scheduler_flow(pipeline_config_path=None, session=None, reference_time: datetime | None = None):
     session = get_database_session()
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
@@ -229,45 +227,17 @@ def construct_dynamic_stray_light_scheduler_flow(pipeline_config_path=None, sess
     else:
         logger.info(f"Will schedule up to {flows_to_schedule} flows")
 
-    existing_models = (session.query(File)
-                       .filter(File.level == "1")
-                       .filter(File.file_type.in_(['TR', 'TM', 'TZ', 'TP']))
-                       .all())
-    logger.info(f"There are {len(existing_models)} model records in the DB")
-
-    existing_models = {(model.file_type, model.observatory, model.date_obs): model for model in existing_models}
     t0 = datetime.strptime(pipeline_config['flows']['construct_dynamic_stray_light']['t0'], "%Y-%m-%d %H:%M:%S")
     increment = timedelta(hours=float(pipeline_config['flows']['construct_dynamic_stray_light']['model_spacing_hours']))
-
-    n = 0
-    # I'm sure there's a better way to do this, but let's step forward by increments to the present, and then we'll work
-    # backwards back to t0, so that we prioritize the stray light models that QuickPUNCH uses
-    while t0 + n * increment < datetime.now():
-        n += 1
-
-    for i in range(n, -1, -1):
-        t = t0 + i * increment
-        for model_type in ['TM', 'TZ', 'TP']:
-            for observatory in ['1', '2', '3']:
-                key = (model_type, observatory, t)
-                model = existing_models.get(key, None)
-                if model is None:
-                    new_model = File(state='waiting',
-                                     level='1',
-                                     file_type=model_type,
-                                     observatory=observatory,
-                                     polarization='C' if model_type[1] == 'R' else model_type[1],
-                                     date_obs=t,
-                                     date_created=datetime.now(),
-                                     file_version=pipeline_config["file_version"],
-                                     software_version=__version__)
-                    session.add(new_model)
-                    existing_models[key] = new_model
+    model_keys = [(model_type, observatory, model_type[1])
+                  for model_type in ['TM', 'TZ', 'TP'] for observatory in ['1', '2', '3']]
+    n_new = materialize_model_grid(session, 'construct_dynamic_stray_light', '1', model_keys, t0, increment,
+                                   pipeline_config)
+    logger.info(f"Added {n_new} new model placeholders")
 
     waiting_models_by_time_and_type = defaultdict(list)
-    for model in existing_models.values():
-        if model.state == 'waiting':
-            waiting_models_by_time_and_type[(model.date_obs, model.observatory, model.file_type)].append(model)
+    for model in get_waiting_models(session, 'construct_dynamic_stray_light'):
+        waiting_models_by_time_and_type[(model.date_obs, model.observatory, model.file_type)].append(model)
 
     logger.info(f"There are {len(waiting_models_by_time_and_type)} waiting models")
 
@@ -292,23 +262,39 @@ def construct_dynamic_stray_light_scheduler_flow(pipeline_config_path=None, sess
                                 key=lambda x: x[0][0],
                                 reverse=True)
 
+    max_files_per_half = pipeline_config['flows']['construct_dynamic_stray_light']['max_files_per_half']
+    half_width = timedelta(hours=pipeline_config['flows']['construct_dynamic_stray_light']['max_hours_per_half'])
+    L0_impossible_after = timedelta(
+        days=pipeline_config['flows']['construct_dynamic_stray_light']['new_L0_impossible_after_days'])
     n_skipped = 0
     to_schedule = []
-    for (date_obs, observatory, is_polarized), models in sorted_models:
-        if not (earliest_input <= date_obs <= latest_input):
-            n_skipped += 1
-            continue
-        if len(models) != 1:
-            logger.warning(f"Wrong number of waiting models for {models[0].date_obs}, got {len(models)}---skipping")
-            continue
-        model = models[0]
-        ready_files = construct_dynamic_stray_light_check_for_inputs(
-            session, pipeline_config, model.date_obs, model)
-        if ready_files:
-            to_schedule.append((model, ready_files))
-            logger.info(f"Will schedule {model.file_type}{model.observatory} at {model.date_obs}")
-            if len(to_schedule) == flows_to_schedule:
-                break
+    for chunk in batched(sorted_models, 500):
+        # Rule out, in bulk, the models that can't have enough inputs, and only run the full query for the rest
+        n_inputs = count_inputs_around_models(session, [models[0] for _, models in chunk], half_width, half_width,
+                                              lambda m: ("1", ["X" + m.file_type[1]], m.observatory),
+                                              ~File.bad_packets)
+        for (date_obs, observatory, file_type), models in chunk:
+            if not (earliest_input <= date_obs <= latest_input):
+                n_skipped += 1
+                continue
+            if len(models) != 1:
+                logger.warning(f"Wrong number of waiting models for {models[0].date_obs}, got {len(models)}---skipping")
+                continue
+            model = models[0]
+            more_L0_impossible = datetime.now() - (date_obs + half_width) > L0_impossible_after
+            # Until more L0s are ruled out, we only produce a model once we have a full set of pairs, which needs at
+            # least one input per pair on each side
+            if not more_L0_impossible and min(n_inputs[model]) < max_files_per_half / 2:
+                continue
+            ready_files = construct_dynamic_stray_light_check_for_inputs(
+                session, pipeline_config, model.date_obs, model)
+            if ready_files:
+                to_schedule.append((model, ready_files))
+                logger.info(f"Will schedule {model.file_type}{model.observatory} at {model.date_obs}")
+                if len(to_schedule) == flows_to_schedule:
+                    break
+        if len(to_schedule) == flows_to_schedule:
+            break
 
     logger.info(f"{n_skipped} models fall outside the range of existing X files and were not queried")
 
@@ -317,6 +303,7 @@ def construct_dynamic_stray_light_scheduler_flow(pipeline_config_path=None, sess
             # Clear the placeholder model entry---it'll be regenerated in the scheduling flow
             args_dictionary = {"file_type": model.file_type, "spacecraft": model.observatory}
             dateobs = model.date_obs
+            dequeue_models(session, [model])
             session.delete(model)
             generic_scheduler_flow_logic(
                 lambda *args, **kwargs: [input_files],
@@ -8,9 +8,15 @@ from punchbowl.level3.f_corona_model import construct_f_corona_model
 
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
+from punchpipe.control.model_grid import (
+    count_inputs_around_models,
+    dequeue_models,
+    get_waiting_models,
+    materialize_model_grid,
+)
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
-from punchpipe.control.util import get_database_session, load_pipeline_configuration
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+from punchpipe.control.util import batched, count_up_to, get_database_session, load_pipeline_configuration
 from punchpipe.flows.util import file_name_to_full_path
 
 
@@ -37,19 +43,21 @@ def f_corona_background_query_ready_files(session, pipeline_config: dict, refere
                          .filter(File.date_obs <= reference_time)
                          .filter(File.file_type == target_file_type)
                          .filter(File.level == "2")
-                         .order_by(File.date_obs.desc())
-                         .limit(max_files_per_half).all())
+                         .order_by(File.date_obs.desc()))
     second_half_inputs = (base_query
                           .filter(File.date_obs >= reference_time)
                           .filter(File.date_obs <= t_end)
                           .filter(File.file_type == target_file_type)
                           .filter(File.level == "2")
-                          .order_by(File.date_obs.asc())
-                          .limit(max_files_per_half).all())
+                          .order_by(File.date_obs.asc()))
 
-    enough_L2s = len(first_half_inputs) > min_files_per_half and len(second_half_inputs) > min_files_per_half
+    # Count before loading anything, since most waiting models won't be ready
+    count_limit = min(min_files_per_half + 1, max_files_per_half)
+    enough_L2s = (count_up_to(first_half_inputs, count_limit) > min_files_per_half
+                  and count_up_to(second_half_inputs, count_limit) > min_files_per_half)
     if enough_L2s:
-        all_ready_files = first_half_inputs + second_half_inputs
+        all_ready_files = (first_half_inputs.limit(max_files_per_half).all()
+                           + second_half_inputs.limit(max_files_per_half).all())
 
         logger.info(f"{len(all_ready_files)} Level 2 {target_file_type}{reference_file.observatory} files will be used "
                      "for F corona estimation.")
@@ -109,6 +117,7 @@ def construct_f_corona_background_file_info(level2_files: t.List[File], pipeline
 
 
 @flow
+@profile_scheduler_flow
 def construct_f_corona_background_scheduler_flow(pipeline_config_path=None, session=None, reference_time: datetime | None = None):
     session = get_database_session()
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
@@ -129,72 +138,50 @@ def construct_f_corona_background_scheduler_flow(pipeline_config_path=None, sess
     else:
         logger.info(f"Will schedule up to {flows_to_schedule} flows")
 
-    existing_models = (session.query(File)
-                       .filter(File.level == "3")
-                       .filter(File.file_type.in_(['CF', "PF"]))
-                       .all())
-    logger.info(f"There are {len(existing_models)} model records in the DB")
-
-    existing_models = {(model.file_type, model.observatory, model.date_obs): model for model in existing_models}
     t0 = datetime.strptime(pipeline_config['flows']['construct_f_corona_background']['t0'], "%Y-%m-%d %H:%M:%S")
     increment = timedelta(hours=float(pipeline_config['flows']['construct_f_corona_background']['model_spacing_hours']))
-    n = 0
-    models_to_try_creating = []
-    # I'm sure there's a better way to do this, but let's step forward by increments to the present, and then we'll work
-    # backwards back to t0, so that we prioritize the stray light models that QuickPUNCH uses
-    while t0 + n * increment < datetime.now():
-        n += 1
-
-    for i in range(n, -1, -1):
-        t = t0 + i * increment
-        for model_type in ["CF", "PF"]:
-            observatory = "M"
-            key = (model_type, observatory, t)
-            model = existing_models.get(key, None)
-            if model is None:
-                new_model = File(state='waiting',
-                                 level='3',
-                                 file_type=model_type,
-                                 observatory=observatory,
-                                 polarization=model_type[0],
-                                 date_obs=t,
-                                 date_created=datetime.now(),
-                                 file_version=pipeline_config["file_version"],
-                                 software_version=__version__)
-                session.add(new_model)
-                models_to_try_creating.append(new_model)
-            elif model.state == 'waiting':
-                models_to_try_creating.append(model)
+    n_new = materialize_model_grid(session, 'construct_f_corona_background', '3',
+                                   [("CF", "M", "C"), ("PF", "M", "P")], t0, increment, pipeline_config)
+    logger.info(f"Added {n_new} new model placeholders")
 
-    session.commit()
+    models_to_try_creating = get_waiting_models(session, 'construct_f_corona_background')
     logger.info(f"There are {len(models_to_try_creating)} waiting models")
 
-
     target_date = pipeline_config.get('target_date', None)
     target_date = datetime.strptime(target_date, "%Y-%m-%d") if target_date else None
     if target_date:
         sorted_models = sorted(models_to_try_creating,
                                 key=lambda x: abs((target_date - x.date_obs).total_seconds()))
     else:
-        sorted_models = sorted(models_to_try_creating,
-                                key=lambda x: x.date_obs,
-                                reverse=True)
+        # The queue already comes back most-recent first
+        sorted_models = models_to_try_creating
 
+    min_files_per_half = pipeline_config['flows']['construct_f_corona_background']['min_files_per_half']
+    half_width = timedelta(hours=pipeline_config['flows']['construct_f_corona_background']['max_hours_per_half'])
     to_schedule = []
-    for model in sorted_models:
-        ready_files = f_corona_background_query_ready_files(
-            session, pipeline_config, model.date_obs, model)
-        if ready_files:
-            to_schedule.append((model, ready_files))
-            logger.info(f"Will schedule {model.file_type} at {model.date_obs}")
-            if len(to_schedule) == flows_to_schedule:
-                break
+    for chunk in batched(sorted_models, 500):
+        # Rule out, in bulk, the models that can't have enough inputs, and only run the full query for the rest
+        n_inputs = count_inputs_around_models(session, chunk, half_width, half_width,
+                                              lambda m: ("2", [m.file_type[0] + 'T'], m.observatory), ~File.outlier)
+        for model in chunk:
+            if min(n_inputs[model]) <= min_files_per_half:
+                continue
+            ready_files = f_corona_background_query_ready_files(
+                session, pipeline_config, model.date_obs, model)
+            if ready_files:
+                to_schedule.append((model, ready_files))
+                logger.info(f"Will schedule {model.file_type} at {model.date_obs}")
+                if len(to_schedule) == flows_to_schedule:
+                    break
+        if len(to_schedule) == flows_to_schedule:
+            break
 
     if len(to_schedule):
         for model, input_files in to_schedule:
             # Clear the placeholder model entry---it'll be regenerated in the scheduling flow
             args_dictionary = {"file_type": model.file_type, "spacecraft": model.observatory}
             dateobs = model.date_obs
+            dequeue_models(session, [model])
             session.delete(model)
             generic_scheduler_flow_logic(
                 lambda *args, **kwargs: [input_files],
@@ -30,13 +30,11 @@ from prefect.blocks.core import Block
 from prefect.blocks.fields import SecretDict
 from prefect.cache_policies import NO_CACHE
 from prefect.context import get_run_context
-from prefect_sqlalchemy import SqlAlchemyConnector
 from punchbowl.data import NormalizedMetadata, get_base_file_name, punch_io, write_ndcube_to_fits
 from punchbowl.data.wcs import calculate_helio_wcs_from_celestial, calculate_pc_matrix
 from punchbowl.limits import LimitSet
 from punchbowl.util import load_mask_file
-from sqlalchemy import and_, or_
-from sqlalchemy.orm import Session
+from sqlalchemy import and_
 from sunpy.coordinates import (
     HeliocentricEarthEcliptic,
     HeliocentricInertial,
@@ -61,7 +59,7 @@ from punchpipe.control.db import (
     PacketHistory,
     TLMFiles,
 )
-from punchpipe.control.util import load_pipeline_configuration
+from punchpipe.control.util import dispose_database_engines, get_database_session, load_pipeline_configuration
 from punchpipe.flows.util import file_name_to_full_path
 
 FIXED_PACKETS = ['ENG_XACT', 'ENG_LED', 'ENG_PFW', 'ENG_CEB', "ENG_LZ"]
@@ -71,13 +69,10 @@ SC_TIME_EPOCH = Time(2000.0, format="decimalyear", scale="tai")
 NFI_PFW_POSITION_MAPPING = ["PM", "DK", "PZ", "PP", "CR"]
 WFI_PFW_POSITION_MAPPING = ["PP", "DK", "PZ", "PM", "CR"]
 
-credentials = SqlAlchemyConnector.load("mariadb-creds", _sync=True)
-engine = credentials.get_engine()
-
 def initializer():
     """ensure the parent proc's database connections are not touched
     in the new connection pool"""
-    engine.dispose(close=False)
+    dispose_database_engines(close=False)
 
 class SpacecraftMapping(Block):
     mapping: SecretDict
@@ -279,7 +274,7 @@ def create_packet_definitions(tlm, parse_expanding_fields=True):
 
 @task(cache_policy=NO_CACHE)
 def detect_new_tlm_files(pipeline_config: dict, session=None) -> List[str]:
-    session = Session(engine)
+    session = get_database_session()
 
     tlm_directory = pipeline_config['tlm_directory']
     found_tlm_files = list(glob(os.path.join(tlm_directory, '**/*.tlm'), recursive=True))
@@ -300,7 +295,7 @@ def detect_new_tlm_files(pipeline_config: dict, session=None) -> List[str]:
 def ingest_tlm_file(path: str,
                     defs: dict[str, ccsdspy.VariableLength | ccsdspy.FixedLength],
                     apid_name2num: dict[str, int]):
-    session = Session(engine)
+    session = get_database_session()
 
     tlm_db_entry = TLMFiles(
         path=path,
@@ -859,7 +854,7 @@ def form_single_image_caller(args):
 
 def form_single_image(spacecraft, t, defs, apid_name2num, pipeline_config, spacecraft_secrets, outlier_limits,
                       masks, processing_flow_id):
-    session = Session(engine)
+    session = get_database_session()
 
     replay_needs = []
     skip_image, skip_reason = False, ""
@@ -1111,8 +1106,10 @@ def level0_form_images(pipeline_config, defs, apid_name2num, outlier_limits, mas
     retry_days = float(pipeline_config["flows"]["level0"]["options"].get("retry_days", 3.0))
     retry_window_start = now - timedelta(days=retry_days)
 
+    # is_used can't be NULL, so a plain filter on it lets these queries use the unused_packets index
     distinct_spacecraft = (session.query(SCI_XFI.spacecraft_id)
-                           .filter(or_(~SCI_XFI.is_used, SCI_XFI.is_used.is_(None)))
+                           .filter(~SCI_XFI.is_used)
+                           .filter(SCI_XFI.timestamp > retry_window_start)
                            .distinct()
                            .all())
 
@@ -1122,7 +1119,7 @@ def level0_form_images(pipeline_config, defs, apid_name2num, outlier_limits, mas
     image_inputs = []
     for spacecraft in distinct_spacecraft:
         distinct_times = (session.query(SCI_XFI.timestamp)
-                          .filter(or_(~SCI_XFI.is_used, SCI_XFI.is_used.is_(None)))
+                          .filter(~SCI_XFI.is_used)
                           .filter(SCI_XFI.spacecraft_id == spacecraft[0])
                           .filter(SCI_XFI.timestamp > retry_window_start)
                           .distinct()
@@ -1194,7 +1191,7 @@ def level0_form_images(pipeline_config, defs, apid_name2num, outlier_limits, mas
 def level0_core_flow(pipeline_config: dict, skip_if_no_new_tlm: bool = True, limit_files: list[str] = None,
                      mask_files: list[str] = None, processing_flow_id=None):
     logger = get_run_logger()
-    session = Session(engine)
+    session = get_database_session()
 
     outlier_limits = []
     if limit_files is not None:
@@ -1294,7 +1291,7 @@ def level0_scheduler_flow(pipeline_config_path=None, session=None, reference_tim
     logger = get_run_logger()
 
     if session is None:
-        session = Session(engine)
+        session = get_database_session()
 
     # We have a concurrency limit set for the L0 flow. If we schedule another one while there's one pending or
     # running, that one could be launched, but then it could be cancelled by Prefect and so its state never gets
@@ -1319,7 +1316,7 @@ def level0_process_flow(flow_id: int, pipeline_config_path=None , session=None):
     logger = get_run_logger()
 
     if session is None:
-        session = Session(engine)
+        session = get_database_session()
 
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
 
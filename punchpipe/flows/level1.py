@@ -7,14 +7,15 @@ from collections import defaultdict
 from prefect import flow, get_run_logger, task
 from prefect.cache_policies import NO_CACHE
 from punchbowl.level1.flow import level1_early_core_flow, level1_late_core_flow, level1_middle_core_flow
-from sqlalchemy import and_, func, text
+from sqlalchemy import and_, func
 from sqlalchemy.orm import aliased
 
 from punchpipe import __version__
 from punchpipe.control import cache_layer
 from punchpipe.control.db import File, FileRelationship, Flow
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+from punchpipe.control.util import query_nearest_in_time
 from punchpipe.flows.util import file_name_to_full_path, summarize_files_missing_cal_files
 
 SCIENCE_LEVEL0_TYPE_CODES = ["PM", "PZ", "PP", "CR"]
@@ -34,12 +35,10 @@ def level1_early_query_ready_files(session, pipeline_config: dict, reference_tim
 
     target_date = pipeline_config.get('target_date', None)
     target_date = datetime.strptime(target_date, "%Y-%m-%d") if target_date else None
-    dt = func.abs(func.timestampdiff(text("second"), File.date_obs, target_date)) if target_date else None
     if target_date:
-        ready = ready.order_by(dt.asc())
+        ready = query_nearest_in_time(ready, target_date)
     else:
-        ready = ready.order_by(File.date_obs.desc())
-    ready = ready.all()
+        ready = ready.order_by(File.date_obs.desc()).all()
 
     quartic_models = get_quartic_model_paths(ready, pipeline_config, session)
     vignetting_functions = get_vignetting_function_paths(ready, pipeline_config, session)
@@ -451,6 +450,7 @@ def level1_early_construct_file_info(level0_files: t.List[File], pipeline_config
 
 
 @flow
+@profile_scheduler_flow
 def level1_early_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level1_early_query_ready_files,
@@ -510,12 +510,10 @@ def level1_middle_query_ready_files(session, pipeline_config: dict, reference_ti
 
     target_date = pipeline_config.get('target_date', None)
     target_date = datetime.strptime(target_date, "%Y-%m-%d") if target_date else None
-    dt = func.abs(func.timestampdiff(text("second"), File.date_obs, target_date)) if target_date else None
     if target_date:
-        ready = ready.order_by(dt.asc())
+        ready = query_nearest_in_time(ready, target_date)
     else:
-        ready = ready.order_by(File.date_obs.desc())
-    ready = ready.all()
+        ready = ready.order_by(File.date_obs.desc()).all()
 
     actually_ready = []
     missing_stray_light = []
@@ -581,6 +579,7 @@ def level1_middle_construct_file_info(input_files: t.List[File], pipeline_config
 
 
 @flow
+@profile_scheduler_flow
 def level1_middle_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level1_middle_query_ready_files,
@@ -629,12 +628,10 @@ def level1_late_query_ready_files(session, pipeline_config: dict, reference_time
 
     target_date = pipeline_config.get('target_date', None)
     target_date = datetime.strptime(target_date, "%Y-%m-%d") if target_date else None
-    dt = func.abs(func.timestampdiff(text("second"), File.date_obs, target_date)) if target_date else None
     if target_date:
-        ready = ready.order_by(dt.asc())
+        ready = query_nearest_in_time(ready, target_date)
     else:
-        ready = ready.order_by(File.date_obs.desc())
-    ready = ready.all()
+        ready = ready.order_by(File.date_obs.desc()).all()
 
 
     distortion_paths = get_distortion_paths(ready, pipeline_config, session)
@@ -726,6 +723,7 @@ def level1_late_construct_file_info(input_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def level1_late_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level1_late_query_ready_files,
@@ -870,6 +868,7 @@ def level1_quick_construct_file_info(input_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def level1_quick_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level1_quick_query_ready_files,
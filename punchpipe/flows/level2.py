@@ -10,7 +10,7 @@ from punchbowl.util import average_datetime
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
 from punchpipe.control.util import group_files_by_time
 from punchpipe.flows.util import file_name_to_full_path
 
@@ -270,6 +270,7 @@ def level2_construct_file_info(level1_files: t.List[File], pipeline_config: dict
 
 
 @flow
+@profile_scheduler_flow
 def level2_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level2_query_ready_files,
@@ -282,6 +283,7 @@ def level2_scheduler_flow(pipeline_config_path=None, session=None, reference_tim
 
 
 @flow
+@profile_scheduler_flow
 def level2_clear_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level2_query_ready_clear_files,
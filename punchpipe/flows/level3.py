@@ -10,7 +10,7 @@ from sqlalchemy import and_
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow, get_closest_after_file, get_closest_before_file, get_closest_file
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
 from punchpipe.control.util import get_database_session
 from punchpipe.flows.util import file_name_to_full_path
 
@@ -101,6 +101,7 @@ def level3_PTM_construct_file_info(input_files: t.List[File], pipeline_config: d
 
 
 @flow
+@profile_scheduler_flow
 def level3_PTM_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level3_PTM_query_ready_files,
@@ -204,6 +205,7 @@ def level3_PIM_construct_file_info(level2_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def level3_PIM_scheduler_flow(pipeline_config_path: str | None = None,
                               session=None,
                               reference_time: datetime | None = None):
@@ -312,6 +314,7 @@ def level3_CIM_construct_file_info(level2_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def level3_CIM_scheduler_flow(pipeline_config_path: str | None = None,
                               session=None,
                               reference_time: datetime | None = None):
@@ -409,6 +412,7 @@ def level3_CTM_construct_file_info(input_files: t.List[File], pipeline_config: d
 
 
 @flow
+@profile_scheduler_flow
 def level3_CTM_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         level3_CTM_query_ready_files,
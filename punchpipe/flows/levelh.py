@@ -9,7 +9,7 @@ from punchbowl.level1.flow import levelh_core_flow
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
 from punchpipe.flows.level1 import get_ccd_parameters, get_psf_model_path
 from punchpipe.flows.util import file_name_to_full_path
 
@@ -78,6 +78,7 @@ def levelh_construct_file_info(level0_files: t.List[File], pipeline_config: dict
 
 
 @flow
+@profile_scheduler_flow
 def levelh_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         levelh_query_ready_files,
@@ -13,14 +13,26 @@ from prefect.context import get_run_context
 from punchbowl.levelq.f_corona_model import construct_qp_f_corona_model
 from punchbowl.levelq.flow import levelq_CNN_core_flow, levelq_CQM_core_flow, levelq_CTM_core_flow
 from punchbowl.util import average_datetime
-from sqlalchemy import and_, func, or_, select, text
+from sqlalchemy import and_, or_
 
 from punchpipe import __version__
 from punchpipe.control.cache_layer.nfi_l1 import wrap_if_appropriate
 from punchpipe.control.db import File, Flow
+from punchpipe.control.model_grid import (
+    count_inputs_around_models,
+    dequeue_models,
+    get_waiting_models,
+    materialize_model_grid,
+)
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
-from punchpipe.control.util import get_database_session, group_files_by_time, load_pipeline_configuration
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+from punchpipe.control.util import (
+    batched,
+    get_database_session,
+    group_files_by_time,
+    load_pipeline_configuration,
+    query_nearest_in_time,
+)
 from punchpipe.flows.util import file_name_to_full_path, summarize_files_missing_cal_files
 
 
@@ -103,6 +115,7 @@ def levelq_CNN_construct_file_info(level1_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def levelq_CNN_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         levelq_CNN_query_ready_files,
@@ -123,18 +136,17 @@ def levelq_CNN_call_data_processor(call_data: dict, pipeline_config, session) ->
 
     # How many files we want for the PCA fitting
     target_number = 1100
-    files_to_fit = session.execute(
-        select(File,
-               dt := func.abs(func.timestampdiff(text("second"), File.date_obs, call_data['date_obs'])))
+    files_to_fit = query_nearest_in_time(
+        session.query(File)
         .filter(File.state.in_(("created", "progressed")))
         .filter(File.level == "1")
         .filter(File.file_type == "QR")
         .filter(File.observatory == "4")
-        .filter(~File.outlier)
-        .filter(dt > 10 * 60)
-        .order_by(dt.asc()).limit(target_number)).all()
+        .filter(~File.outlier),
+        datetime.strptime(call_data['date_obs'], "%Y-%m-%d %H:%M:%S"),
+        limit=target_number, min_separation=timedelta(minutes=10))
 
-    files_to_fit = [os.path.join(f.directory(pipeline_config['root']), f.filename()) for f, _ in files_to_fit]
+    files_to_fit = [os.path.join(f.directory(pipeline_config['root']), f.filename()) for f in files_to_fit]
 
     # Remove files that we're subtracting
     files_to_fit = [f for f in files_to_fit if f not in call_data['data_list']]
@@ -278,6 +290,7 @@ def levelq_CQM_construct_file_info(level1_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def levelq_CQM_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         levelq_CQM_query_ready_files,
@@ -301,10 +314,9 @@ def levelq_CQM_process_flow(flow_id: int | list[int], pipeline_config_path=None,
 
 
 def get_fcorona_models(session, f: File):
-    dt = func.abs(func.timestampdiff(text("second"), File.date_obs, f.date_obs))
-    return (session.query(File).filter(File.state == "created").filter(File.level == "Q")
-                      .filter(File.file_type == "CF").filter(File.observatory == 'M')
-                      .order_by(dt.asc()).limit(2).all())
+    return query_nearest_in_time(session.query(File).filter(File.state == "created").filter(File.level == "Q")
+                                 .filter(File.file_type == "CF").filter(File.observatory == 'M'),
+                                 f.date_obs, limit=2)
 
 
 @task(cache_policy=NO_CACHE)
@@ -375,6 +387,7 @@ def levelq_CTM_construct_file_info(level1_files: t.List[File], pipeline_config:
 
 
 @flow
+@profile_scheduler_flow
 def levelq_CTM_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         levelq_CTM_query_ready_files,
@@ -442,6 +455,7 @@ def levelq_upload_construct_file_info(level1_files: t.List[File], pipeline_confi
     return []
 
 @flow
+@profile_scheduler_flow
 def levelq_upload_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     generic_scheduler_flow_logic(
         levelq_upload_query_ready_files,
@@ -572,6 +586,7 @@ def construct_levelq_CFM_file_info(levelq_files: t.List[File], pipeline_config:
             ),]
 
 @flow
+@profile_scheduler_flow
 def levelq_CFM_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     session = get_database_session()
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
@@ -592,60 +607,39 @@ def levelq_CFM_scheduler_flow(pipeline_config_path=None, session=None, reference
     else:
         logger.info(f"Will schedule up to {flows_to_schedule} flows")
 
-    existing_models = (session.query(File)
-                       .filter(File.level == "Q")
-                       .filter(File.file_type == 'CF')
-                       .all())
-    logger.info(f"There are {len(existing_models)} model records in the DB")
-
-    existing_models = {(model.file_type, model.observatory, model.date_obs): model for model in existing_models}
     t0 = datetime.strptime(pipeline_config['flows']['levelq_CFM']['t0'], "%Y-%m-%d %H:%M:%S")
     increment = timedelta(hours=float(pipeline_config['flows']['levelq_CFM']['model_spacing_hours']))
-    n = 0
-    models_to_try_creating = []
-    # I'm sure there's a better way to do this, but let's step forward by increments to the present, and then we'll work
-    # backwards back to t0, so that we prioritize the stray light models that QuickPUNCH uses
-    while t0 + n * increment < datetime.now():
-        n += 1
-
-    for i in range(n, -1, -1):
-        t = t0 + i * increment
-        model_type = "CF"
-        observatory = "M"
-        key = (model_type, observatory, t)
-        model = existing_models.get(key, None)
-        if model is None:
-            new_model = File(state='waiting',
-                             level='Q',
-                             file_type=model_type,
-                             observatory=observatory,
-                             polarization=model_type[0],
-                             date_obs=t,
-                             date_created=datetime.now(),
-                             file_version=pipeline_config["file_version"],
-                             software_version=__version__)
-            session.add(new_model)
-            models_to_try_creating.append(new_model)
-        elif model.state == 'waiting':
-            models_to_try_creating.append(model)
+    n_new = materialize_model_grid(session, 'levelq_CFM', 'Q', [("CF", "M", "C")], t0, increment, pipeline_config)
+    logger.info(f"Added {n_new} new model placeholders")
 
-    session.commit()
+    models_to_try_creating = get_waiting_models(session, 'levelq_CFM')
     logger.info(f"There are {len(models_to_try_creating)} waiting models")
 
+    min_files_per_half = pipeline_config['flows']['construct_f_corona_background']['min_files_per_half']
+    max_hours_per_half = pipeline_config['flows']['construct_f_corona_background']['max_hours_per_half']
     to_schedule = []
-    for model in models_to_try_creating:
-        ready_files = levelq_CFM_query_ready_files(
-            session, pipeline_config, model.date_obs)
-        if ready_files:
-            to_schedule.append((model, ready_files))
-            logger.info(f"Will schedule {model.file_type} at {model.date_obs}")
-            if len(to_schedule) == flows_to_schedule:
-                break
+    for chunk in batched(models_to_try_creating, 500):
+        # Rule out, in bulk, the models that can't have enough inputs, and only run the full query for the rest
+        n_inputs = count_inputs_around_models(session, chunk, timedelta(hours=2 * max_hours_per_half), timedelta(0),
+                                              lambda m: ("Q", ["CQ"], "M"))
+        for model in chunk:
+            if n_inputs[model][0] < 2 * min_files_per_half:
+                continue
+            ready_files = levelq_CFM_query_ready_files(
+                session, pipeline_config, model.date_obs)
+            if ready_files:
+                to_schedule.append((model, ready_files))
+                logger.info(f"Will schedule {model.file_type} at {model.date_obs}")
+                if len(to_schedule) == flows_to_schedule:
+                    break
+        if len(to_schedule) == flows_to_schedule:
+            break
 
     if len(to_schedule):
         for model, input_files in to_schedule:
             dateobs = model.date_obs
             # Clear the placeholder model entry---it'll be regenerated in the scheduling flow
+            dequeue_models(session, [model])
             session.delete(model)
             generic_scheduler_flow_logic(
                 lambda *args, **kwargs: [input_files],
@@ -733,6 +727,7 @@ def construct_levelq_CFN_background_file_info(levelq_files: t.List[File], pipeli
             ),]
 
 @flow
+@profile_scheduler_flow
 def levelq_CFN_scheduler_flow(pipeline_config_path=None, session=None, reference_time=None):
     reference_time = reference_time or datetime.now(UTC)
 
@@ -8,9 +8,15 @@ from punchbowl.level3.stellar import generate_starfield_background
 
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
+from punchpipe.control.model_grid import (
+    count_inputs_around_models,
+    dequeue_models,
+    get_waiting_models,
+    materialize_model_grid,
+)
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
-from punchpipe.control.util import get_database_session, load_pipeline_configuration
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+from punchpipe.control.util import batched, count_up_to, get_database_session, load_pipeline_configuration
 from punchpipe.flows.util import file_name_to_full_path
 
 
@@ -28,7 +34,7 @@ def starfield_background_query_ready_files(session, pipeline_config: dict,
     target_mapping = {"PS": "PI", "CS": "CI"}
     target_file_type = target_mapping[reference_file.file_type]
 
-    base_query = (session.query(File)
+    base_query = (session.query(File.file_id)
                   .filter(File.state.in_(["created", "progressed"]))
                   .filter(File.observatory == reference_file.observatory)
                   .filter(~File.outlier)
@@ -39,19 +45,21 @@ def starfield_background_query_ready_files(session, pipeline_config: dict,
                          .filter(File.date_obs <= reference_time)
                          .filter(File.file_type == target_file_type)
                          .filter(File.level == "3")
-                         .order_by(File.date_obs.desc())
-                         .limit(max_files_per_half).all())
+                         .order_by(File.date_obs.desc()))
     second_half_inputs = (base_query
                           .filter(File.date_obs >= reference_time)
                           .filter(File.date_obs <= t_end)
                           .filter(File.file_type == target_file_type)
                           .filter(File.level == "3")
-                          .order_by(File.date_obs.asc())
-                          .limit(max_files_per_half).all())
+                          .order_by(File.date_obs.asc()))
 
-    enough_inputs = len(first_half_inputs) > min_files_per_half and len(second_half_inputs) > min_files_per_half
+    # Count before loading anything, since most waiting models won't be ready
+    count_limit = min(min_files_per_half + 1, max_files_per_half)
+    enough_inputs = (count_up_to(first_half_inputs, count_limit) > min_files_per_half
+                     and count_up_to(second_half_inputs, count_limit) > min_files_per_half)
     if enough_inputs:
-        all_ready_files = first_half_inputs + second_half_inputs
+        all_ready_files = (first_half_inputs.limit(max_files_per_half).all()
+                           + second_half_inputs.limit(max_files_per_half).all())
 
         logger.info(f"{len(all_ready_files)} Level 3 {target_file_type}{reference_file.observatory} files will be used "
                      "for starfield estimation.")
@@ -110,6 +118,7 @@ def construct_starfield_background_file_info(level3_files: t.List[File], pipelin
 
 
 @flow
+@profile_scheduler_flow
 def construct_starfield_background_scheduler_flow(pipeline_config_path=None, session=None, reference_time: datetime | None = None):
     session = get_database_session()
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
@@ -130,61 +139,43 @@ def construct_starfield_background_scheduler_flow(pipeline_config_path=None, ses
     else:
         logger.info(f"Will schedule up to {flows_to_schedule} flows")
 
-    existing_models = (session.query(File)
-                       .filter(File.level == "3")
-                       .filter(File.file_type.in_(['CS', 'PS']))
-                       .all())
-    logger.info(f"There are {len(existing_models)} model records in the DB")
-
-    existing_models = {(model.file_type, model.observatory, model.date_obs): model for model in existing_models}
     t0 = datetime.strptime(pipeline_config['flows']['construct_starfield_background']['t0'], "%Y-%m-%d %H:%M:%S")
     increment = timedelta(hours=float(pipeline_config['flows']['construct_starfield_background']['model_spacing_hours']))
-    n = 0
-    models_to_try_creating = []
-    # I'm sure there's a better way to do this, but let's step forward by increments to the present, and then we'll work
-    # backwards back to t0, so that we prioritize the stray light models that QuickPUNCH uses
-    while t0 + n * increment < datetime.now():
-        n += 1
-
-    for i in range(n, -1, -1):
-        t = t0 + i * increment
-        for model_type in ["CS", "PS"]:
-            observatory = "M"
-            key = (model_type, observatory, t)
-            model = existing_models.get(key, None)
-            if model is None:
-                new_model = File(state='waiting',
-                                 level='3',
-                                 file_type=model_type,
-                                 observatory=observatory,
-                                 polarization=model_type[0],
-                                 date_obs=t,
-                                 date_created=datetime.now(),
-                                 file_version=pipeline_config["file_version"],
-                                 software_version=__version__)
-                session.add(new_model)
-                models_to_try_creating.append(new_model)
-            elif model.state == 'waiting':
-                models_to_try_creating.append(model)
+    n_new = materialize_model_grid(session, 'construct_starfield_background', '3',
+                                   [("CS", "M", "C"), ("PS", "M", "P")], t0, increment, pipeline_config)
+    logger.info(f"Added {n_new} new model placeholders")
 
-    session.commit()
+    models_to_try_creating = get_waiting_models(session, 'construct_starfield_background')
     logger.info(f"There are {len(models_to_try_creating)} waiting models")
 
+    min_files_per_half = pipeline_config['flows']['construct_starfield_background']['min_files_per_half']
+    half_width = timedelta(hours=pipeline_config['flows']['construct_starfield_background']['max_hours_per_half'])
+    target_mapping = {"PS": "PI", "CS": "CI"}
     to_schedule = []
-    for model in models_to_try_creating:
-        ready_files = starfield_background_query_ready_files(
-            session, pipeline_config, model.date_obs, model)
-        if ready_files:
-            to_schedule.append((model, ready_files))
-            logger.info(f"Will schedule {model.file_type} at {model.date_obs}")
-            if len(to_schedule) == flows_to_schedule:
-                break
+    for chunk in batched(models_to_try_creating, 500):
+        # Rule out, in bulk, the models that can't have enough inputs, and only run the full query for the rest
+        n_inputs = count_inputs_around_models(session, chunk, half_width, half_width,
+                                              lambda m: ("3", [target_mapping[m.file_type]], m.observatory),
+                                              ~File.outlier)
+        for model in chunk:
+            if min(n_inputs[model]) <= min_files_per_half:
+                continue
+            ready_files = starfield_background_query_ready_files(
+                session, pipeline_config, model.date_obs, model)
+            if ready_files:
+                to_schedule.append((model, ready_files))
+                logger.info(f"Will schedule {model.file_type} at {model.date_obs}")
+                if len(to_schedule) == flows_to_schedule:
+                    break
+        if len(to_schedule) == flows_to_schedule:
+            break
 
     if len(to_schedule):
         for model, input_files in to_schedule:
             # Clear the placeholder model entry---it'll be regenerated in the scheduling flow
             args_dictionary = {"file_type": model.file_type, "spacecraft": model.observatory}
             dateobs = model.date_obs
+            dequeue_models(session, [model])
             session.delete(model)
             generic_scheduler_flow_logic(
                 lambda *args, **kwargs: [input_files],
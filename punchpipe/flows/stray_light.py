@@ -9,9 +9,15 @@ from sqlalchemy import func
 
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
+from punchpipe.control.model_grid import (
+    count_inputs_around_models,
+    dequeue_models,
+    get_waiting_models,
+    materialize_model_grid,
+)
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
-from punchpipe.control.util import get_database_session, load_pipeline_configuration
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
+from punchpipe.control.util import batched, count_up_to, get_database_session, load_pipeline_configuration
 from punchpipe.flows.level2 import group_l2_inputs_single_observatory
 from punchpipe.flows.util import file_name_to_full_path
 
@@ -35,7 +41,9 @@ def construct_clear_stray_light_check_for_inputs(session,
     L0_type_mapping = {"SR": "CR", "SM": "PM", "SZ": "PZ", "SP": "PP"}
     L0_target_file_type = L0_type_mapping[reference_file.file_type]
 
-    base_query = (session.query(File)
+    # We only select IDs, so these queries can be answered from the indices. We first just count the files to decide
+    # whether we're ready, and only pull the IDs when we know we'll be scheduling this model.
+    base_query = (session.query(File.file_id)
                   .filter(File.state.in_(["created", "progressed"]))
                   .filter(File.observatory == reference_file.observatory)
                   .filter(~File.outlier)
@@ -46,57 +54,53 @@ def construct_clear_stray_light_check_for_inputs(session,
                          .filter(File.date_obs <= reference_time)
                          .filter(File.file_type == target_file_type)
                          .filter(File.level == "1")
-                         .order_by(File.date_obs.desc())
-                         .limit(max_files_per_half).all())
+                         .order_by(File.date_obs.desc()))
 
     second_half_inputs = (base_query
                           .filter(File.date_obs >= reference_time)
                           .filter(File.date_obs <= t_end)
                           .filter(File.file_type == target_file_type)
                           .filter(File.level == "1")
-                          .order_by(File.date_obs.asc())
-                          .limit(max_files_per_half).all())
+                          .order_by(File.date_obs.asc()))
 
     first_half_L0s = (base_query
                       .filter(File.date_obs >= t_start)
                       .filter(File.date_obs <= reference_time)
                       .filter(File.file_type == L0_target_file_type)
-                      .filter(File.level == "0")
-                      .order_by(File.date_obs.desc())
-                      .limit(max_files_per_half).all())
+                      .filter(File.level == "0"))
 
     second_half_L0s = (base_query
                        .filter(File.date_obs >= reference_time)
                        .filter(File.date_obs <= t_end)
                        .filter(File.file_type == L0_target_file_type)
-                       .filter(File.level == "0")
-                       .order_by(File.date_obs.asc())
-                       .limit(max_files_per_half).all())
+                       .filter(File.level == "0"))
+
+    n_first_half_inputs = count_up_to(first_half_inputs, max_files_per_half)
+    n_second_half_inputs = count_up_to(second_half_inputs, max_files_per_half)
+    n_first_half_L0s = count_up_to(first_half_L0s, max_files_per_half)
+    n_second_half_L0s = count_up_to(second_half_L0s, max_files_per_half)
 
     # Allow 5% of the L0s to not be processed, in case a few fail
-    all_inputs_ready = (len(first_half_inputs) >= 0.95 * len(first_half_L0s)
-                        and len(second_half_inputs) >= 0.95 * len(second_half_L0s))
-    enough_L1s = len(first_half_inputs) > min_files_per_half and len(second_half_inputs) > min_files_per_half
-    max_L1s = len(first_half_inputs) == max_files_per_half and len(second_half_inputs) == max_files_per_half
+    all_inputs_ready = (n_first_half_inputs >= 0.95 * n_first_half_L0s
+                        and n_second_half_inputs >= 0.95 * n_second_half_L0s)
+    enough_L1s = n_first_half_inputs > min_files_per_half and n_second_half_inputs > min_files_per_half
+    max_L1s = n_first_half_inputs == max_files_per_half and n_second_half_inputs == max_files_per_half
 
-    produce = False
+    n_to_use = None
     if more_L0_impossible:
-        if len(first_half_L0s) < min_files_per_half or len(second_half_L0s) < min_files_per_half:
+        if n_first_half_L0s < min_files_per_half or n_second_half_L0s < min_files_per_half:
             reference_file.state = "impossible"
             # Record who deemed this to be impossible
             reference_file.file_version = pipeline_config["file_version"]
             reference_file.software_version = __version__
             reference_file.date_created = datetime.now()
         elif all_inputs_ready and enough_L1s:
-            n = min(len(first_half_inputs), len(second_half_inputs))
-            first_half_inputs = first_half_inputs[:n]
-            second_half_inputs = second_half_inputs[:n]
-            produce = True
+            n_to_use = min(n_first_half_inputs, n_second_half_inputs)
     elif max_L1s:
-        produce = True
+        n_to_use = max_files_per_half
 
-    if produce:
-        all_ready_files = first_half_inputs + second_half_inputs
+    if n_to_use is not None:
+        all_ready_files = first_half_inputs.limit(n_to_use).all() + second_half_inputs.limit(n_to_use).all()
 
         logger.info(f"{len(all_ready_files)} Level 1 {target_file_type}{reference_file.observatory} files will be used "
                      "for stray light estimation.")
@@ -121,12 +125,26 @@ def construct_polarized_stray_light_check_for_inputs(session,
     target_file_types = ('YP', 'YM', 'YZ')
     L0_target_file_types = ('PP', 'PM', 'PZ')
 
-    base_query = (session.query(File)
+    # Grouping into triplets only needs the timestamp and polarization of each file, so we don't load full rows
+    base_query = (session.query(File.file_id, File.date_obs, File.polarization)
                   .filter(File.state.in_(["created", "progressed"]))
                   .filter(File.observatory == reference_files[0].observatory)
                   .filter(~File.outlier)
                   )
 
+    if not more_L0_impossible:
+        # We'll need max_files_per_half complete triplets on each side, so if there aren't even three times that many
+        # files, we can say no without pulling or grouping anything.
+        for t_low, t_high in ((t_start, reference_time), (reference_time, t_end)):
+            n_inputs = count_up_to(base_query
+                                   .filter(File.date_obs >= t_low)
+                                   .filter(File.date_obs <= t_high)
+                                   .filter(File.file_type.in_(target_file_types))
+                                   .filter(File.level == "1"),
+                                   3 * max_files_per_half)
+            if n_inputs < 3 * max_files_per_half:
+                return []
+
     first_half_inputs = (base_query
                          .filter(File.date_obs >= t_start)
                          .filter(File.date_obs <= reference_time)
@@ -285,6 +303,7 @@ def construct_stray_light_file_info(level1_files: t.List[File],
                 )]
 
 @flow
+@profile_scheduler_flow
 def construct_stray_light_scheduler_flow(pipeline_config_path=None, session=None, reference_time: datetime | None = None):
     session = get_database_session()
     pipeline_config = load_pipeline_configuration(pipeline_config_path)
@@ -306,46 +325,17 @@ def construct_stray_light_scheduler_flow(pipeline_config_path=None, session=None
     else:
         logger.info(f"Will schedule up to {flows_to_schedule} flows")
 
-    existing_models = (session.query(File)
-                       .filter(File.level == "1")
-                       .filter(File.file_type.in_(['SR', 'SM', 'SZ', 'SP']))
-                       .all())
-    logger.info(f"There are {len(existing_models)} model records in the DB")
-
-    existing_models = {(model.file_type, model.observatory, model.date_obs): model for model in existing_models}
     t0 = datetime.strptime(pipeline_config['flows']['construct_stray_light']['t0'], "%Y-%m-%d %H:%M:%S")
     increment = timedelta(hours=float(pipeline_config['flows']['construct_stray_light']['model_spacing_hours']))
-
-    n = 0
-    # I'm sure there's a better way to do this, but let's step forward by increments to the present, and then we'll work
-    # backwards back to t0, so that we prioritize the stray light models that QuickPUNCH uses
-    while t0 + n * increment < datetime.now():
-        n += 1
-
-    for i in range(n, -1, -1):
-        t = t0 + i * increment
-        for model_type in ['SR', 'SM', 'SZ', 'SP']:
-            for observatory in ['1', '2', '3', '4']:
-                key = (model_type, observatory, t)
-                model = existing_models.get(key, None)
-                if model is None:
-                    new_model = File(state='waiting',
-                                     level='1',
-                                     file_type=model_type,
-                                     observatory=observatory,
-                                     polarization='C' if model_type[1] == 'R' else model_type[1],
-                                     date_obs=t,
-                                     date_created=datetime.now(),
-                                     file_version=pipeline_config["file_version"],
-                                     software_version=__version__)
-                    session.add(new_model)
-                    existing_models[key] = new_model
+    model_keys = [(model_type, observatory, 'C' if model_type[1] == 'R' else model_type[1])
+                  for model_type in ['SR', 'SM', 'SZ', 'SP'] for observatory in ['1', '2', '3', '4']]
+    n_new = materialize_model_grid(session, 'construct_stray_light', '1', model_keys, t0, increment, pipeline_config)
+    logger.info(f"Added {n_new} new model placeholders")
 
     waiting_models_by_time_and_type = defaultdict(list)
-    for model in existing_models.values():
-        if model.state == 'waiting':
-            is_polarized = model.polarization != 'C'
-            waiting_models_by_time_and_type[(model.date_obs, model.observatory, is_polarized)].append(model)
+    for model in get_waiting_models(session, 'construct_stray_light'):
+        is_polarized = model.polarization != 'C'
+        waiting_models_by_time_and_type[(model.date_obs, model.observatory, is_polarized)].append(model)
 
     logger.info(f"There are {len(waiting_models_by_time_and_type)} waiting models")
 
@@ -369,36 +359,54 @@ def construct_stray_light_scheduler_flow(pipeline_config_path=None, session=None
         sorted_models = sorted(waiting_models_by_time_and_type.items(),
                                 key=lambda x: x[0][0],
                                 reverse=True)
+    max_files_per_half = pipeline_config['flows']['construct_stray_light']['max_files_per_half']
+    half_width = timedelta(hours=pipeline_config['flows']['construct_stray_light']['max_hours_per_half'])
+    L0_impossible_after = timedelta(
+        days=pipeline_config['flows']['construct_stray_light']['new_L0_impossible_after_days'])
     n_skipped = 0
     to_schedule = []
-    for (date_obs, observatory, is_polarized), models in sorted_models:
-        if not (earliest_input <= date_obs <= latest_input):
-            n_skipped += 1
-            continue
-        if is_polarized:
-            if len(models) != 3:
-                logger.warning(f"Wrong number of waiting polarized models for {date_obs}, got {len(models)}---skipping")
+    for chunk in batched(sorted_models, 500):
+        # Rule out, in bulk, the models that can't have enough inputs, and only run the full query for the rest
+        n_inputs = count_inputs_around_models(
+            session, [models[0] for _, models in chunk], half_width, half_width,
+            lambda m: ("1", ('YP', 'YM', 'YZ') if m.polarization != 'C' else ('XR',), m.observatory),
+            ~File.outlier)
+        for (date_obs, observatory, is_polarized), models in chunk:
+            if not (earliest_input <= date_obs <= latest_input):
+                n_skipped += 1
                 continue
-            ready_files = construct_polarized_stray_light_check_for_inputs(
-                session, pipeline_config, models[0].date_obs, models)
-            if ready_files:
-                to_schedule.append((models, ready_files))
-                logger.info(f"Will schedule {' '.join(m.file_type + m.observatory for m in models)} "
-                            f"at {models[0].date_obs}")
-                if len(to_schedule) == flows_to_schedule:
-                    break
-        else:
-            if len(models) != 1:
-                logger.warning(f"Wrong number of waiting clear models for {date_obs}, got {len(models)}---skipping")
+            # Until more L0s are ruled out, we only produce a model once we have the maximum number of inputs (or, for
+            # polarized models, of complete MZP triplets)
+            more_L0_impossible = datetime.now() - (date_obs + half_width) > L0_impossible_after
+            needed_inputs = max_files_per_half * (3 if is_polarized else 1)
+            if not more_L0_impossible and min(n_inputs[models[0]]) < needed_inputs:
                 continue
-            model = models[0]
-            ready_files = construct_clear_stray_light_check_for_inputs(
-                session, pipeline_config, model.date_obs, model)
-            if ready_files:
-                to_schedule.append(([model], ready_files))
-                logger.info(f"Will schedule {model.file_type}{model.observatory} at {model.date_obs}")
-                if len(to_schedule) == flows_to_schedule:
-                    break
+            if is_polarized:
+                if len(models) != 3:
+                    logger.warning(f"Wrong number of waiting polarized models for {date_obs}, got {len(models)}"
+                                   "---skipping")
+                    continue
+                ready_files = construct_polarized_stray_light_check_for_inputs(
+                    session, pipeline_config, models[0].date_obs, models)
+                if ready_files:
+                    to_schedule.append((models, ready_files))
+                    logger.info(f"Will schedule {' '.join(m.file_type + m.observatory for m in models)} "
+                                f"at {models[0].date_obs}")
+            else:
+                if len(models) != 1:
+                    logger.warning(f"Wrong number of waiting clear models for {date_obs}, got {len(models)}"
+                                   "---skipping")
+                    continue
+                model = models[0]
+                ready_files = construct_clear_stray_light_check_for_inputs(
+                    session, pipeline_config, model.date_obs, model)
+                if ready_files:
+                    to_schedule.append(([model], ready_files))
+                    logger.info(f"Will schedule {model.file_type}{model.observatory} at {model.date_obs}")
+            if len(to_schedule) == flows_to_schedule:
+                break
+        if len(to_schedule) == flows_to_schedule:
+            break
 
     logger.info(f"{n_skipped} models fall outside the range of existing X files and were not queried")
 
@@ -407,6 +415,7 @@ def construct_stray_light_scheduler_flow(pipeline_config_path=None, session=None
             # Clear the placeholder model entry---it'll be regenerated in the scheduling flow
             args_dictionary = {"file_type": [m.file_type for m in models], "spacecraft": models[0].observatory}
             dateobs = models[0].date_obs
+            dequeue_models(session, models)
             for model in models:
                 session.delete(model)
             generic_scheduler_flow_logic(
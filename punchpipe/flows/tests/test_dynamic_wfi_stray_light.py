@@ -0,0 +1,72 @@
+from datetime import UTC, datetime, timedelta
+
+import numpy as np
+
+from punchpipe.control.db import File
+from punchpipe.flows.dynamic_wfi_stray_light import collect_pairs_by_phase, fiducial_utime, make_phases
+
+
+def loop_make_phases(files):
+    """The original, one-file-at-a-time phase binning, as a reference"""
+    phases = [[] for _ in range(8)]
+    for file in files:
+        utime = file.date_obs.replace(tzinfo=UTC).timestamp()
+        phases[int((utime - fiducial_utime) / 60) % 8].append(file)
+    return phases
+
+
+def loop_collect_pairs_by_phase(phases, phase1, phase2):
+    """The original walking pair matcher, as a reference"""
+    def utime(file):
+        return file.date_obs.replace(tzinfo=UTC).timestamp()
+    if not len(phases[phase1]) or not len(phases[phase2]):
+        return []
+    pairs = []
+    j = 0
+    for i in range(len(phases[phase1])):
+        ti = utime(phases[phase1][i])
+        tj = utime(phases[phase2][j])
+        while tj > ti and j > 0:
+            j -= 1
+            tj = utime(phases[phase2][j])
+        while tj <= ti and j < len(phases[phase2]) - 1:
+            j += 1
+            tj = utime(phases[phase2][j])
+        dt_min = (tj - ti) / 60
+        if 0 < dt_min < 8:
+            pairs.append([phases[phase1][i], phases[phase2][j]])
+    return pairs
+
+
+def make_files(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # Roughly one image a minute with jitter and some gaps, including some times before the fiducial time
+    offsets = np.cumsum(rng.uniform(0, 150, n))
+    t0 = datetime(2024, 12, 31, 23)
+    files = [File(level='1', file_type='XM', observatory='1', file_version='1', software_version='1',
+                  date_obs=t0 + timedelta(seconds=float(offset)), state='created') for offset in offsets]
+    for i, file in enumerate(files):
+        file.file_id = i
+    return files
+
+
+def test_make_phases_matches_loop():
+    files = make_files(2000)
+    assert make_phases(files) == loop_make_phases(files)
+
+
+def test_make_phases_empty():
+    assert make_phases([]) == [[] for _ in range(8)]
+
+
+def test_collect_pairs_by_phase_matches_loop():
+    files = make_files(2000, seed=1)
+    phases = make_phases(files)
+    for phase1, phase2 in [(3, 7), (2, 6), (1, 5), (7, 3)]:
+        assert collect_pairs_by_phase(phases, phase1, phase2) == loop_collect_pairs_by_phase(phases, phase1, phase2)
+
+
+def test_collect_pairs_by_phase_missing_phase():
+    phases = make_phases(make_files(10))
+    phases[5] = []
+    assert collect_pairs_by_phase(phases, 1, 5) == []
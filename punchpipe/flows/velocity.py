@@ -8,7 +8,7 @@ from punchbowl.level3.velocity import track_velocity
 from punchpipe import __version__
 from punchpipe.control.db import File, Flow
 from punchpipe.control.processor import generic_process_flow_logic
-from punchpipe.control.scheduler import generic_scheduler_flow_logic
+from punchpipe.control.scheduler import generic_scheduler_flow_logic, profile_scheduler_flow
 from punchpipe.flows.util import file_name_to_full_path
 
 
@@ -67,6 +67,7 @@ def level3_vam_construct_file_info(level3_files: List[File], pipeline_config: di
 
 
 @flow
+@profile_scheduler_flow
 def level3_vam_scheduler_flow(pipeline_config_path=None, session=None, reference_time: datetime | None = None):
     reference_time = reference_time or datetime.now(UTC)
 
@@ -150,6 +151,7 @@ def level3_van_construct_file_info(level3_files: List[File], pipeline_config: di
 
 
 @flow
+@profile_scheduler_flow
 def level3_van_scheduler_flow(pipeline_config_path=None, session=None, reference_time: datetime | None = None):
     reference_time = reference_time or datetime.now(UTC)
 
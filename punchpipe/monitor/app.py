@@ -2,19 +2,18 @@ from contextlib import contextmanager
 
 import dash_bootstrap_components as dbc
 from dash import Dash, dcc, html, page_container, page_registry
-from sqlalchemy.orm import Session
 
 from punchpipe.control.util import get_database_session as _get_database_session
 
-# We'll keep and engine to keep a DB connection pool for the monitor, instead of making a new connection in each
-# individual function every time the page loads or refreshes.
-session, engine = _get_database_session(get_engine=True, engine_kwargs=dict(pool_recycle=6*3600))
-session.close()
+# The dashboard only reads, and refreshes every minute, so it can read from a replica that's a few minutes behind
+MAX_STALENESS_SECONDS = 300
 
 
 @contextmanager
 def get_database_session():
-    session = Session(engine)
+    # Engines (and their connection pools) are cached, so this doesn't make a new connection every time a page refreshes
+    session = _get_database_session(read_only=True, max_staleness=MAX_STALENESS_SECONDS,
+                                    engine_kwargs=dict(pool_recycle=6*3600))
     try:
         yield session
     finally:
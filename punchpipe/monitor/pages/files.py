@@ -7,7 +7,7 @@ import plotly.express as px
 from dash import Input, Output, State, callback, dash_table, dcc, html
 from sqlalchemy import func, select
 
-from punchpipe.control.db import File, Flow
+from punchpipe.control.db import File, FlowAll
 from punchpipe.monitor.app import get_database_session
 
 REFRESH_RATE = 60  # seconds
@@ -242,7 +242,8 @@ def construct_base_query(columns, filter, extra_filters, extra_filters2, include
     for col in columns:
         col = col.lower().replace(' ', '_')
         if col == 'flow_type':
-            cols.append(getattr(Flow, col))
+            # Files outlive their flows in the flows table, so archived flows are included too
+            cols.append(getattr(FlowAll, col))
             join_flow_type = True
         else:
             cols.append(getattr(File, col))
@@ -252,7 +253,7 @@ def construct_base_query(columns, filter, extra_filters, extra_filters2, include
     query = select(*cols)
 
     if join_flow_type:
-        query = query.join(Flow, Flow.flow_id == File.processing_flow)
+        query = query.join(FlowAll, FlowAll.flow_id == File.processing_flow)
 
     for filter_part in filter.split(' && '):
         col_name, operator, filter_value, py_method = split_filter_part(filter_part)
@@ -7,7 +7,8 @@ import plotly.express as px
 from dash import Input, Output, callback, dash_table, dcc, html
 from sqlalchemy import select
 
-from punchpipe.control.db import Flow, Health
+from punchpipe.control.db import FileStatusSummary, Flow, FlowHourlyStats, FlowStatusSummary, Health, ResourceUsage
+from punchpipe.control.health import HOUR, MACHINE, MINUTE
 from punchpipe.monitor.app import get_database_session
 
 REFRESH_RATE = 60  # seconds
@@ -18,6 +19,11 @@ column_names = [ "flow_level", "flow_type", "state", "priority",
                  "flow_run_name", "call_data"]
 schedule_columns =[{'name': v.replace("_", " ").capitalize(), 'id': v} for v in column_names]
 PAGE_SIZE = 15
+FLOW_RESOURCE_LABELS = {"cpu_percentage": "CPU Usage % (of one core)",
+                        "mean_rss": "Mean Memory Usage [GB]",
+                        "max_rss": "Peak Memory Usage [GB]",
+                        "read_rate": "Disk Reads [MB/s]",
+                        "write_rate": "Disk Writes [MB/s]"}
 
 dash.register_page(__name__, path='/')
 
@@ -58,6 +64,15 @@ def layout():
                 ),
             ]),
         ]),
+        dcc.Graph(id='flow-resource-graph'),
+        dcc.Dropdown(
+            id="flow-resource-stat",
+            options=list(FLOW_RESOURCE_LABELS),
+            value="cpu_percentage",
+            clearable=False,
+            style={'width': '50%'},
+            persistence=True, persistence_type='memory',
+        ),
         html.Hr(),
         html.Div(
             id="status-cards"
@@ -153,6 +168,17 @@ def update_flows(n, page_current, page_size, sort_by, filter):
     return dff.to_dict('records')
 
 
+def pivot_state_counts(df, group_columns, state_columns):
+    """Turns one row per group and state into one row per group, with a column of counts for each state"""
+    df = (df[df['state'].isin(list(state_columns))]
+          .pivot_table(index=group_columns, columns='state', values='count', aggfunc='sum', fill_value=0)
+          .reindex(columns=list(state_columns), fill_value=0)
+          .rename(columns=state_columns)
+          .reset_index())
+    df.columns.name = None
+    return df
+
+
 def create_card_content(level: int | str, type: str | None, status: str, message: str):
     if type == "levelq_CNN":
         type = "CNN"
@@ -176,22 +202,14 @@ def create_card_content(level: int | str, type: str | None, status: str, message
     Input('interval-component', 'n_intervals'),
 )
 def update_cards(n):
+    # Counted by the summarizer control flow: planned and launched flows, and others if they started in the last day
+    query = select(FlowStatusSummary.flow_level.label('level'), FlowStatusSummary.flow_type,
+                   FlowStatusSummary.state, FlowStatusSummary.count)
     with get_database_session() as session:
-        reference_time = datetime.now() - timedelta(hours=24)
-        query = (f"SELECT flow_level AS level, flow_type, SUM(state = 'completed') AS n_good, "
-                  "SUM(state = 'failed') AS n_bad, SUM(state = 'running') AS n_running,"
-                 f"SUM(state = 'timed_out') AS n_timed_out "
-                 f"FROM flows WHERE start_time > '{reference_time}' "
-                  "GROUP BY level, flow_type;")
         df = pd.read_sql_query(query, session.connection())
-        # These states don't have a start_time set
-        query = ("SELECT flow_level AS level, flow_type, "
-                 "SUM(state = 'launched') AS n_launched, SUM(state = 'planned') AS n_planned "
-                 "FROM flows GROUP BY level, flow_type;")
-        second_df = pd.read_sql_query(query, session.connection())
-    df = df.dropna().merge(second_df.dropna().set_index('level'), on=['level', 'flow_type'], how='outer')
-    df = df.infer_objects()
-    df.fillna(0, inplace=True)
+    df = pivot_state_counts(df, ['level', 'flow_type'],
+                            {'completed': 'n_good', 'failed': 'n_bad', 'running': 'n_running',
+                             'timed_out': 'n_timed_out', 'launched': 'n_launched', 'planned': 'n_planned'})
 
     cards = []
     for level, type in zip(['0', '1', '2', '3', 'S', 'Q', 'Q'],
@@ -253,13 +271,13 @@ def create_file_card_content(level: int | str, type: str | None, status: str, me
     Input('interval-component', 'n_intervals'),
 )
 def update_file_cards(n):
-    query = ("SELECT level, file_type, SUM(state = 'created') AS n_created, "
-             "SUM(state = 'failed') AS n_failed, SUM(state = 'planned') AS n_planned, "
-             "SUM(state = 'creating') AS n_creating, SUM(state = 'progressed') AS n_progressed, "
-             "SUM(state = 'timed_out') AS n_timed_out, "
-             "SUM(state = 'quickpunched') AS n_quickpunched FROM files GROUP BY level, file_type;")
+    states = ['created', 'failed', 'planned', 'creating', 'progressed', 'timed_out', 'quickpunched']
+    # Counted by the summarizer control flow
+    query = select(FileStatusSummary.level, FileStatusSummary.file_type, FileStatusSummary.state,
+                   FileStatusSummary.count)
     with get_database_session() as session:
         df = pd.read_sql_query(query, session.connection())
+    df = pivot_state_counts(df, ['level', 'file_type'], {state: f"n_{state}" for state in states})
 
     cards = []
     for level, type in zip(['0', '1', '2', '3', 'S', 'Q', 'Q'], [None, None, None, None, None, 'CN', 'CT']):
@@ -332,6 +350,39 @@ def update_machine_stats(n, machine_stat, start_date, end_date, smooth_window):
 
     return fig
 
+@callback(
+    Output('flow-resource-graph', 'figure'),
+    Input('interval-component', 'n_intervals'),
+    Input('flow-resource-stat', 'value'),
+    Input('plot-range', 'start_date'),
+    Input('plot-range', 'end_date'),
+)
+def update_flow_resources(n, flow_resource_stat, start_date, end_date):
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    # The health monitor rolls per-flow usage up by minute and by hour. Long ranges use the hourly values.
+    period_seconds = MINUTE if end_date - start_date <= timedelta(days=2) else HOUR
+    query = (select(ResourceUsage)
+             .where(ResourceUsage.period_seconds == period_seconds)
+             .where(ResourceUsage.flow_type != MACHINE)
+             .where(ResourceUsage.period_start > start_date)
+             .where(ResourceUsage.period_start < end_date))
+    with get_database_session() as session:
+        df = pd.read_sql_query(query, session.connection())
+
+    df = df.groupby(['period_start', 'flow_type'], as_index=False).sum(numeric_only=True)
+    df['cpu_percentage'] = 100 * df['cpu_seconds'] / period_seconds
+    df['mean_rss'] = df['mean_rss'] / 1e9
+    df['max_rss'] = df['max_rss'] / 1e9
+    df['read_rate'] = df['read_bytes'] / period_seconds / 1e6
+    df['write_rate'] = df['write_bytes'] / period_seconds / 1e6
+
+    fig = px.area(df, x='period_start', y=flow_resource_stat, color='flow_type',
+                  title=f"Resource usage by flow type (per {'minute' if period_seconds == MINUTE else 'hour'})")
+    fig.update_xaxes(title_text="Time")
+    fig.update_yaxes(title_text=FLOW_RESOURCE_LABELS[flow_resource_stat])
+
+    return fig
+
 @callback(
     Output('flow-throughput', 'figure'),
     Output('flow-duration', 'figure'),
@@ -340,10 +391,11 @@ def update_machine_stats(n, machine_stat, start_date, end_date, smooth_window):
 def update_flow_stats(n):
     now = datetime.now()
     reference_time = now - timedelta(hours=72)
-    query = ("SELECT flow_type, end_time AS hour, AVG(TIMEDIFF(end_time, start_time)) AS duration, "
-             "COUNT(*) AS count, state "
-             f"FROM flows WHERE end_time > '{reference_time}' "
-             "GROUP BY HOUR(end_time), DAY(end_time), MONTH(end_time), YEAR(end_time), flow_type, state;")
+    # Accumulated by the summarizer control flow
+    query = (select(FlowHourlyStats.flow_type, FlowHourlyStats.hour,
+                    (FlowHourlyStats.total_duration / FlowHourlyStats.count).label('duration'),
+                    FlowHourlyStats.count, FlowHourlyStats.state)
+             .where(FlowHourlyStats.hour >= reference_time.replace(minute=0, second=0, microsecond=0)))
     with get_database_session() as session:
         df = pd.read_sql_query(query, session.connection())
     # Fill missing entries (for hours where nothing ran)
@@ -1,25 +1,30 @@
 import os
+import math
 import time
+import queue
+import socket
 import argparse
 import warnings
 import traceback
 import multiprocessing
 from datetime import datetime
-from collections import defaultdict
+from collections import Counter, deque, defaultdict
 
 import prefect.exceptions
 import yaml
 from prefect.logging import disable_run_logger
-from sqlalchemy import update
+from sqlalchemy import select, update
 from tqdm.auto import tqdm
 from yaml.loader import FullLoader
 
 from punchpipe.cli import find_flow
 from punchpipe.control.db import Flow
+from punchpipe.control.health import SPEEDSTER_RUN_NAME_PREFIX
+from punchpipe.control.launcher import effective_priority, load_flow_data
 from punchpipe.control.util import get_database_session
 
 
-def load_pipeline_configuration(path: str = None) -> dict:
+def load_pipeline_configuration(path: str | None = None) -> dict:
     with open(path) as f:
         config = yaml.load(f, Loader=FullLoader)
     # TODO: add validation
@@ -34,11 +39,12 @@ def load_enabled_flows(pipeline_config):
     return enabled_flows
 
 
-def gather_planned_flows(session, enabled_flows, max_n=None):
+def gather_planned_flows(session, enabled_flows, pipeline_config, max_n=None):
     flows = (session.query(Flow)
              .where(Flow.state == "planned")
              .where(Flow.flow_type.in_(enabled_flows))
-             .order_by(Flow.is_backprocessing.asc(), Flow.priority.desc(), Flow.creation_time.asc())
+             .order_by(Flow.is_backprocessing.asc(), effective_priority(pipeline_config).desc(),
+                       Flow.creation_time.asc())
              .limit(max_n).all())
     count_per_type = defaultdict(lambda: 0)
     flow_ids = []
@@ -51,13 +57,90 @@ def gather_planned_flows(session, enabled_flows, max_n=None):
     return flow_ids, types, count_per_type
 
 
+def supports_skip_locked(session) -> bool:
+    """Whether the database can skip rows another transaction has locked, rather than waiting on them"""
+    dialect = session.get_bind().dialect
+    if dialect.name in ("mysql", "mariadb"):
+        if getattr(dialect, "is_mariadb", False):
+            return dialect.server_version_info >= (10, 6)
+        return dialect.server_version_info >= (8, 0, 1)
+    return dialect.name == "postgresql"
+
+
+def claim_flows(session, enabled_flows, pipeline_config, max_n, claim_name=None, attempts=3):
+    """Selects up to `max_n` planned flows and marks them as launched, so that no other process will run them
+
+    Candidates are found without locking, and then claimed. Where the database supports it, the candidates still
+    planned are locked with SELECT ... FOR UPDATE SKIP LOCKED, passing over any another speedster is claiming right
+    now. Elsewhere, they're claimed with an UPDATE that only applies to flows still planned, and the flows that were
+    changed are identified by `claim_name`, which should be unique to this process. Either way, flows another process
+    got to first are dropped, and if that leaves fewer than `max_n`, more candidates are looked for.
+    """
+    if claim_name is None:
+        claim_name = f"{SPEEDSTER_RUN_NAME_PREFIX}:{os.getpid()}@{socket.gethostname()}"[:64]
+    skip_locked = supports_skip_locked(session)
+
+    flow_ids, types = [], []
+    for _ in range(attempts):
+        n_wanted = max_n - len(flow_ids)
+        candidate_ids, candidate_types, _ = gather_planned_flows(session, enabled_flows, pipeline_config, n_wanted)
+        if not candidate_ids:
+            break
+        if skip_locked:
+            claimed = set(session.execute(select(Flow.flow_id)
+                                          .where(Flow.flow_id.in_(candidate_ids))
+                                          .where(Flow.state == "planned")
+                                          .with_for_update(skip_locked=True)).scalars())
+            session.execute(update(Flow).where(Flow.flow_id.in_(list(claimed))).values(
+                    state='launched', flow_run_name=claim_name, launch_time=datetime.now()))
+        else:
+            session.execute(update(Flow)
+                            .where(Flow.flow_id.in_(candidate_ids))
+                            .where(Flow.state == "planned")
+                            .values(state='launched', flow_run_name=claim_name, launch_time=datetime.now()))
+            claimed = set(session.execute(select(Flow.flow_id)
+                                          .where(Flow.flow_id.in_(candidate_ids))
+                                          .where(Flow.state == "launched")
+                                          .where(Flow.flow_run_name == claim_name)).scalars())
+        session.commit()
+        for flow_id, flow_type in zip(candidate_ids, candidate_types):
+            if flow_id in claimed:
+                flow_ids.append(flow_id)
+                types.append(flow_type)
+        if len(candidate_ids) < n_wanted or len(claimed) == len(candidate_ids):
+            break
+    session.commit()
+
+    count_per_type = defaultdict(lambda: 0)
+    for flow_type in types:
+        count_per_type[flow_type] += 1
+    return flow_ids, types, count_per_type
+
+
+def release_unstarted_flows(session, flow_ids):
+    """Returns claimed flows that never got to start back to the planned state"""
+    if flow_ids:
+        session.execute(update(Flow).where(Flow.flow_id.in_(flow_ids)).where(Flow.state == 'launched').values(
+                state='planned', flow_run_name=None, launch_time=None))
+        session.commit()
+
+
+def find_stopped_flows(session, flow_ids) -> set[int]:
+    """Of these flows, those that are no longer launched or running, including any that have been deleted"""
+    active = set(session.execute(select(Flow.flow_id)
+                                 .where(Flow.flow_id.in_(flow_ids))
+                                 .where(Flow.state.in_(["launched", "running"]))).scalars())
+    session.commit()
+    return set(flow_ids) - active
+
+
 def worker_init(config_path):
     global session, flow_type_to_runner, path_to_config
     with disable_run_logger(), warnings.catch_warnings():
         # Otherwise warning spam will hide any progress messages
         warnings.simplefilter('ignore')
         session = get_database_session()
-    flow_type_to_runner = dict()
+    flow_type_to_runner = {}
     path_to_config = config_path
 
 
@@ -70,14 +153,12 @@ def worker_run_flow(inputs):
     else:
         runner = flow_type_to_runner[flow_type]
 
-    session.execute(update(Flow).where(Flow.flow_id == flow_id).values(
-            state='launched', flow_run_name='speedster', launch_time=datetime.now()))
-
     with disable_run_logger(), warnings.catch_warnings():
         # Otherwise warning spam will hide any progress messages
         warnings.simplefilter('ignore')
         try:
-            time.sleep(delay)
+            if delay:
+                time.sleep(delay)
             runner(flow_id, path_to_config, session)
         except (KeyboardInterrupt, prefect.exceptions.TerminationSignal):
             session.execute(
@@ -87,63 +168,239 @@ def worker_run_flow(inputs):
         except: # noqa: E722
             print(f"Exception in flow {flow_id}")
             traceback.print_exc()
+    return flow_id
+
+
+def load_limits(pipeline_config, session, n_workers):
+    """Each speedy flow type's launch weight and concurrency limit, and the total weight allowed to run at once"""
+    flow_weights, _, _ = load_flow_data(pipeline_config, session)
+    concurrency_limits = {flow_type: settings["concurrency_limit"]
+                          for flow_type, settings in pipeline_config["flows"].items()
+                          if settings.get("concurrency_limit") is not None}
+    max_weight_running = pipeline_config.get("speedster", {}).get("max_weight_running")
+    if max_weight_running is None:
+        max_weight_running = n_workers
+    return flow_weights, concurrency_limits, max_weight_running
+
+
+def within_concurrency_limit(flow_type, running, concurrency_limits) -> bool:
+    """Whether another flow of this type can start, given how many of each type are running"""
+    return running[flow_type] < concurrency_limits.get(flow_type, math.inf)
+
+
+def flow_fits(flow_type, running, weight_running, flow_weights, concurrency_limits, max_weight_running) -> bool:
+    """Whether a flow can start now without passing its type's concurrency limit or the total weight budget
+
+    `running` counts the running flows of each type. A flow heavier than the whole budget may start when nothing else
+    is running, so that it isn't held back forever.
+    """
+    if not within_concurrency_limit(flow_type, running, concurrency_limits):
+        return False
+    return running.total() == 0 or weight_running + flow_weights.get(flow_type, 1) <= max_weight_running
+
+
+def dispatch(pool, session, config_path, n_workers, prefetch, flows_per_claim=None, max_claims=None,
+             stagger=0, min_backoff=5, max_backoff=120, report_seconds=30, reconcile_seconds=60):
+    """Keeps the pool busy, claiming more flows as running ones finish
+
+    Up to `prefetch` claimed flows wait in a queue here, so a worker that frees up has its next flow ready rather than
+    idling until the whole batch is done. The queue is topped up once half of it has been taken, so claims aren't made
+    one flow at a time. When no flows are waiting, the time until the next look doubles from `min_backoff` up to
+    `max_backoff` seconds, and goes back down as soon as some are found. The progress bar shows the throughput over the
+    last five minutes.
+
+    A flow is only handed to a worker if that keeps its type within its `concurrency_limit` and the total `launch_weight`
+    of running flows within `speedster.max_weight_running` (by default, the number of workers). Otherwise, the
+    next queued flow that does fit is started instead, and if none do, lighter flows are claimed for the free workers.
+    So that a heavy flow isn't starved by a steady stream of lighter ones, once it has been passed over for want of
+    weight `n_workers` times, nothing more is started ahead of it until there's room for it.
+
+    With a `stagger` of more than zero, the first `n_workers` flows are started that many seconds apart, to spread out
+    their initial DB and IO load. It's off by default, since it holds those workers idle.
+
+    A worker that dies mid-flow (e.g. it's killed) takes its task with it, and the pool never reports back on that flow.
+    So every `reconcile_seconds`, the flows still outstanding are checked against the database. One that's no longer
+    launched or running, and is still outstanding at the next check, is taken to be lost, and its worker and weight are
+    freed.
+    """
+    waiting = deque()
+    passed_over = Counter()
+    running = {}
+    running_per_type = Counter()
+    weight_running = 0
+    finished = queue.Queue()
+    suspected = set()
+    finish_times = deque()
+    n_claims = 0
+    n_started = 0
+    backoff = min_backoff
+    next_claim = 0
+    start = time.monotonic()
+    next_report = start + report_seconds
+    next_reconcile = start + reconcile_seconds
+    refill_at = max(1, prefetch // 2)
+
+    pipeline_config = load_pipeline_configuration(config_path)
+    flow_weights, concurrency_limits, max_weight_running = load_limits(pipeline_config, session, n_workers)
+
+    def fits(flow_type):
+        return flow_fits(flow_type, running_per_type, weight_running, flow_weights, concurrency_limits,
+                         max_weight_running)
+
+    with tqdm(unit="flow") as pbar:
+        try:
+            while True:
+                # Start queued flows on free workers, taking the first in line that fits
+                reserving = False
+                while len(running) < n_workers:
+                    flow, skipped = None, []
+                    for candidate in waiting:
+                        if fits(candidate[1]):
+                            flow = candidate
+                            break
+                        if within_concurrency_limit(candidate[1], running_per_type, concurrency_limits):
+                            # It's only waiting for weight to free up
+                            if passed_over[candidate[0]] >= n_workers:
+                                reserving = True
+                                break
+                            skipped.append(candidate[0])
+                    if flow is None:
+                        break
+                    waiting.remove(flow)
+                    passed_over.pop(flow[0], None)
+                    passed_over.update(skipped)
+                    flow_id, flow_type = flow
+                    delay = n_started * stagger if n_started < n_workers else 0
+                    # The weight is kept, so the right amount is freed even if the config changes in the meantime
+                    weight = flow_weights.get(flow_type, 1)
+                    running_per_type[flow_type] += 1
+                    weight_running += weight
+                    n_started += 1
+                    result = pool.apply_async(worker_run_flow, ((flow_id, flow_type, delay),), callback=finished.put,
+                                              error_callback=lambda _, flow_id=flow_id: finished.put(flow_id))
+                    running[flow_id] = (flow_type, weight, result)
+
+                # Workers are free but nothing queued can use them, so look for flows that can
+                stalled = len(running) < n_workers and len(waiting) > 0 and not reserving
+                room = n_workers + prefetch - len(running) - len(waiting)
+                can_claim = max_claims is None or n_claims < max_claims
+                if (room >= refill_at or stalled) and can_claim and time.monotonic() >= next_claim:
+                    pipeline_config = load_pipeline_configuration(config_path)
+                    flow_weights, concurrency_limits, max_weight_running = load_limits(pipeline_config, session,
+                                                                                       n_workers)
+                    # There's no use queueing more flows of a type than its concurrency limit
+                    queued_per_type = running_per_type + Counter(flow_type for _, flow_type in waiting)
+                    enabled_flows = [flow_type for flow_type in load_enabled_flows(pipeline_config)
+                                     if within_concurrency_limit(flow_type, queued_per_type, concurrency_limits)]
+                    if stalled:
+                        enabled_flows = [flow_type for flow_type in enabled_flows if fits(flow_type)]
+                        n_wanted = n_workers - len(running)
+                    else:
+                        n_wanted = room
+                    if flows_per_claim is not None:
+                        n_wanted = min(n_wanted, flows_per_claim)
+                    if enabled_flows:
+                        flow_ids, types, count_per_type = claim_flows(session, enabled_flows, pipeline_config,
+                                                                      n_wanted)
+                    else:
+                        flow_ids, types, count_per_type = [], [], {}
+                    if flow_ids:
+                        if n_claims == 0:
+                            pbar.write("Claimed " + ", ".join(f"{count_per_type[flow_type]} of {flow_type}"
+                                                              for flow_type in sorted(count_per_type)))
+                        n_claims += 1
+                        backoff = min_backoff
+                        waiting.extend(zip(flow_ids, types))
+                    if len(flow_ids) < n_wanted:
+                        # The queue's been drained, so there's no point looking again right away
+                        if not flow_ids and not running:
+                            pbar.write(f"No pending flows found---will look again in {backoff:.0f} seconds")
+                        next_claim = time.monotonic() + backoff
+                        if not flow_ids:
+                            backoff = min(2 * backoff, max_backoff)
+                    continue
+                elif not running and not waiting and not can_claim:
+                    break
+
+                # Wait for a flow to finish, or until it's time to look for more work or report progress
+                timeout = next_report - time.monotonic()
+                if (room >= refill_at or stalled) and can_claim:
+                    timeout = min(timeout, next_claim - time.monotonic())
+                if running:
+                    timeout = min(timeout, next_reconcile - time.monotonic())
+                try:
+                    flow_ids = [finished.get(timeout=max(timeout, 0))]
+                    while not finished.empty():
+                        flow_ids.append(finished.get_nowait())
+                except queue.Empty:
+                    flow_ids = []
+                now = time.monotonic()
+                if now >= next_reconcile:
+                    outstanding = [flow_id for flow_id, (_, _, result) in running.items() if not result.ready()]
+                    stopped = find_stopped_flows(session, outstanding) if outstanding else set()
+                    # A flow that has only just stopped may not have been reported back yet, so give it until the next
+                    # check
+                    lost = stopped & suspected
+                    suspected = stopped - lost
+                    if lost:
+                        pbar.write(f"Lost track of flows {sorted(lost)}, whose workers may have died; freeing their "
+                                   f"slots")
+                    flow_ids += sorted(lost)
+                    next_reconcile = now + reconcile_seconds
+                n_finished = 0
+                for flow_id in flow_ids:
+                    # A lost flow may still be reported back, once it's already been freed
+                    if flow_id not in running:
+                        continue
+                    flow_type, weight, _ = running.pop(flow_id)
+                    running_per_type[flow_type] -= 1
+                    weight_running -= weight
+                    finish_times.append(now)
+                    n_finished += 1
+                pbar.update(n_finished)
+
+                if now >= next_report:
+                    while finish_times and finish_times[0] < now - 300:
+                        finish_times.popleft()
+                    window = min(now - start, 300)
+                    pbar.set_postfix_str(f"{60 * len(finish_times) / window:.1f} flows/min, "
+                                         f"{len(running)} running (weight {weight_running:.1f}), "
+                                         f"{len(waiting)} queued")
+                    next_report = now + report_seconds
+        except KeyboardInterrupt:
+            pbar.write("Halting")
+            pool.terminate()
+            pool.join()
+            session.rollback()
+            release_unstarted_flows(session, list(running) + [flow_id for flow_id, _ in waiting])
 
 
 if __name__ == "__main__":
     multiprocessing.set_start_method('forkserver')
     parser = argparse.ArgumentParser(prog='speedster')
     parser.add_argument("config", type=str, help="Path to config.")
-    parser.add_argument("-f", "--flows-per-batch", type=int, help="Max number of flows per batch.")
-    parser.add_argument("-b", "--n-batches", type=int, help="Number of batches.")
+    parser.add_argument("-f", "--flows-per-batch", type=int, help="Max number of flows to claim at once.")
+    parser.add_argument("-b", "--n-batches", type=int, help="Stop after this many claims, once their flows finish.")
     parser.add_argument("-w", "--n-workers", type=int, help="Number of workers")
+    parser.add_argument("-s", "--stagger", type=float, default=0,
+                        help="Seconds between the first launches, to spread out their start-up load. Defaults to 0.")
+    parser.add_argument("-p", "--prefetch", type=int,
+                        help="Number of claimed flows to keep queued for the workers. Defaults to the number of workers.")
     args = parser.parse_args()
     config_path = args.config
 
-    session = get_database_session(engine_kwargs=dict(isolation_level="READ COMMITTED"))
+    session = get_database_session(engine_kwargs={"isolation_level": "READ COMMITTED"})
 
     if args.n_workers is None:
         args.n_workers = os.cpu_count()
+    if args.prefetch is None:
+        args.prefetch = args.n_workers
 
-    if args.flows_per_batch is None:
-        n_cores = args.n_workers
-    else:
-        n_cores = min(args.n_workers, args.flows_per_batch)
-
-    n_batches_run = 0
-    with multiprocessing.Pool(n_cores, initializer=worker_init, initargs=(config_path,)) as p:
-        print("Beginning fetch-run loop; press Ctrl-C to exit and allow time for cleanup")
+    with multiprocessing.Pool(args.n_workers, initializer=worker_init, initargs=(config_path,)) as p:
+        print("Beginning streaming dispatch; press Ctrl-C to exit and allow time for cleanup")
         if args.flows_per_batch:
-            print(f"Will cap at {args.flows_per_batch} flows per batch")
+            print(f"Will cap at {args.flows_per_batch} flows per claim")
         if args.n_batches:
-            print(f"Will stop after {args.n_batches} batches")
-        while True:
-            pipeline_config = load_pipeline_configuration(config_path)
-            enabled_flows = load_enabled_flows(pipeline_config)
-
-            batch_of_flows, batch_types, count_per_type = gather_planned_flows(
-                    session, enabled_flows, args.flows_per_batch)
-
-            if len(batch_of_flows) == 0:
-                print("No pending flows found---will wait two minutes and try again")
-                try:
-                    time.sleep(60*2)
-                except KeyboardInterrupt:
-                    break
-            else:
-                print("Batch contents: ", end='')
-                count_report = []
-                for type in sorted(count_per_type.keys()):
-                    print(f"{count_per_type[type]} of {type}, ", end='')
-                print()
-                with tqdm(total=len(batch_of_flows)) as pbar:
-                    # Stagger the launches which may give less DB and IO contention
-                    delays = [i / 6 if i < n_cores else 0 for i in range(len(batch_of_flows))]
-                    try:
-                        for _ in p.imap_unordered(worker_run_flow, zip(batch_of_flows, batch_types, delays)):
-                            pbar.update()
-                    except KeyboardInterrupt:
-                        print("Halting")
-                        break
-            n_batches_run += 1
-            if args.n_batches and n_batches_run >= args.n_batches:
-                break
+            print(f"Will stop after {args.n_batches} claims")
+        dispatch(p, session, config_path, args.n_workers, args.prefetch, args.flows_per_batch, args.n_batches,
+                 stagger=args.stagger)
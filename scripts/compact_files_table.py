@@ -0,0 +1,117 @@
+"""Converts an existing files table to the compact schema
+
+The state, level, file_type, observatory and polarization columns are rewritten as small integers, and the lookup table
+is filled in. Stop the pipeline before running this. Afterward, everything using the database must run with
+PUNCHPIPE_COMPACT_FILES=1 set in its environment, which each process checks when it connects.
+
+Each ALTER TABLE commits on its own, so the conversion can't be one transaction. Instead, every step checks what's
+already been done, and if the script is interrupted it can be run again to pick up where it left off. The database is
+only marked as compact once everything else is finished.
+"""
+import os
+
+os.environ["PUNCHPIPE_COMPACT_FILES"] = "1"
+
+from sqlalchemy import bindparam, func, inspect, select, text  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+from sqlalchemy.types import Integer  # noqa: E402
+
+from punchpipe.control.db import FILE_STATES, File, FileCodeLookup, file_code_lookup_rows  # noqa: E402
+from punchpipe.control.util import get_database_engine  # noqa: E402
+
+# How many rows each UPDATE converts, so no single statement locks or logs the whole table
+BATCH_SIZE = 100_000
+
+
+def packed_code_sql(column_name, length):
+    """SQL computing the packed integer code of a column, matching CodedString.encode"""
+    code = "0"
+    for i in range(1, length + 1):
+        code = f"({code}) * 256 + ASCII(SUBSTRING({column_name}, {i}, 1))"
+    return f"CASE WHEN {column_name} IS NULL THEN NULL ELSE {code} END"
+
+
+def state_code_sql():
+    cases = " ".join(f"WHEN '{state}' THEN {code}" for code, state in enumerate(FILE_STATES))
+    return f"CASE state {cases} END"
+
+
+def get_columns(engine) -> dict:
+    return {column["name"]: column for column in inspect(engine).get_columns("files")}
+
+
+def convert_column(session, engine, column_name, code_sql):
+    """Converts one column, skipping whichever of its steps are already done"""
+    columns = get_columns(engine)
+    code_column = f"{column_name}_code"
+    if column_name in columns and isinstance(columns[column_name]["type"], Integer) and code_column not in columns:
+        print(f"{column_name} is already converted")
+        return
+
+    if column_name in columns and code_column not in columns:
+        print(f"Adding {code_column}")
+        session.execute(text(f"ALTER TABLE files ADD COLUMN {code_column} SMALLINT NULL"))
+        session.commit()
+
+    if column_name in columns:
+        # Rows converted by an earlier, interrupted run are skipped, except that a NULL polarization is simply redone
+        max_id = session.execute(select(func.max(File.file_id))).scalar() or 0
+        print(f"Filling in {code_column} for file IDs up to {max_id}")
+        for start in range(0, max_id + 1, BATCH_SIZE):
+            session.execute(text(f"UPDATE files SET {code_column} = {code_sql} "
+                                 f"WHERE file_id >= :start AND file_id < :end AND {code_column} IS NULL"),
+                            dict(start=start, end=start + BATCH_SIZE))
+            session.commit()
+        print(f"Dropping the old {column_name}")
+        session.execute(text(f"ALTER TABLE files DROP COLUMN {column_name}"))
+        session.commit()
+
+    print(f"Renaming {code_column} to {column_name}")
+    nullable = "NULL" if File.__table__.c[column_name].nullable else "NOT NULL"
+    session.execute(text(f"ALTER TABLE files CHANGE {code_column} {column_name} SMALLINT {nullable}"))
+    session.commit()
+
+
+def fill_file_code_lookup(session, engine):
+    """Creates the lookup table if needed and adds any rows it's missing, ending with the compact schema's marker"""
+    FileCodeLookup.__table__.create(engine, checkfirst=True)
+    existing = set(session.execute(select(FileCodeLookup.column_name, FileCodeLookup.code)).tuples())
+    rows = [row for row in file_code_lookup_rows() if (row["column_name"], row["code"]) not in existing]
+    for start in range(0, len(rows), BATCH_SIZE):
+        session.execute(FileCodeLookup.__table__.insert(), rows[start:start + BATCH_SIZE])
+    session.commit()
+
+
+if __name__ == "__main__":
+    # A partly converted database is neither compact nor not, so the usual check that it matches is skipped
+    engine = get_database_engine(check_schema=False)
+    session = Session(engine)
+
+    columns = get_columns(engine)
+    if "state" in columns and not isinstance(columns["state"]["type"], Integer):
+        unknown_states = session.execute(text("SELECT DISTINCT state FROM files WHERE state NOT IN :states")
+                                         .bindparams(bindparam("states", expanding=True)),
+                                         dict(states=list(FILE_STATES))).scalars().all()
+        if unknown_states:
+            raise RuntimeError(f"Add these states to FILE_STATES before converting: {unknown_states}")
+
+    new_columns = {"level": packed_code_sql("level", 1),
+                   "file_type": packed_code_sql("file_type", 2),
+                   "observatory": packed_code_sql("observatory", 1),
+                   "polarization": packed_code_sql("polarization", 2),
+                   "state": state_code_sql()}
+
+    # The indices are rebuilt at the end, which is much faster than updating them through every step
+    for index in File.__table__.indexes:
+        print(f"Dropping index {index.name}")
+        index.drop(engine, checkfirst=True)
+
+    for column_name, code_sql in new_columns.items():
+        convert_column(session, engine, column_name, code_sql)
+
+    for index in File.__table__.indexes:
+        print(f"Creating index {index.name}")
+        index.create(engine, checkfirst=True)
+
+    fill_file_code_lookup(session, engine)
+    print("Done")
@@ -1,12 +1,12 @@
-from prefect_sqlalchemy import SqlAlchemyConnector
 from sqlalchemy import text
 
 from punchpipe.control.db import Base
+from punchpipe.control.util import get_database_engine
 
 if __name__ == "__main__":
 
-    credentials = SqlAlchemyConnector.load("mariadb-creds")
-    engine = credentials.get_engine()
-    with engine.connect() as connection:
-        result = connection.execute(text('CREATE DATABASE IF NOT EXISTS punchpipe;'))
+    engine = get_database_engine()
+    if engine.dialect.name != "sqlite":
+        with engine.connect() as connection:
+            result = connection.execute(text('CREATE DATABASE IF NOT EXISTS punchpipe;'))
     Base.metadata.create_all(engine)
@@ -9,7 +9,7 @@ from dateutil.parser import parse as parse_datetime_str
 from sqlalchemy.orm import aliased
 from tqdm import tqdm
 
-from punchpipe.control.db import File, FileRelationship, Flow
+from punchpipe.control.db import File, FileRelationship, Flow, FlowAll
 from punchpipe.control.util import get_database_session
 
 
@@ -27,7 +27,7 @@ class ExportedFlow:
     priority: int
 
     @staticmethod
-    def from_Flow(flow: Flow):
+    def from_Flow(flow: Flow | FlowAll):
         return ExportedFlow(
             flow_level=flow.flow_level,
             flow_type=flow.flow_type,
@@ -78,7 +78,8 @@ class ExportedFile:
         if file.processing_flow is None:
             processing_flow = None
         else:
-            processing_flow = session.query(Flow).where(Flow.flow_id == file.processing_flow).one()
+            # The flow may have been archived
+            processing_flow = session.query(FlowAll).where(FlowAll.flow_id == file.processing_flow).one()
 
         child = aliased(File)
         parent = aliased(File)
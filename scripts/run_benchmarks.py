@@ -0,0 +1,186 @@
+"""Benchmarks the database work of the scheduler -> launcher -> processor loop
+
+By default this runs against a fresh SQLite database in a temporary directory, so it needs no MariaDB server or Prefect
+credentials block (Prefect itself runs as a temporary local server). Set PUNCHPIPE_DATABASE_URL to benchmark against
+another, empty, database instead. The synthetic data come from a fixed seed, so results are comparable between runs:
+
+    python scripts/run_benchmarks.py --n-files 20000 --repeat 5 --output benchmark.json
+
+Each step is timed `repeat` times, and the minimum and median times are reported.
+"""
+import os
+import json
+import random
+import argparse
+import tempfile
+import statistics
+from time import perf_counter
+from datetime import datetime, timedelta
+
+import numpy as np
+from astropy.nddata import StdDevUncertainty
+from astropy.wcs import WCS
+from ndcube import NDCube
+from prefect import flow
+from prefect.testing.utilities import prefect_test_harness
+from punchbowl.data import NormalizedMetadata
+from sqlalchemy import insert, update
+
+from punchpipe.control.db import Base, File, Flow
+from punchpipe.control.launcher import count_flows, effective_priority, gather_planned_flows, load_flow_data
+from punchpipe.control.processor import generic_process_flow_logic
+from punchpipe.control.scheduler import generic_scheduler_flow_logic
+from punchpipe.control.util import DATABASE_URL_VARIABLE, get_database_session
+
+FILE_TYPES = ["PM", "PZ", "PP", "CR"]
+OBSERVATORIES = ["1", "2", "3", "4"]
+
+
+def make_config(root, max_start):
+    return {
+        "root": root,
+        "file_version": "1",
+        "scheduler": {"max_start": max_start},
+        "control": {"launcher": {"max_weight_running": 10_000, "max_weight_to_launch_at_once": max_start,
+                                 "max_flows_to_launch_at_once": max_start}},
+        "flows": {"benchmark": {"enabled": True, "launch_weight": 1, "batch_size": 1,
+                                "priority": {"initial": 5, "seconds": [3600, 7200], "escalation": [10, 20]}}},
+    }
+
+
+def populate(session, n_files, n_old_flows, seed):
+    """Fills the database with level 0 files ready to process, and a history of finished flows"""
+    rng = random.Random(seed)
+    t0 = datetime(2025, 1, 1)
+    files = [dict(level="0", file_type=rng.choice(FILE_TYPES), observatory=rng.choice(OBSERVATORIES),
+                  state="created", file_version="1", software_version="benchmark",
+                  date_obs=t0 + timedelta(minutes=4 * i, microseconds=rng.randrange(1_000_000)),
+                  outlier=False, bad_packets=False)
+             for i in range(n_files)]
+    session.execute(insert(File), files)
+    old_flows = []
+    for _ in range(n_old_flows):
+        creation_time = t0 + timedelta(seconds=rng.randrange(86400 * 30))
+        old_flows.append(dict(flow_level="1", flow_type="benchmark", state=rng.choice(["completed", "failed"]),
+                              creation_time=creation_time, start_time=creation_time, end_time=creation_time,
+                              priority=5, call_data="{}", is_backprocessing=False))
+    session.execute(insert(Flow), old_flows)
+    session.commit()
+
+
+def query_ready_files(session, pipeline_config, reference_time=None, max_n=None):
+    return [[f.file_id] for f in session.query(File)
+                                        .where(File.level == "0")
+                                        .where(File.state == "created")
+                                        .order_by(File.date_obs.desc())
+                                        .limit(max_n).all()]
+
+
+def construct_child_file_info(parent_files, pipeline_config, reference_time=None):
+    parent = parent_files[0]
+    return [File(level="1", file_type=parent.file_type, observatory=parent.observatory, state="planned",
+                 file_version=pipeline_config["file_version"], software_version="benchmark",
+                 date_obs=parent.date_obs, outlier=False, bad_packets=False)]
+
+
+def construct_child_flow_info(parent_files, child_files, pipeline_config, session=None, reference_time=None):
+    child = child_files[0]
+    call_data = json.dumps(dict(code=child.file_type + child.observatory, date_obs=str(child.date_obs)))
+    return Flow(flow_level="1", flow_type="benchmark", state="planned", creation_time=datetime.now(),
+                priority=pipeline_config["flows"]["benchmark"]["priority"]["initial"], call_data=call_data)
+
+
+@flow
+def benchmark_scheduler_flow(pipeline_config, session):
+    generic_scheduler_flow_logic(query_ready_files, construct_child_file_info, construct_child_flow_info,
+                                 pipeline_config, session=session)
+
+
+@flow
+def benchmark_core_flow(code, date_obs):
+    data = np.zeros((16, 16))
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = "HPLN-ARC", "HPLT-ARC"
+    meta = NormalizedMetadata.load_template(code, "1")
+    meta["DATE-OBS"] = date_obs
+    meta["DATE"] = datetime.now().strftime("%Y%m%dT%H%M%S")
+    return [NDCube(data=data, uncertainty=StdDevUncertainty(data), wcs=wcs, meta=meta)]
+
+
+@flow
+def benchmark_process_flow(flow_id, pipeline_config_path, session):
+    generic_process_flow_logic(flow_id, benchmark_core_flow, pipeline_config_path, session=session)
+
+
+def time_step(results, name, function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    results[name] = dict(min=min(times), median=statistics.median(times), repeat=repeat)
+    print(f"{name:>24}: min {min(times):8.4f} s, median {statistics.median(times):8.4f} s")
+
+
+def run_benchmarks(n_files, n_old_flows, batch, n_process, repeat, seed, workdir):
+    session, engine = get_database_session(get_engine=True)
+    Base.metadata.create_all(engine)
+    populate(session, n_files, n_old_flows, seed)
+
+    pipeline_config = make_config(os.path.join(workdir, "data"), batch)
+    config_path = os.path.join(workdir, "config.json")
+    # JSON is valid YAML, so load_pipeline_configuration can read this
+    with open(config_path, "w") as f:
+        json.dump(pipeline_config, f)
+    flow_weights, flow_enabled, flow_batch_sizes = load_flow_data(pipeline_config)
+
+    results = {}
+    time_step(results, "schedule", lambda: benchmark_scheduler_flow(pipeline_config, session), repeat)
+    time_step(results, "count_flows", lambda: count_flows.fn(session, flow_weights), repeat)
+
+    selected = []
+
+    def gather():
+        selected[:] = gather_planned_flows.fn(session, batch, batch, flow_weights, flow_enabled, flow_batch_sizes,
+                                              priority=effective_priority(pipeline_config))[0]
+    time_step(results, "gather_planned_flows", gather, repeat)
+
+    def mark_launched():
+        # The database side of launch_ready_flows, without submitting anything to Prefect
+        flow_ids = [flow.flow_id for batch in selected for flow in batch]
+        session.execute(update(Flow).where(Flow.flow_id.in_(flow_ids))
+                        .values(state="launched", launch_time=datetime.now()))
+        session.commit()
+    time_step(results, "mark_launched", mark_launched, 1)
+
+    launched = [flow.flow_id for batch in selected for flow in batch][:n_process]
+
+    def process():
+        for flow_id in launched:
+            benchmark_process_flow(flow_id, config_path, session)
+    time_step(results, "process_flows", process, 1)
+    results["process_flows"]["per_flow"] = results["process_flows"]["min"] / max(len(launched), 1)
+    session.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-files", type=int, default=20_000, help="Number of level 0 files to start with")
+    parser.add_argument("--n-old-flows", type=int, default=50_000, help="Number of finished flows to start with")
+    parser.add_argument("--batch", type=int, default=100, help="Flows to schedule and launch per step")
+    parser.add_argument("--n-process", type=int, default=10, help="Number of flows to run through the processor")
+    parser.add_argument("--repeat", type=int, default=3, help="Times to repeat each step")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.setdefault(DATABASE_URL_VARIABLE, f"sqlite:///{os.path.join(workdir, 'benchmark.db')}")
+        with prefect_test_harness():
+            results = run_benchmarks(args.n_files, args.n_old_flows, args.batch, args.n_process, args.repeat,
+                                     args.seed, workdir)
+    results["settings"] = vars(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -3,8 +3,9 @@ from datetime import datetime, timedelta
 
 from prefect import flow, get_run_logger
 from prefect.schedules import Cron
+from sqlalchemy import func, select
 
-from punchpipe.control.db import File
+from punchpipe.control.db import FileHourlyCounts
 from punchpipe.control.util import get_database_session, load_pipeline_configuration
 
 LEVEL_0_SPACECRAFT = ["1", "2", "3", "4"]
@@ -34,26 +35,28 @@ LEVEL_3_CODES = [f"L3_{prefix}{spacecraft}" for prefix, spacecraft in
 
 LEVEL_Q_CODES = ["LQ_CNN", "LQ_CFN", "LQ_CFM", "LQ_CTM"]
 
-def get_file_count_in_db(level, product, start_time, end_time, session=None):
+def get_file_counts_in_db(start_time, end_time, session=None):
+    """Counts the files created in each product, from the hourly counts kept by the summarizer control flow
+
+    The window is widened to whole hours.
+    """
     if session is None:
         session = get_database_session()
 
-    resulting_files = (
-        session.query(File)
-         .filter(File.level == level)
-         .filter(File.file_type == product[:2])
-         .filter(File.observatory == product[2])
-         .filter(File.date_created > start_time)
-         .filter(File.date_created < end_time)
+    rows = session.execute(
+        select(FileHourlyCounts.level, FileHourlyCounts.file_type, FileHourlyCounts.observatory,
+               func.sum(FileHourlyCounts.count))
+        .where(FileHourlyCounts.hour >= start_time.replace(minute=0, second=0, microsecond=0))
+        .where(FileHourlyCounts.hour < end_time)
+        .group_by(FileHourlyCounts.level, FileHourlyCounts.file_type, FileHourlyCounts.observatory)
     ).all()
-    return len(resulting_files)
+    return {(level, file_type + observatory): int(count) for level, file_type, observatory, count in rows}
 
 def get_minimum_count(configuration, product_code):
     return configuration.get("minimum_counts", {}).get(product_code, 1)
 
-def get_product_counts(product_codes, start_time, end_time, session=None):
-    return {product_code: get_file_count_in_db(product_code[1], product_code[-3:], start_time, end_time, session=session)
-     for product_code in product_codes}
+def get_product_counts(product_codes, file_counts):
+    return {product_code: file_counts.get((product_code[1], product_code[-3:]), 0) for product_code in product_codes}
 
 @flow
 def check_product_counts_watchdog(start_time=None, end_time=None):
@@ -68,11 +71,12 @@ def check_product_counts_watchdog(start_time=None, end_time=None):
     logger.info(f"Checking product counts for {start_time} -> {end_time}")
 
     session = get_database_session()
+    file_counts = get_file_counts_in_db(start_time, end_time, session=session)
 
     error_product_codes = []
     configuration = load_pipeline_configuration()
     for level_codes in [LEVEL_0_CODES, LEVEL_1_CODES, LEVEL_2_CODES, LEVEL_3_CODES, LEVEL_Q_CODES]:
-        counts = get_product_counts(level_codes, start_time, end_time, session=session)
+        counts = get_product_counts(level_codes, file_counts)
         for product_code, count in counts.items():
             minimum_expected_count = get_minimum_count(configuration, product_code)
             if count < minimum_expected_count: